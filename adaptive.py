@@ -0,0 +1,313 @@
+import logging
+import os
+import threading
+import time
+import metrics
+import retry
+from pipeline import percentile
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+# Tune the number of captures in flight at runtime; MAX_WORKERS becomes the starting point
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', 'false').lower() == 'true'
+ADAPTIVE_MIN_WORKERS = int(os.getenv('ADAPTIVE_MIN_WORKERS', 1))
+ADAPTIVE_MAX_WORKERS = int(os.getenv('ADAPTIVE_MAX_WORKERS', 16))
+# Seconds between adjustments
+ADAPTIVE_INTERVAL = float(os.getenv('ADAPTIVE_INTERVAL', 5))
+# Share of the memory limit in use above which slots are taken away; growing must stay below it
+ADAPTIVE_MEMORY_TARGET = float(os.getenv('ADAPTIVE_MEMORY_TARGET', 0.8))
+# CPU use above which slots stop growing
+ADAPTIVE_CPU_TARGET = float(os.getenv('ADAPTIVE_CPU_TARGET', 0.9))
+# Share of attempts failing with timeouts or browser faults above which slots are taken away
+ADAPTIVE_ERROR_RATE = float(os.getenv('ADAPTIVE_ERROR_RATE', 0.2))
+# p95 capture time, as a multiple of the best seen this run, above which slots are taken away
+ADAPTIVE_LATENCY_FACTOR = float(os.getenv('ADAPTIVE_LATENCY_FACTOR', 3))
+# Slots added per healthy interval, and the factor kept when shrinking
+ADAPTIVE_STEP = int(os.getenv('ADAPTIVE_STEP', 1))
+ADAPTIVE_BACKOFF = float(os.getenv('ADAPTIVE_BACKOFF', 0.7))
+
+# Attempts an interval needs before its error rate and latency are trusted
+MIN_SAMPLES = 5
+# How fast the latency baseline follows a run that gets slower for good (per interval)
+BASELINE_DRIFT = 1.05
+
+CGROUP = '/sys/fs/cgroup'
+
+LIMIT = metrics.Gauge('screenshot_concurrency_limit', 'Captures the adaptive controller currently allows in flight')
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _host_memory():
+    meminfo = {}
+    for line in _read('/proc/meminfo').splitlines():
+        name, _, value = line.partition(':')
+        meminfo[name] = int(value.split()[0]) * 1024
+    return meminfo['MemTotal'] - meminfo['MemAvailable'], meminfo['MemTotal']
+
+
+def memory_usage():
+    """(bytes in use, bytes allowed) for this container's cgroup, or for the host without a limit"""
+    host = _host_memory()
+    try:
+        limit = _read(f'{CGROUP}/memory.max')
+        if limit != 'max':
+            stat = dict(line.split() for line in _read(f'{CGROUP}/memory.stat').splitlines())
+            # Inactive page cache is reclaimed before the OOM killer steps in
+            used = int(_read(f'{CGROUP}/memory.current')) - int(stat.get('inactive_file', 0))
+            return used, int(limit)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1 reports no limit as a number close to 2^63
+        limit = int(_read(f'{CGROUP}/memory/memory.limit_in_bytes'))
+        if limit < host[1]:
+            stat = dict(line.split() for line in _read(f'{CGROUP}/memory/memory.stat').splitlines())
+            used = int(_read(f'{CGROUP}/memory/memory.usage_in_bytes')) - int(stat.get('total_inactive_file', 0))
+            return used, limit
+    except (OSError, ValueError):
+        pass
+    return host
+
+
+def cpu_capacity():
+    """CPUs this process may use, honouring a cgroup CPU quota"""
+    try:
+        quota, period = _read(f'{CGROUP}/cpu.max').split()
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: a quota of -1 means none
+        quota = int(_read(f'{CGROUP}/cpu/cpu.cfs_quota_us'))
+        if quota > 0:
+            return quota / int(_read(f'{CGROUP}/cpu/cpu.cfs_period_us'))
+    except (OSError, ValueError):
+        pass
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def cpu_seconds():
+    """CPU time used so far by this container's cgroup, or by the whole host"""
+    try:
+        for line in _read(f'{CGROUP}/cpu.stat').splitlines():
+            name, value = line.split()
+            if name == 'usage_usec':
+                return int(value) / 1e6
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1 counts nanoseconds
+        return int(_read(f'{CGROUP}/cpuacct/cpuacct.usage')) / 1e9
+    except (OSError, ValueError):
+        pass
+    fields = [int(value) for value in _read('/proc/stat').splitlines()[0].split()[1:]]
+    # Everything but idle and iowait
+    return (sum(fields) - fields[3] - fields[4]) / os.sysconf('SC_CLK_TCK')
+
+
+class Slots:
+    """Semaphore for captures in flight whose size can change while it is in use.
+
+    Shrinking never interrupts a capture: slots above the new limit simply
+    are not handed out again once released.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.used >= self.limit:
+                self.condition.wait()
+            self.used += 1
+            self.peak = max(self.peak, self.used)
+
+    def release(self):
+        with self.condition:
+            self.used -= 1
+            self.condition.notify_all()
+
+    def wait_free(self, timeout=None):
+        """Wait up to timeout for a free slot and return how many are free"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.used < self.limit, timeout)
+            return max(0, self.limit - self.used)
+
+    def wait_idle(self):
+        """Wait until every slot has been released"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.used)
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def take_peak(self):
+        """Most slots in use at once since the last call"""
+        with self.condition:
+            peak, self.peak = self.peak, self.used
+            return peak
+
+
+class ConcurrencyController:
+    """Sizes a run's capture slots to what the host can take (AIMD).
+
+    Every ADAPTIVE_INTERVAL seconds it samples memory and CPU use, the
+    browsers' RSS and the capture times and errors of the interval. Memory
+    above ADAPTIVE_MEMORY_TARGET, timeouts and browser faults above
+    ADAPTIVE_ERROR_RATE, or a p95 capture time ADAPTIVE_LATENCY_FACTOR times
+    the run's best shrink the slots by ADAPTIVE_BACKOFF. Otherwise, when all
+    slots were in use, CPU is below ADAPTIVE_CPU_TARGET and another slot's
+    worth of browser memory fits, they grow by ADAPTIVE_STEP. Every change
+    is logged with the sample that caused it.
+    """
+
+    def __init__(self, slots, engine, minimum=ADAPTIVE_MIN_WORKERS, maximum=ADAPTIVE_MAX_WORKERS,
+                 interval=ADAPTIVE_INTERVAL):
+        self.slots = slots
+        self.engine = engine
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.durations = []
+        self.errors = 0
+        self.baseline = None
+        self.cooldown = False
+        self.cpu_at = (time.monotonic(), cpu_seconds())
+        self.stopping = threading.Event()
+        self.thread = None
+        self.adjustments = 0
+        LIMIT.set(slots.limit)
+
+    def observe(self, seconds, error=None):
+        """Account one finished attempt; error is its exception, if it failed"""
+        with self.lock:
+            self.durations.append(seconds)
+            # Pages that do not exist say nothing about load; timeouts and crashes do
+            if error is not None and retry.classify(error) != retry.PERMANENT:
+                self.errors += 1
+
+    def sample(self):
+        """Resource use and capture outcomes since the previous sample"""
+        with self.lock:
+            durations, self.durations = self.durations, []
+            errors, self.errors = self.errors, 0
+        now, cpu = time.monotonic(), cpu_seconds()
+        elapsed = now - self.cpu_at[0]
+        cpu_use = (cpu - self.cpu_at[1]) / (elapsed * cpu_capacity()) if elapsed > 0 else 0.0
+        self.cpu_at = (now, cpu)
+        used, limit = memory_usage()
+        in_use = max(1, self.slots.used)
+        return {
+            'memory': used / limit,
+            'memory_free_mb': (limit * ADAPTIVE_MEMORY_TARGET - used) / (1024 * 1024),
+            'cpu': cpu_use,
+            'slot_rss_mb': self.engine.rss_mb() / in_use,
+            'completed': len(durations),
+            'per_second': len(durations) / elapsed if elapsed > 0 else 0.0,
+            'p95': percentile(sorted(durations), 0.95) if durations else None,
+            'error_rate': errors / len(durations) if durations else 0.0,
+            'saturated': self.slots.take_peak() >= self.slots.limit,
+        }
+
+    def decide(self, limit, sample):
+        """New slot count for a sample and why, or (limit, None) to hold"""
+        trusted = sample['completed'] >= MIN_SAMPLES
+        if trusted and sample['p95'] is not None:
+            if self.baseline is None or sample['p95'] < self.baseline:
+                self.baseline = sample['p95']
+            slow = sample['p95'] > self.baseline * ADAPTIVE_LATENCY_FACTOR
+            # A run whose pages are simply slower later on re-baselines over time
+            self.baseline *= BASELINE_DRIFT
+        else:
+            slow = False
+
+        # The interval after a decrease still holds captures started under the old limit,
+        # so only memory may shrink the slots again before the decrease has shown its effect
+        cooldown, self.cooldown = self.cooldown, False
+        if sample['memory'] > ADAPTIVE_MEMORY_TARGET:
+            reason = 'memory above target'
+        elif cooldown:
+            return limit, None
+        elif trusted and sample['error_rate'] > ADAPTIVE_ERROR_RATE:
+            reason = 'error rate above target'
+        elif slow:
+            reason = 'captures slowing down'
+        else:
+            reason = None
+        if reason:
+            self.cooldown = True
+            return max(self.minimum, min(limit - 1, int(limit * ADAPTIVE_BACKOFF))), reason
+        if not sample['saturated'] or limit >= self.maximum:
+            return limit, None
+        if sample['cpu'] > ADAPTIVE_CPU_TARGET:
+            return limit, None
+        if sample['slot_rss_mb'] * ADAPTIVE_STEP > sample['memory_free_mb']:
+            return limit, None
+        return min(self.maximum, limit + ADAPTIVE_STEP), 'headroom available'
+
+    def adjust(self):
+        sample = self.sample()
+        limit = self.slots.limit
+        new_limit, reason = self.decide(limit, sample)
+        if new_limit == limit:
+            return
+        self.slots.resize(new_limit)
+        resize = getattr(self.engine, 'resize', None)
+        if resize is not None:
+            resize(new_limit)
+        LIMIT.set(new_limit)
+        self.adjustments += 1
+        p95 = f"{sample['p95']:.1f}s" if sample['p95'] is not None else 'n/a'
+        logging.info(f"Concurrency {limit} -> {new_limit} ({reason}): memory {sample['memory']:.0%}, "
+                     f"CPU {sample['cpu']:.0%}, browser RSS {sample['slot_rss_mb']:.0f} MB/slot, "
+                     f"p95 {p95}, errors {sample['error_rate']:.0%}, {sample['per_second']:.2f} captures/s")
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception as e:
+                logging.error(f"Adaptive concurrency sample failed: {str(e)}")
+
+    def start(self):
+        logging.info(f"Adaptive concurrency: starting at {self.slots.limit}, "
+                     f"between {self.minimum} and {self.maximum}")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        LIMIT.set(0)
+        logging.info(f"Adaptive concurrency: ended at {self.slots.limit} after {self.adjustments} adjustments")
+
+
+def create_slots(engine, window, start):
+    """Capture slots for an engine and their controller.
+
+    Without ADAPTIVE_CONCURRENCY the slots stay at window and there is no
+    controller; with it they start at start, within the configured bounds
+    and the engine's own concurrency.
+    """
+    if not ADAPTIVE_CONCURRENCY:
+        return Slots(window), None
+    maximum = min(ADAPTIVE_MAX_WORKERS, engine.concurrency)
+    slots = Slots(max(ADAPTIVE_MIN_WORKERS, min(start, maximum)))
+    controller = ConcurrencyController(slots, engine, maximum=maximum)
+    controller.start()
+    return slots, controller
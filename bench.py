@@ -0,0 +1,327 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from PIL import Image
+from browser_pool import process_tree_rss_mb
+from pipeline import percentile
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+BENCH_LEVELS = os.getenv('BENCH_LEVELS', '1,2,4,8')
+BENCH_PAGES = int(os.getenv('BENCH_PAGES', 5))
+BENCH_SLOW_DELAY = float(os.getenv('BENCH_SLOW_DELAY', 3))
+BENCH_OUTPUT = os.getenv('BENCH_OUTPUT', 'bench.json')
+BENCH_SAMPLE_INTERVAL = float(os.getenv('BENCH_SAMPLE_INTERVAL', 0.25))
+CAPTURE_ENGINE = os.getenv('CAPTURE_ENGINE', 'selenium')
+
+# Kinds of synthetic page in the corpus, served as http://<kind>-<n>.localhost:<port>
+KINDS = ('static', 'heavy', 'slow', 'js', 'infinite', 'error')
+
+# Seconds a request for /hang is held open; longer than any readiness timeout
+HANG_SECONDS = 300
+
+PARAGRAPH = ("<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+             "incididunt ut labore et dolore magna aliqua.</p>")
+
+
+def noise_png(seed, size=256):
+    """Incompressible PNG, so heavy pages move real bytes"""
+    data = random.Random(seed).randbytes(size * size * 3)
+    output = io.BytesIO()
+    Image.frombytes('RGB', (size, size), data).save(output, format='PNG')
+    return output.getvalue()
+
+
+def page_html(kind, n):
+    title = f"{kind.title()} page {n}"
+    head = (f"<!DOCTYPE html><html><head><title>{title}</title><style>body {{ font-family: sans-serif; "
+            f"background: hsl({n * 37 % 360}, 40%, 95%); margin: 40px }}</style></head><body><h1>{title}</h1>")
+    if kind == 'heavy':
+        body = ''.join(f'<img src="/asset/{i}.png?page={n}" width="256" height="256">' for i in range(24))
+    elif kind == 'js':
+        # Nothing to see until the script has fetched its data and built the page
+        body = ('<div id="app">Loading...</div><script>'
+                'fetch("/data.json").then(r => r.json()).then(data => setTimeout(() => {'
+                'const app = document.getElementById("app"); app.textContent = "";'
+                'for (const item of data.items) { const p = document.createElement("p");'
+                'p.textContent = item; app.appendChild(p); } }, 300));</script>')
+    elif kind == 'infinite':
+        # A resource that never arrives and constant polling: the network never goes idle
+        body = (PARAGRAPH * 5 + '<img src="/hang" width="10" height="10"><script>'
+                'setInterval(() => fetch("/data.json?t=" + Date.now()), 200);</script>')
+    else:
+        body = PARAGRAPH * 20
+    return f"{head}{body}</body></html>".encode()
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_page(self, body, content_type='text/html', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        host = self.headers.get('Host', '').split(':')[0]
+        kind, _, number = host.split('.')[0].partition('-')
+        path = urlsplit(self.path).path
+        if path == '/hang':
+            time.sleep(HANG_SECONDS)
+            self.close_connection = True
+        elif path.startswith('/asset/'):
+            index = int(os.path.splitext(os.path.basename(path))[0] or 0)
+            self.send_page(self.server.images[index % len(self.server.images)], 'image/png')
+        elif path == '/data.json':
+            self.send_page(json.dumps({'items': [f"Item {i}" for i in range(200)]}).encode(), 'application/json')
+        elif kind not in KINDS or not number.isdigit():
+            self.send_page(b'Unknown fixture', 'text/plain', 404)
+        elif kind == 'error':
+            self.send_page(b'<h1>Internal Server Error</h1>', status=500)
+        else:
+            if kind == 'slow':
+                time.sleep(self.server.slow_delay)
+            self.send_page(page_html(kind, int(number)))
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """Local web server answering for <kind>-<n>.localhost with a synthetic page of that kind.
+
+    Chrome resolves every *.localhost name to the loopback address itself,
+    so each page is its own host without touching DNS.
+    """
+
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, port=0, slow_delay=BENCH_SLOW_DELAY):
+        super().__init__(('127.0.0.1', port), FixtureHandler)
+        self.slow_delay = slow_delay
+        self.images = [noise_png(seed) for seed in range(4)]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def targets(self, pages):
+        """Target lines for pages of every kind, kinds interleaved"""
+        return [f"http://{kind}-{n}.localhost:{self.port}" for n in range(pages) for kind in KINDS]
+
+
+def latency_summary(seconds):
+    values = sorted(seconds)
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+    }
+
+
+def job_latencies(job_db):
+    """End-to-end latency of every finished job, overall and by fixture kind"""
+    connection = sqlite3.connect(job_db)
+    try:
+        rows = connection.execute(
+            'SELECT domain, state, duration FROM jobs WHERE run_id = (SELECT MAX(id) FROM runs)').fetchall()
+    finally:
+        connection.close()
+    by_kind = {}
+    for domain, state, duration in rows:
+        kind = domain.split('://')[-1].split('-')[0]
+        entry = by_kind.setdefault(kind, {'durations': [], 'success': 0, 'error': 0})
+        entry['success' if state == 'success' else 'error'] += 1
+        if duration is not None:
+            entry['durations'].append(duration)
+    kinds = {kind: dict(latency_summary(entry.pop('durations')), **entry) for kind, entry in by_kind.items()}
+    total = latency_summary([duration for _, _, duration in rows if duration is not None])
+    return total, kinds
+
+
+def run_level(concurrency, targets, engine, log_path):
+    """Capture the corpus in a fresh worker process at one concurrency level and measure it"""
+    with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+        target_file = os.path.join(workdir, 'target.txt')
+        with open(target_file, 'w') as f:
+            f.write(''.join(f"{target}\n" for target in targets))
+        result_file = os.path.join(workdir, 'result.json')
+        job_db = os.path.join(workdir, 'jobs.db')
+        env = dict(os.environ,
+                   CAPTURE_ENGINE=engine,
+                   MAX_WORKERS=str(concurrency),
+                   CDP_CONCURRENCY=str(concurrency),
+                   TARGET_FILE=target_file,
+                   IMAGE_DIR=os.path.join(workdir, 'img'),
+                   MANIFEST_FILE=os.path.join(workdir, 'manifest.jsonl'),
+                   JOB_DB=job_db,
+                   PRECHECK='false',
+                   INCREMENTAL='false',
+                   RESUME='false',
+                   BENCH_RESULT=result_file)
+
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.monotonic()
+        peak_rss = 0.0
+        with open(log_path, 'w') as log:
+            worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                                      env=env, stdout=log, stderr=subprocess.STDOUT)
+            while worker.poll() is None:
+                # Browsers are children of the worker, so the whole tree is counted
+                peak_rss = max(peak_rss, process_tree_rss_mb(worker.pid))
+                time.sleep(BENCH_SAMPLE_INTERVAL)
+        wall = time.monotonic() - started
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        if worker.returncode != 0 or not os.path.exists(result_file):
+            raise RuntimeError(f"Benchmark worker at concurrency {concurrency} failed, see {log_path}")
+        with open(result_file, 'r') as f:
+            counts = json.load(f)
+        total, kinds = job_latencies(job_db)
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    stages = counts.get('stages', {})
+    stages['total'] = total
+    return {
+        'concurrency': concurrency,
+        'pages': len(targets),
+        'success': counts['success'],
+        'error': counts['error'],
+        'wall_seconds': wall,
+        'pages_per_minute': (counts['success'] + counts['error']) / wall * 60 if wall else 0.0,
+        'peak_rss_mb': peak_rss,
+        'rss_per_worker_mb': peak_rss / concurrency,
+        'cpu_seconds': cpu,
+        'cpu_percent': cpu / wall * 100 if wall else 0.0,
+        'stages': stages,
+        'kinds': kinds,
+    }
+
+
+def format_level(level):
+    stages = level['stages']
+    parts = [f"c={level['concurrency']:<3}",
+             f"{level['pages_per_minute']:7.1f} pages/min",
+             f"{level['success']}/{level['pages']} ok",
+             f"peak RSS {level['peak_rss_mb']:.0f} MB ({level['rss_per_worker_mb']:.0f}/worker)",
+             f"CPU {level['cpu_percent']:.0f}%"]
+    for name in ('capture', 'postprocess', 'total'):
+        if name in stages:
+            s = stages[name]
+            parts.append(f"{name} p50/p95/p99 {s['p50_ms']:.0f}/{s['p95_ms']:.0f}/{s['p99_ms']:.0f} ms")
+    return '  '.join(parts)
+
+
+def run_benchmark(levels, pages, engine, output):
+    """Benchmark every concurrency level against a fresh fixture server and write the results to output"""
+    server = FixtureServer().start()
+    targets = server.targets(pages)
+    results = {
+        'created_at': time.time(),
+        'host': {'platform': platform.platform(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+        'config': {
+            'engine': engine,
+            'pages_per_kind': pages,
+            'kinds': list(KINDS),
+            'slow_delay': server.slow_delay,
+            # Capture settings that change the numbers, as the worker sees them
+            'settings': {name: os.getenv(name) for name in
+                         ('READY_STRATEGIES', 'READY_TIMEOUT', 'PAGE_LOAD_WAIT', 'SCREENSHOT_RESIZE_WIDTH',
+                          'OUTPUT_FORMAT', 'OUTPUT_VARIANTS', 'BROWSER_SCALING', 'TABS_PER_BROWSER',
+                          'POSTPROCESS_WORKERS') if os.getenv(name) is not None},
+        },
+        'levels': [],
+    }
+    base = os.path.splitext(output)[0]
+    try:
+        for concurrency in levels:
+            level = run_level(concurrency, targets, engine, f"{base}-c{concurrency}.log")
+            results['levels'].append(level)
+            print(format_level(level), flush=True)
+            # Written after every level so an interrupted benchmark keeps what it measured
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def change(old, new):
+    return f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+
+
+def compare(old_path, new_path):
+    """Print how each concurrency level moved between two result files"""
+    with open(old_path, 'r') as f:
+        old = {level['concurrency']: level for level in json.load(f)['levels']}
+    with open(new_path, 'r') as f:
+        new = {level['concurrency']: level for level in json.load(f)['levels']}
+    for concurrency in sorted(set(old) & set(new)):
+        a, b = old[concurrency], new[concurrency]
+        lines = [f"c={concurrency}",
+                 f"  pages/min          {a['pages_per_minute']:6.1f} -> {b['pages_per_minute']:6.1f} "
+                 f"({change(a['pages_per_minute'], b['pages_per_minute'])})",
+                 f"  peak RSS MB        {a['peak_rss_mb']:6.0f} -> {b['peak_rss_mb']:6.0f} "
+                 f"({change(a['peak_rss_mb'], b['peak_rss_mb'])})",
+                 f"  CPU %              {a['cpu_percent']:6.0f} -> {b['cpu_percent']:6.0f}"]
+        for name in ('capture', 'postprocess', 'total'):
+            if name in a['stages'] and name in b['stages']:
+                x, y = a['stages'][name]['p95_ms'], b['stages'][name]['p95_ms']
+                lines.append(f"  {name + ' p95 ms':<18} {x:6.0f} -> {y:6.0f} ({change(x, y)})")
+        print('\n'.join(lines))
+
+
+def run_worker():
+    """Worker side of one level: run a capture batch and write its counts for the parent"""
+    import screenshot
+    counts = screenshot.run_batch(incremental=False, resume=False)
+    with open(os.environ['BENCH_RESULT'], 'w') as f:
+        json.dump(counts, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the capture pipeline against local fixture pages')
+    parser.add_argument('--levels', default=BENCH_LEVELS, help='comma-separated concurrency levels')
+    parser.add_argument('--pages', type=int, default=BENCH_PAGES, help='pages of each kind')
+    parser.add_argument('--engine', default=CAPTURE_ENGINE, choices=('selenium', 'cdp'))
+    parser.add_argument('--output', default=BENCH_OUTPUT, help='JSON results file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker()
+    elif args.compare:
+        compare(*args.compare)
+    else:
+        levels = [int(level) for level in args.levels.split(',') if level.strip()]
+        run_benchmark(levels, args.pages, args.engine, args.output)
+
+
+if __name__ == "__main__":
+    main()
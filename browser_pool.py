@@ -0,0 +1,281 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from selenium import webdriver
+from selenium.webdriver.chromium.remote_connection import ChromiumRemoteConnection
+from selenium.webdriver.chrome.service import Service
+from driver_cache import resolve_chromedriver
+from retry import is_browser_fault
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+BROWSER_POOL_SIZE = int(os.getenv('BROWSER_POOL_SIZE', 0))
+TABS_PER_BROWSER = int(os.getenv('TABS_PER_BROWSER', 4))
+BROWSER_MAX_PAGES = int(os.getenv('BROWSER_MAX_PAGES', 200))
+BROWSER_MAX_RSS_MB = int(os.getenv('BROWSER_MAX_RSS_MB', 1024))
+# Pages between RSS checks; measuring walks all of /proc
+BROWSER_RSS_CHECK_PAGES = int(os.getenv('BROWSER_RSS_CHECK_PAGES', 10))
+
+
+def process_tree_rss_mb(pid):
+    """Sum the resident memory of a process and all of its descendants (Linux only)"""
+    children = {}
+    rss_pages = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # Fields after the command name start at "state"; ppid is next, rss is 22nd
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss_pages[int(entry)] = int(fields[21])
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss_pages.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class Tab:
+    def __init__(self, browser, driver):
+        self.browser = browser
+        self.driver = driver
+        self.busy = False
+
+
+class Browser:
+    """One Chrome process driven through several tabs.
+
+    The first tab belongs to the session that launched Chrome. Every other tab
+    is a separate WebDriver session on the same chromedriver, attached to the
+    running browser through its debugger address, so tabs can be driven from
+    different threads without switching windows.
+    """
+
+    def __init__(self, options_factory, tabs):
+        self.driver_path = resolve_chromedriver()
+        self.owner = webdriver.Chrome(service=Service(self.driver_path), options=options_factory())
+        self.debugger_address = self.owner.capabilities['goog:chromeOptions']['debuggerAddress']
+        self.options_factory = options_factory
+        self.pages = 0
+        self.retiring = False
+        self.tabs = [Tab(self, self.owner)]
+        for _ in range(tabs - 1):
+            self.tabs.append(Tab(self, self._open_tab()))
+
+    def _open_tab(self):
+        # ChromiumRemoteConnection keeps the executeCdpCommand endpoint available on tabs
+        connection = ChromiumRemoteConnection(
+            self.owner.service.service_url, vendor_prefix='goog', browser_name='chrome')
+        driver = webdriver.Remote(
+            command_executor=connection,
+            options=self.options_factory(debugger_address=self.debugger_address)
+        )
+        driver.switch_to.new_window('tab')
+        return driver
+
+    def replace_tab(self, tab):
+        """Close a misbehaving tab and open a fresh one in its place"""
+        if tab.driver is not self.owner:
+            try:
+                tab.driver.close()
+                tab.driver.quit()
+            except Exception:
+                pass
+            tab.driver = self._open_tab()
+
+    def is_alive(self):
+        try:
+            self.owner.window_handles
+            return True
+        except Exception:
+            return False
+
+    def rss_mb(self):
+        try:
+            return process_tree_rss_mb(self.owner.service.process.pid)
+        except Exception:
+            return 0
+
+    def busy(self):
+        return any(tab.busy for tab in self.tabs)
+
+    def quit(self):
+        for tab in self.tabs:
+            if tab.driver is not self.owner:
+                try:
+                    tab.driver.quit()
+                except Exception:
+                    pass
+        try:
+            self.owner.quit()
+        except Exception:
+            pass
+
+
+class BrowserPool:
+    """Hands out leases on browser tabs to worker threads.
+
+    Browsers are launched lazily up to size, health-checked when a tab is
+    leased, and recycled once they have served max_pages pages or their
+    process tree grows past max_rss_mb.
+    """
+
+    def __init__(self, options_factory, size, tabs=TABS_PER_BROWSER,
+                 max_pages=BROWSER_MAX_PAGES, max_rss_mb=BROWSER_MAX_RSS_MB):
+        self.options_factory = options_factory
+        self.size = size
+        self.tabs = tabs
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.browsers = []
+        self.launching = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _free_tab(self):
+        for browser in self.browsers:
+            if browser.retiring:
+                continue
+            for tab in browser.tabs:
+                if not tab.busy:
+                    return tab
+        return None
+
+    def _launch(self):
+        """Start a browser outside the lock; the caller has reserved a launch slot"""
+        try:
+            browser = Browser(self.options_factory, self.tabs)
+        except Exception:
+            with self.condition:
+                self.launching -= 1
+                self.condition.notify_all()
+            raise
+        logging.info(f"Launched browser with {self.tabs} tabs at {browser.debugger_address}")
+        with self.condition:
+            self.launching -= 1
+            self.browsers.append(browser)
+            self.condition.notify_all()
+
+    def acquire(self):
+        """Block until a healthy tab is free and mark it busy"""
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        raise RuntimeError("Browser pool is closed")
+                    tab = self._free_tab()
+                    if tab:
+                        tab.busy = True
+                        break
+                    if len(self.browsers) + self.launching < self.size:
+                        self.launching += 1
+                        tab = None
+                        break
+                    self.condition.wait()
+
+            if tab is None:
+                self._launch()
+                continue
+
+            if tab.browser.is_alive():
+                return tab
+            self._discard(tab.browser)
+
+    def release(self, tab, healthy=True):
+        """Return a tab to the pool, recycling it or its browser when needed"""
+        browser = tab.browser
+        with self.condition:
+            browser.pages += 1
+            pages = browser.pages
+
+        if not healthy:
+            if browser.is_alive():
+                try:
+                    browser.replace_tab(tab)
+                except Exception as e:
+                    logging.error(f"Error replacing browser tab: {str(e)}")
+                    browser.retiring = True
+            else:
+                browser.retiring = True
+
+        if not browser.retiring:
+            if pages >= self.max_pages:
+                logging.info(f"Recycling browser after {pages} pages")
+                browser.retiring = True
+            elif (self.max_rss_mb and pages % max(1, BROWSER_RSS_CHECK_PAGES) == 0
+                  and browser.rss_mb() > self.max_rss_mb):
+                logging.info(f"Recycling browser above {self.max_rss_mb} MB RSS")
+                browser.retiring = True
+
+        with self.condition:
+            tab.busy = False
+            retire = browser.retiring and not browser.busy() and browser in self.browsers
+            if retire:
+                self.browsers.remove(browser)
+            self.condition.notify_all()
+        if retire:
+            browser.quit()
+
+    def _discard(self, browser):
+        browser.retiring = True
+        with self.condition:
+            if browser in self.browsers:
+                self.browsers.remove(browser)
+            self.condition.notify_all()
+        logging.warning("Discarding unresponsive browser")
+        browser.quit()
+
+    @contextmanager
+    def lease(self):
+        """Lease a tab for the duration of a with block and yield its driver"""
+        tab = self.acquire()
+        try:
+            yield tab.driver
+        except Exception as e:
+            # A page that failed to load leaves the tab usable; only session faults replace it
+            self.release(tab, healthy=not is_browser_fault(e))
+            raise
+        self.release(tab)
+
+    def resize(self, size):
+        """Change how many browsers may run; surplus ones retire once their tabs are idle"""
+        retired = []
+        with self.condition:
+            self.size = size
+            surplus = len(self.browsers) - size
+            # Idle browsers first, they can go right away
+            for browser in sorted(self.browsers, key=lambda browser: browser.busy())[:max(0, surplus)]:
+                browser.retiring = True
+                if not browser.busy():
+                    self.browsers.remove(browser)
+                    retired.append(browser)
+            self.condition.notify_all()
+        for browser in retired:
+            browser.quit()
+        if retired:
+            logging.info(f"Closed {len(retired)} idle browsers, pool size now {size}")
+
+    def rss_mb(self):
+        """Resident memory of every running browser and its children"""
+        with self.condition:
+            browsers = list(self.browsers)
+        return sum(browser.rss_mb() for browser in browsers)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            browsers, self.browsers = self.browsers, []
+            self.condition.notify_all()
+        for browser in browsers:
+            browser.quit()
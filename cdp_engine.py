@@ -0,0 +1,338 @@
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import websockets
+import metrics
+from dotenv import load_dotenv
+from browser_pool import process_tree_rss_mb
+from imaging import capture_params
+from pipeline import StageMetrics
+from readiness import (ReadinessResult, READY_STRATEGIES, READY_TIMEOUT, READY_POLL_INTERVAL,
+                       NETWORK_IDLE_WINDOW, PAGE_LOAD_WAIT)
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+CHROME_BINARY = os.getenv('CHROME_BINARY', '')
+CDP_BROWSERS = int(os.getenv('CDP_BROWSERS', 2))
+CDP_CONCURRENCY = int(os.getenv('CDP_CONCURRENCY', 64))
+CDP_LAUNCH_TIMEOUT = float(os.getenv('CDP_LAUNCH_TIMEOUT', 30))
+SCREENSHOT_WIDTH = int(os.getenv('SCREENSHOT_WIDTH', 1920))
+SCREENSHOT_HEIGHT = int(os.getenv('SCREENSHOT_HEIGHT', 1080))
+HEADLESS = os.getenv('HEADLESS', 'true').lower() == 'true'
+
+
+class CDPError(Exception):
+    pass
+
+
+def find_chrome_binary():
+    """Return CHROME_BINARY or the first Chrome/Chromium found on PATH"""
+    if CHROME_BINARY:
+        return CHROME_BINARY
+    for name in ('google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser'):
+        path = shutil.which(name)
+        if path:
+            return path
+    raise CDPError("No Chrome binary found; set CHROME_BINARY")
+
+
+class CDPConnection:
+    """A browser-level DevTools websocket multiplexing many page sessions"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.listeners = {}
+        self.reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def send(self, method, params=None, session_id=None, timeout=READY_TIMEOUT):
+        """Send a command and wait for its result, giving up after timeout seconds"""
+        message = {'id': next(self.ids), 'method': method, 'params': params or {}}
+        if session_id:
+            message['sessionId'] = session_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message['id']] = future
+        try:
+            await self.websocket.send(json.dumps(message))
+            # Page.navigate only answers once the response commits, which a stalled host never does
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise CDPError(f"Timed out after {timeout:g}s waiting for {method}")
+        finally:
+            self.pending.pop(message['id'], None)
+
+    async def _read(self):
+        try:
+            async for raw in self.websocket:
+                message = json.loads(raw)
+                if 'id' in message:
+                    future = self.pending.pop(message['id'], None)
+                    if future is None or future.done():
+                        continue
+                    if 'error' in message:
+                        future.set_exception(CDPError(message['error'].get('message', 'CDP error')))
+                    else:
+                        future.set_result(message.get('result', {}))
+                else:
+                    listener = self.listeners.get(message.get('sessionId'))
+                    if listener:
+                        listener(message['method'], message.get('params', {}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(CDPError("DevTools connection closed"))
+            self.pending.clear()
+
+    async def close(self):
+        await self.websocket.close()
+        await self.reader
+
+
+class PageReadiness:
+    """Evaluates the readiness strategies from a page session's CDP events"""
+
+    def __init__(self, names=READY_STRATEGIES):
+        self.names = [name.strip() for name in names.split(',') if name.strip()]
+        self.frame_id = None
+        self.lifecycle = set()
+        self.in_flight = set()
+        self.last_activity = 0.0
+
+    def on_event(self, method, params):
+        loop_time = asyncio.get_running_loop().time()
+        if method == 'Page.lifecycleEvent':
+            if self.frame_id and params.get('frameId') != self.frame_id:
+                return
+            if params.get('name') == 'init':
+                self.lifecycle.clear()
+            self.lifecycle.add(params.get('name'))
+        elif method == 'Network.requestWillBeSent':
+            self.in_flight.add(params.get('requestId'))
+            self.last_activity = loop_time
+        elif method in ('Network.loadingFinished', 'Network.loadingFailed'):
+            self.in_flight.discard(params.get('requestId'))
+            self.last_activity = loop_time
+
+    def _fired(self, name, elapsed, now):
+        if name == 'readystate':
+            return 'load' in self.lifecycle
+        if name == 'network_idle':
+            return ('DOMContentLoaded' in self.lifecycle and not self.in_flight
+                    and now - self.last_activity >= NETWORK_IDLE_WINDOW)
+        if name == 'first_paint':
+            return 'firstContentfulPaint' in self.lifecycle
+        if name == 'fixed':
+            return elapsed >= PAGE_LOAD_WAIT
+        raise ValueError(f"Unknown readiness strategy: {name}")
+
+    async def wait(self, started):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            elapsed = now - started
+            for name in self.names:
+                if name != 'timeout' and self._fired(name, elapsed, now):
+                    return ReadinessResult(name, elapsed)
+            if elapsed >= READY_TIMEOUT:
+                return ReadinessResult('timeout', elapsed)
+            await asyncio.sleep(READY_POLL_INTERVAL)
+
+
+class ChromeBrowser:
+    """A headless Chrome process driven over its DevTools websocket"""
+
+    def __init__(self, process, user_data_dir, connection):
+        self.process = process
+        self.user_data_dir = user_data_dir
+        self.connection = connection
+
+    @classmethod
+    async def launch(cls):
+        user_data_dir = tempfile.mkdtemp(prefix='cdp-chrome-')
+        args = [
+            find_chrome_binary(),
+            '--remote-debugging-port=0',
+            f'--user-data-dir={user_data_dir}',
+            '--no-sandbox',
+            '--disable-dev-shm-usage',
+            '--disable-gpu',
+            '--no-first-run',
+            f'--window-size={SCREENSHOT_WIDTH},{SCREENSHOT_HEIGHT}',
+        ]
+        if HEADLESS:
+            args.append('--headless=new')
+        args.append('about:blank')
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # Chrome writes the port and browser target path once DevTools is listening
+        port_file = os.path.join(user_data_dir, 'DevToolsActivePort')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CDP_LAUNCH_TIMEOUT
+        while True:
+            try:
+                with open(port_file, 'r') as f:
+                    port, path = f.read().split()[:2]
+                break
+            except (OSError, ValueError):
+                if process.returncode is not None or loop.time() > deadline:
+                    if process.returncode is None:
+                        process.kill()
+                    shutil.rmtree(user_data_dir, ignore_errors=True)
+                    raise CDPError("Chrome did not start a DevTools endpoint")
+                await asyncio.sleep(0.1)
+
+        websocket = await websockets.connect(f'ws://127.0.0.1:{port}{path}', max_size=None)
+        logging.info(f"Launched Chrome for CDP on port {port}")
+        return cls(process, user_data_dir, CDPConnection(websocket))
+
+    def is_alive(self):
+        return self.process.returncode is None and not self.connection.reader.done()
+
+    async def capture(self, url, domain=None):
+        """Open url in a new tab and return the PNG bytes and readiness result"""
+        connection = self.connection
+        loop = asyncio.get_running_loop()
+        opened, opening = time.time(), loop.time()
+        target = await connection.send('Target.createTarget', {'url': 'about:blank'})
+        target_id = target['targetId']
+        attached = await connection.send('Target.attachToTarget', {'targetId': target_id, 'flatten': True})
+        session_id = attached['sessionId']
+        page = PageReadiness()
+        connection.listeners[session_id] = page.on_event
+
+        try:
+            await connection.send('Page.enable', session_id=session_id)
+            await connection.send('Page.setLifecycleEventsEnabled', {'enabled': True}, session_id)
+            await connection.send('Network.enable', session_id=session_id)
+            await connection.send('Emulation.setDeviceMetricsOverride', {
+                'width': SCREENSHOT_WIDTH,
+                'height': SCREENSHOT_HEIGHT,
+                'deviceScaleFactor': 1,
+                'mobile': False,
+            }, session_id)
+
+            started = loop.time()
+            navigation = await connection.send('Page.navigate', {'url': url}, session_id)
+            navigated = loop.time()
+            # Opening the tab counts towards navigation
+            metrics.record(domain, 'navigate', navigated - opening, opened)
+            if navigation.get('errorText'):
+                raise CDPError(f"{navigation['errorText']} loading {url}")
+            page.frame_id = navigation.get('frameId')
+            ready = (await page.wait(started))._replace(navigated=navigated - started)
+            metrics.record(domain, 'ready', loop.time() - navigated, opened + navigated - opening)
+
+            with metrics.stage(domain, 'capture'):
+                screenshot = await connection.send('Page.captureScreenshot', capture_params(), session_id)
+            return base64.b64decode(screenshot['data']), ready
+        finally:
+            connection.listeners.pop(session_id, None)
+            try:
+                await connection.send('Target.closeTarget', {'targetId': target_id})
+            except CDPError:
+                pass
+
+    async def close(self):
+        try:
+            await self.connection.send('Browser.close', timeout=5)
+        except (CDPError, websockets.ConnectionClosed):
+            pass
+        await self.connection.close()
+        if self.process.returncode is None:
+            self.process.kill()
+        await self.process.wait()
+        shutil.rmtree(self.user_data_dir, ignore_errors=True)
+
+
+class CDPCaptureEngine:
+    """Capture engine that multiplexes page loads over a few Chrome processes.
+
+    An asyncio loop runs on a single background thread. submit() returns a
+    concurrent.futures.Future, like the thread-based engine, so callers do
+    not care which engine is in use. on_capture(domain, png_bytes) hands each
+    screenshot to post-processing and returns a future; it may block for
+    backpressure, so it runs in the loop's default executor.
+    """
+
+    def __init__(self, on_capture, url_for, browsers=CDP_BROWSERS, concurrency=CDP_CONCURRENCY):
+        self.on_capture = on_capture
+        self.url_for = url_for
+        self.concurrency = concurrency
+        self.metrics = StageMetrics('capture')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(browsers, concurrency), self.loop).result()
+
+    async def _start(self, browsers, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.browsers = list(await asyncio.gather(*(ChromeBrowser.launch() for _ in range(browsers))))
+        # One relaunch at a time per browser, so captures that find it dead together start one Chrome
+        self.launching = [asyncio.Lock() for _ in range(browsers)]
+        self.next_browser = itertools.cycle(range(browsers))
+
+    async def _browser(self):
+        """Pick the next browser round-robin, relaunching it if it died"""
+        index = next(self.next_browser)
+        if self.browsers[index].is_alive():
+            return self.browsers[index]
+        async with self.launching[index]:
+            # Another capture may have relaunched it while this one waited
+            if not self.browsers[index].is_alive():
+                logging.warning("Relaunching crashed Chrome")
+                dead, self.browsers[index] = self.browsers[index], await ChromeBrowser.launch()
+                await dead.close()
+            return self.browsers[index]
+
+    async def _capture(self, domain):
+        # One attempt; the caller schedules any retry
+        url = self.url_for(domain)
+        waiting = self.loop.time()
+        async with self.semaphore:
+            started = self.loop.time()
+            try:
+                logging.info(f"Processing: {url}")
+                browser = await self._browser()
+                metrics.record(domain, 'acquire', self.loop.time() - waiting)
+                png, ready = await browser.capture(url, domain)
+            except Exception:
+                self.metrics.record(self.loop.time() - started, ok=False)
+                raise
+            logging.info(f"Ready: {url} via {ready.strategy} after {ready.elapsed:.2f}s")
+            self.metrics.record(self.loop.time() - started)
+            return png
+
+    async def _process(self, domain):
+        png = await self._capture(domain)
+        # The capture slot is free again while the screenshot is post-processed
+        stored = await self.loop.run_in_executor(None, self.on_capture, domain, png)
+        return await asyncio.wrap_future(stored)
+
+    def submit(self, domain):
+        return asyncio.run_coroutine_threadsafe(self._process(domain), self.loop)
+
+    def rss_mb(self):
+        """Resident memory of the Chrome processes and their children"""
+        return sum(process_tree_rss_mb(browser.process.pid) for browser in list(self.browsers))
+
+    async def _close(self):
+        await asyncio.gather(*(browser.close() for browser in self.browsers), return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,252 @@
+import base64
+import collections
+import concurrent.futures
+import ipaddress
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import imaging
+import metrics
+import pipeline
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+# Seconds a worker may hold leased domains without a heartbeat or result before they go to another worker
+LEASE_TIMEOUT = float(os.getenv('LEASE_TIMEOUT', 120))
+# Captures handed out or waiting for a worker at once; the claim window is twice this unless MAX_IN_FLIGHT is set
+COORDINATOR_CAPACITY = int(os.getenv('COORDINATOR_CAPACITY', 128))
+# Most domains a single lease request may take
+LEASE_MAX_BATCH = int(os.getenv('LEASE_MAX_BATCH', 32))
+# Shared secret workers send as a bearer token; empty accepts any worker, and is only allowed on a loopback address
+COORDINATOR_TOKEN = os.getenv('COORDINATOR_TOKEN', '')
+# Largest request body a worker may send, an upload with every variant base64-encoded
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 32 * 1024 * 1024))
+
+HASH_PATTERN = re.compile(r'[0-9a-f]{64}')
+PHASH_PATTERN = re.compile(r'[0-9a-f]{1,256}')
+
+WORKERS = metrics.Gauge('screenshot_workers', 'Distributed workers heard from within the lease timeout')
+
+# Engine of the batch running in this process, reached through the server's /work routes
+active = None
+
+
+class RemoteCaptureError(Exception):
+    """A capture that failed on a worker, carrying the worker's error message"""
+
+
+class RemoteEngine:
+    """Capture engine whose captures run on distributed workers (worker.py).
+
+    submit() queues a domain and returns a future, like the local engines,
+    so claiming, politeness, retries and the manifest work unchanged.
+    Workers lease queued domains in batches, renew the leases with
+    heartbeats and upload each result as encoded variants, which are stored
+    here as write_variants would have stored them. A domain whose lease runs
+    out goes back to the front of the queue for the next worker, and only
+    the worker holding a live lease on a domain can settle it.
+    """
+
+    def __init__(self, image_dir, capacity=COORDINATOR_CAPACITY, lease_timeout=LEASE_TIMEOUT):
+        global active
+        self.image_dir = image_dir
+        self.concurrency = capacity
+        self.lease_timeout = lease_timeout
+        self.metrics = pipeline.StageMetrics('capture')
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.futures = {}
+        # Submission time of domains not leased yet, for the acquire stage
+        self.submitted = {}
+        # Domain -> (worker, lease expiry, leased at), all monotonic
+        self.leases = {}
+        self.workers = {}
+        self.requeued = 0
+        WORKERS.set_function(self.live_workers)
+        active = self
+        logging.info(f"Waiting for workers to lease captures (lease timeout {lease_timeout:g}s)")
+
+    def submit(self, domain):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.futures[domain] = future
+            self.submitted[domain] = time.monotonic()
+            self.queue.append(domain)
+        return future
+
+    def _expire(self, now):
+        # Called with the lock held
+        expired = [domain for domain, (_, expires, _) in self.leases.items() if expires < now]
+        for domain in expired:
+            worker = self.leases.pop(domain)[0]
+            self.queue.appendleft(domain)
+            self.requeued += 1
+            logging.warning(f"Lease on {domain} held by {worker} expired, handing it to another worker")
+
+    def lease(self, worker, size):
+        """Lease up to size queued domains to a worker"""
+        now = time.monotonic()
+        leased = []
+        with self.lock:
+            self.workers[worker] = now
+            self._expire(now)
+            while self.queue and len(leased) < min(size, LEASE_MAX_BATCH):
+                domain = self.queue.popleft()
+                # Skip domains settled by a late result after their lease was requeued
+                if domain in self.futures and domain not in self.leases:
+                    self.leases[domain] = (worker, now + self.lease_timeout, now)
+                    leased.append((domain, self.submitted.pop(domain, None)))
+        for domain, submitted in leased:
+            if submitted is not None:
+                metrics.record(domain, 'acquire', now - submitted)
+        return [domain for domain, _ in leased]
+
+    def heartbeat(self, worker, domains):
+        """Extend the leases of the domains a worker says it is still working on; returns how many.
+
+        Leases the worker holds but no longer mentions, such as one whose
+        upload failed, are left to run out and be handed to another worker.
+        Leases that have already run out are not revived.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.workers[worker] = now
+            self._expire(now)
+            held = [domain for domain in domains if self.leases.get(domain, (None,))[0] == worker]
+            for domain in held:
+                self.leases[domain] = (worker, now + self.lease_timeout, self.leases[domain][2])
+        return len(held)
+
+    def complete(self, worker, domain, result):
+        """Settle a domain with a worker's upload; False unless that worker holds a live lease on it"""
+        now = time.monotonic()
+        with self.lock:
+            self.workers[worker] = now
+            self._expire(now)
+            lease = self.leases.get(domain)
+            if lease is None or lease[0] != worker:
+                # Leased to another worker, never leased, or back in the queue after the lease ran out
+                return False
+            del self.leases[domain]
+            future = self.futures.pop(domain)
+        elapsed = now - lease[2]
+        try:
+            stored = self._store(worker, domain, result)
+        except Exception as e:
+            self.metrics.record(elapsed, ok=False)
+            future.set_exception(e)
+        else:
+            self.metrics.record(elapsed)
+            future.set_result(stored)
+        return True
+
+    def _store(self, worker, domain, result):
+        if result.get('error'):
+            raise RemoteCaptureError(str(result['error']))
+        content_hash = str(result.get('hash', ''))
+        phash = str(result.get('phash', ''))
+        if not HASH_PATTERN.fullmatch(content_hash) or not PHASH_PATTERN.fullmatch(phash):
+            raise ValueError(f"Malformed upload for {domain} from {worker}")
+        expected = {name for name, _ in imaging.VARIANTS}
+        uploaded = result.get('files') or {}
+        if set(uploaded) != expected:
+            raise ValueError(f"Upload for {domain} from {worker} has variants {sorted(uploaded)}, "
+                             f"expected {sorted(expected)}")
+        files = {name: base64.b64decode(data, validate=True) for name, data in uploaded.items()}
+        stem = imaging.screenshot_path(domain)
+        with metrics.stage(domain, 'write'):
+            imaging.store_variants(self.image_dir, stem, content_hash, files)
+        logging.info(f"Screenshot saved: {stem}{imaging.EXTENSION} from {worker}")
+        return {'hash': content_hash, 'phash': phash, 'timings': _timings(result.get('timings'))}
+
+    def live_workers(self):
+        horizon = time.monotonic() - self.lease_timeout
+        with self.lock:
+            return sum(1 for seen in self.workers.values() if seen > horizon)
+
+    def rss_mb(self):
+        # The browsers run on the workers
+        return 0
+
+    def close(self):
+        global active
+        if active is self:
+            active = None
+        with self.lock:
+            futures = list(self.futures.values())
+            self.futures.clear()
+            self.queue.clear()
+            self.leases.clear()
+        # Anything still outstanding goes back to the job store through report_progress
+        for future in futures:
+            future.cancel()
+        WORKERS.set_function(None)
+        WORKERS.set(0)
+        if self.requeued:
+            logging.info(f"Coordinator: {self.requeued} expired leases were handed to another worker")
+
+
+def _timings(timings):
+    """Post-processing step timings reported by a worker, or None if they are unusable"""
+    try:
+        return {'pid': int(timings['pid']),
+                'steps': [(str(step), float(started), float(seconds)) for step, started, seconds in timings['steps']]}
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+def output_settings():
+    """Image settings workers encode with, so every stored variant matches this coordinator's"""
+    return {'format': imaging.OUTPUT_FORMAT, 'quality': imaging.OUTPUT_QUALITY,
+            'variants': [list(variant) for variant in imaging.VARIANTS]}
+
+
+def authorized(header):
+    return not COORDINATOR_TOKEN or header == f'Bearer {COORDINATOR_TOKEN}'
+
+
+def is_loopback(host):
+    """Whether a server bound to host only accepts connections from this machine"""
+    if not host:
+        # Every interface
+        return False
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+
+def check_exposure(host):
+    """Refuse to coordinate workers on a reachable address without COORDINATOR_TOKEN"""
+    if not COORDINATOR_TOKEN and not is_loopback(host):
+        raise ValueError(f"Set COORDINATOR_TOKEN before serving workers on {host or 'every interface'}: "
+                         f"without it anyone who can reach the port can upload screenshots")
+
+
+def handle(path, request):
+    """Answer a worker's request to /work/lease, /work/heartbeat or /work/result.
+
+    Returns (HTTP status, response body). With no batch running, leases come
+    back empty and workers keep polling.
+    """
+    worker = str(request.get('worker') or '')
+    if not worker:
+        return 400, {'error': 'worker name missing'}
+    engine = active
+    if path == '/work/lease':
+        domains = engine.lease(worker, int(request.get('size', 1))) if engine is not None else []
+        return 200, {'domains': domains, 'lease_seconds': LEASE_TIMEOUT, 'output': output_settings()}
+    if path == '/work/heartbeat':
+        return 200, {'renewed': engine.heartbeat(worker, request.get('domains', [])) if engine is not None else 0}
+    if path == '/work/result':
+        domain = str(request.get('domain') or '')
+        accepted = engine is not None and engine.complete(worker, domain, request)
+        return 200, {'accepted': accepted}
+    return 404, {'error': 'unknown request'}
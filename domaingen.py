@@ -1,4 +1,7 @@
+import heapq
+import json
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,43 +11,150 @@ load_dotenv()
 SOURCE_FILE = os.getenv('SOURCE_FILE', 'source.txt')
 TARGET_FILE = os.getenv('TARGET_FILE', 'target.txt')
 EXTENSIONS_FILE = os.getenv('EXTENSIONS_FILE', 'extensions.txt')
+# Names and extensions already expanded into TARGET_FILE, for incremental runs
+DOMAINGEN_STATE_FILE = os.getenv('DOMAINGEN_STATE_FILE', f"{TARGET_FILE}.state.json")
+DOMAINGEN_INCREMENTAL = os.getenv('DOMAINGEN_INCREMENTAL', 'false').lower() == 'true'
 
-def generate_domains():
+def read_lines(path):
+    """Stripped, non-empty, de-duplicated lines in file order"""
+    with open(path, 'r') as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+def prefixes(names):
+    # Both www and non-www versions
+    for name in names:
+        yield name
+        yield f"www.{name}"
+
+def with_extensions(prefix, extensions):
+    for ext in extensions:
+        yield f"{prefix}{ext}"
+
+def prefix_groups(sorted_prefixes):
+    """Split sorted prefixes into runs that start with the run's first prefix.
+
+    Domains from different runs never interleave in sorted order, so only the
+    prefixes inside a run (like "shop" and "shop-online") need merging.
+    """
+    group = []
+    for prefix in sorted_prefixes:
+        if group and not prefix.startswith(group[0]):
+            yield group
+            group = []
+        group.append(prefix)
+    if group:
+        yield group
+
+def iter_domains(names, extensions):
+    """Every name x extension x {bare, www} domain in sorted order, without building the product.
+
+    Each prefix's domains are already sorted once the extensions are, so a
+    k-way merge of one stream per prefix yields the list in order while
+    holding only one pending domain per prefix of the current group.
+    """
+    extensions = sorted(extensions)
+    previous = None
+    for group in prefix_groups(sorted(prefixes(names))):
+        streams = [with_extensions(prefix, extensions) for prefix in group]
+        for domain in heapq.merge(*streams) if len(streams) > 1 else streams[0]:
+            # Different name/extension splits can spell the same domain
+            if domain != previous:
+                yield domain
+                previous = domain
+
+def write_domains(path, domains):
+    """Stream domains into path through a temporary file and rename it into place"""
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w', buffering=1024 * 1024) as f:
+            for domain in domains:
+                f.write(f"{domain}\n")
+                count += 1
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return count
+
+def load_state():
+    try:
+        with open(DOMAINGEN_STATE_FILE, 'r') as f:
+            state = json.load(f)
+        return state['names'], state['extensions']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_state(names, extensions):
+    with open(DOMAINGEN_STATE_FILE, 'w') as f:
+        json.dump({'names': names, 'extensions': extensions}, f)
+
+def reset_state():
+    """Forget what has been expanded so the next run rewrites TARGET_FILE in full"""
+    try:
+        os.remove(DOMAINGEN_STATE_FILE)
+    except FileNotFoundError:
+        pass
+
+def append_domains(domains):
+    """Append the domains not already in TARGET_FILE; returns how many were added"""
+    pending = set(domains)
+    if os.path.exists(TARGET_FILE):
+        # One streaming pass; only the new combinations are held in memory
+        with open(TARGET_FILE, 'r') as f:
+            for line in f:
+                pending.discard(line.strip())
+    with open(TARGET_FILE, 'a') as f:
+        for domain in sorted(pending):
+            f.write(f"{domain}\n")
+    return len(pending)
+
+def generate_domains(incremental=DOMAINGEN_INCREMENTAL):
+    """Write every domain combination to TARGET_FILE and return how many were written.
+
+    With incremental, only combinations involving names or extensions added
+    since the last run are appended. Removing any name or extension falls
+    back to a full, sorted rewrite.
+    """
     # Read base names
     try:
-        with open(SOURCE_FILE, 'r') as f:
-            names = [line.strip() for line in f if line.strip()]
+        names = read_lines(SOURCE_FILE)
     except FileNotFoundError:
         print(f"Error: {SOURCE_FILE} not found")
-        return
-    
+        return None
+
     # Read extensions
     try:
-        with open(EXTENSIONS_FILE, 'r') as f:
-            extensions = [line.strip() for line in f if line.strip()]
+        extensions = read_lines(EXTENSIONS_FILE)
     except FileNotFoundError:
         print(f"Error: {EXTENSIONS_FILE} not found")
-        return
-    
-    # Generate domain combinations
-    domains = []
-    for name in names:
-        for ext in extensions:
-            # Add both www and non-www versions
-            domains.append(f"{name}{ext}")
-            domains.append(f"www.{name}{ext}")
-    
-    # Sort domains alphabetically
-    domains.sort()
-    
-    # Write to target file
+        return None
+
+    state = load_state() if incremental and os.path.exists(TARGET_FILE) else None
     try:
-        with open(TARGET_FILE, 'w') as f:
-            for domain in domains:
-                f.write(f"{domain}\n")
-        print(f"Generated {len(domains)} domains")
+        if state is not None and set(state[0]) <= set(names) and set(state[1]) <= set(extensions):
+            old_names, old_extensions = set(state[0]), set(state[1])
+            new_names = [name for name in names if name not in old_names]
+            new_extensions = [ext for ext in extensions if ext not in old_extensions]
+            # New names with every extension, then the old names with only the new extensions
+            added = append_domains(list(iter_domains(new_names, extensions)) +
+                                   list(iter_domains(state[0], new_extensions)))
+            print(f"Appended {added} new domains")
+            count = added
+        else:
+            count = write_domains(TARGET_FILE, iter_domains(names, extensions))
+            print(f"Generated {count} domains")
     except Exception as e:
         print(f"Error writing to {TARGET_FILE}: {str(e)}")
+        return None
+
+    save_state(names, extensions)
+    return count
 
 if __name__ == "__main__":
     generate_domains()
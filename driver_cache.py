@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+CHROMEDRIVER_PATH = os.getenv('CHROMEDRIVER_PATH', '')
+DRIVER_OFFLINE = os.getenv('DRIVER_OFFLINE', 'false').lower() == 'true'
+DRIVER_CACHE_FILE = os.getenv('DRIVER_CACHE_FILE', '.chromedriver.json')
+DRIVER_CACHE_TTL = int(os.getenv('DRIVER_CACHE_TTL', 7 * 24 * 3600))
+
+# Resolved once per process and shared by every browser launch
+_resolved = None
+_lock = threading.Lock()
+
+
+def _is_executable(path):
+    return bool(path) and os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def _driver_version(path):
+    """Ask the binary for its version, e.g. 'ChromeDriver 120.0.6099.109 (...)'"""
+    try:
+        result = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=10)
+        parts = result.stdout.split()
+        return parts[1] if len(parts) > 1 else ''
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def _read_cache():
+    try:
+        with open(DRIVER_CACHE_FILE, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not _is_executable(entry.get('path')):
+        return None
+    if DRIVER_CACHE_TTL and not DRIVER_OFFLINE:
+        if time.time() - entry.get('resolved_at', 0) > DRIVER_CACHE_TTL:
+            return None
+    return entry
+
+
+def _write_cache(entry):
+    temp_path = f"{DRIVER_CACHE_FILE}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, DRIVER_CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Could not write driver cache {DRIVER_CACHE_FILE}: {str(e)}")
+
+
+def _download():
+    # Imported lazily so offline and pinned setups never touch webdriver-manager
+    from webdriver_manager.chrome import ChromeDriverManager
+    return ChromeDriverManager().install()
+
+
+def _resolve():
+    if CHROMEDRIVER_PATH:
+        if not _is_executable(CHROMEDRIVER_PATH):
+            raise RuntimeError(f"CHROMEDRIVER_PATH is not an executable file: {CHROMEDRIVER_PATH}")
+        return {'path': CHROMEDRIVER_PATH, 'version': _driver_version(CHROMEDRIVER_PATH), 'source': 'pinned'}
+
+    entry = _read_cache()
+    if entry:
+        entry['source'] = 'cache'
+        return entry
+
+    if DRIVER_OFFLINE:
+        path = shutil.which('chromedriver')
+        if not path:
+            raise RuntimeError("DRIVER_OFFLINE is set but no cached or installed chromedriver was found")
+        source = 'path'
+    else:
+        path = _download()
+        source = 'download'
+
+    entry = {'path': path, 'version': _driver_version(path), 'resolved_at': time.time()}
+    _write_cache(entry)
+    return dict(entry, source=source)
+
+
+def resolve_chromedriver():
+    """Return the chromedriver path, resolving it at most once per process"""
+    global _resolved
+    with _lock:
+        if _resolved is None:
+            entry = _resolve()
+            logging.info(f"Using chromedriver {entry['version'] or '(unknown version)'} "
+                         f"from {entry['source']}: {entry['path']}")
+            _resolved = entry['path']
+        return _resolved
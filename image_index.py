@@ -0,0 +1,268 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+import imaging
+from ingest import split_target
+from lookalike import BKTree, LOOKALIKE_DISTANCE
+from manifest import Manifest, MANIFEST_FILE
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+IMAGE_DIR = os.getenv('IMAGE_DIR', 'img')
+IMAGE_INDEX_HISTORY = int(os.getenv('IMAGE_INDEX_HISTORY', 10000))
+
+# Fields the catalog can be sorted by
+SORT_FIELDS = ('domain', 'tld', 'captured_at', 'size', 'status')
+
+
+def _version(mtime_ns):
+    return format(mtime_ns, 'x')
+
+
+def version_tag(stat):
+    """Short token that changes whenever a file is rewritten"""
+    return _version(stat.st_mtime_ns)
+
+
+class ImageIndex:
+    """In-memory catalog of stored screenshots with a numbered change log.
+
+    Entries come from the manifest, which records where each domain's
+    screenshot is stored and the size and modification time of its files,
+    so keeping up only means reading the lines appended since the last
+    scan; the image directory is never listed. Each entry has the domain,
+    TLD, www variant, capture time, bytes on disk, last capture status and
+    look-alike group. Screenshots within LOOKALIKE_DISTANCE bits of a group's first
+    member's perceptual hash join its group. Every add,
+    update or removal bumps the cursor and is remembered in a bounded log, so
+    clients holding an earlier cursor can be sent only what changed since. A
+    cursor older than the log means the client must reload the full list.
+    """
+
+    def __init__(self, image_dir=IMAGE_DIR, history=IMAGE_INDEX_HISTORY, manifest_path=MANIFEST_FILE,
+                 lookalike_distance=LOOKALIKE_DISTANCE):
+        self.image_dir = image_dir
+        self.manifest = Manifest(manifest_path)
+        # Domain whose capture each screenshot name shows; http:// targets share the bare domain's
+        self.domains = {}
+        self.loaded = False
+        self.images = {}
+        # Tells cursors handed out by an earlier server process apart from ours
+        self.epoch = format(int(time.time() * 1000), 'x')
+        self.cursor = 0
+        self.log = deque(maxlen=history)
+        self.condition = threading.Condition()
+        # Sorted orders and TLD counts, rebuilt lazily once the cursor moves
+        self.orders = {}
+        self.tld_counts = None
+        self.group_list = None
+        self.derived_at = 0
+        # Perceptual hash of each group's first member, and the group each image was put in
+        self.lookalikes = BKTree()
+        self.lookalike_distance = lookalike_distance
+        self.group_of = {}
+
+    def token(self, cursor):
+        return f"{self.epoch}.{cursor}"
+
+    def parse_token(self, token):
+        """Cursor from a client token, or None if it belongs to another index"""
+        epoch, _, cursor = (token or '').partition('.')
+        return int(cursor) if epoch == self.epoch and cursor.isdigit() else None
+
+    def _group(self, name, phash):
+        """Look-alike group of an image: the first group within reach of its hash, or a new one"""
+        if not phash:
+            # Captured before perceptual hashes: a group of its own
+            return name
+        known = self.group_of.get(name)
+        if known is not None and known[0] == phash:
+            return known[1]
+        key = int(phash, 16)
+        match = self.lookalikes.nearest(key, self.lookalike_distance)
+        if match is not None:
+            group = match[2]
+        else:
+            group = phash[:16]
+            self.lookalikes.add(key, group)
+        self.group_of[name] = (phash, group)
+        return group
+
+    def _describe(self, domain, entry):
+        """Catalog entry for a domain's manifest entry, or None when it has no stored screenshot"""
+        path = entry.get('path') or imaging.screenshot_path(domain)
+        if 'files' in entry:
+            files = entry['files'] or {}
+        else:
+            # Recorded before the manifest kept track of the files
+            files = imaging.stat_variants(self.image_dir, path)
+        variants = [
+            # Versioned by modification time: a re-capture gets a new URL, so the old one can be cached forever
+            {'url': f"{self.image_dir}/{variant}/{path}{imaging.EXTENSION}?v={_version(files[variant][1])}",
+             'width': width or imaging.SCREENSHOT_WIDTH}
+            for variant, width in imaging.VARIANTS if variant in files]
+        if not variants:
+            return None
+        name = imaging.screenshot_name(domain)
+        host = split_target(domain)[1]
+        updated = max(mtime_ns for _, mtime_ns in files.values()) // 1_000_000_000
+        return {'name': name,
+                'variants': variants,
+                'updated': updated,
+                'size': sum(size for size, _ in files.values()),
+                'domain': domain,
+                'tld': host.rsplit('.', 1)[-1],
+                'www': host.startswith('www.'),
+                'captured_at': entry.get('captured_at', updated),
+                'status': entry.get('status', 'success'),
+                'group': self._group(name, entry.get('phash'))}
+
+    def _update(self, domain):
+        # Called with the condition held
+        name = imaging.screenshot_name(domain)
+        entry = self.manifest.entries.get(domain)
+        image = self._describe(domain, entry) if entry is not None else None
+        if image is None:
+            # Only the domain the screenshot was last taken for can take it away
+            if self.domains.get(name, domain) == domain:
+                self.domains.pop(name, None)
+                self._change(name, None)
+            return
+        self.domains[name] = domain
+        self._change(name, image)
+
+    def _change(self, name, image):
+        # Called with the condition held; image None means removed
+        if image is None:
+            if self.images.pop(name, None) is None:
+                return
+            self.group_of.pop(name, None)
+        else:
+            if self.images.get(name) == image:
+                return
+            self.images[name] = image
+        self.cursor += 1
+        self.log.append((self.cursor, name))
+        self.condition.notify_all()
+
+    def scan(self):
+        """Catch up with the manifest, picking up captures stored by this or any other process"""
+        with self.condition:
+            try:
+                changed = self.manifest.refresh()
+            except OSError as e:
+                logging.warning(f"Could not read {self.manifest.path}: {str(e)}")
+                return
+            if not self.loaded:
+                # Entries read when the manifest was opened
+                changed.update(self.manifest.entries)
+                self.loaded = True
+            for domain in sorted(changed):
+                self._update(domain)
+
+    def clear(self):
+        """Forget every screenshot once the image directory has been emptied"""
+        with self.condition:
+            self.manifest.clear()
+            self.domains = {}
+            for name in list(self.images):
+                self._change(name, None)
+            self.lookalikes = BKTree()
+
+    def snapshot(self):
+        """(cursor, every image sorted by name)"""
+        with self.condition:
+            return self.cursor, [self.images[name] for name in sorted(self.images)]
+
+    def changes_since(self, cursor):
+        """(cursor, changed images, removed names), or None when cursor is too old to catch up from"""
+        with self.condition:
+            if cursor is None or cursor > self.cursor:
+                return None
+            if cursor < self.cursor and (not self.log or self.log[0][0] > cursor + 1):
+                return None
+            names = {name for seq, name in self.log if seq > cursor}
+            changed = [self.images[name] for name in sorted(names) if name in self.images]
+            removed = sorted(name for name in names if name not in self.images)
+            return self.cursor, changed, removed
+
+    def _derive(self):
+        # Called with the condition held
+        if self.derived_at != self.cursor:
+            self.orders = {}
+            self.tld_counts = None
+            self.group_list = None
+            self.derived_at = self.cursor
+
+    def _order(self, field):
+        """Image names sorted by field, ties broken by domain"""
+        self._derive()
+        if field not in self.orders:
+            self.orders[field] = sorted(
+                self.images, key=lambda name: (self.images[name][field], self.images[name]['domain']))
+        return self.orders[field]
+
+    def tlds(self):
+        """Number of images per TLD"""
+        with self.condition:
+            self._derive()
+            if self.tld_counts is None:
+                self.tld_counts = Counter(image['tld'] for image in self.images.values())
+            return dict(self.tld_counts)
+
+    def _matches(self, names, q, tld, group=''):
+        q = q.lower()
+        if not (q or tld or group):
+            return names if isinstance(names, list) else list(names)
+        return [name for name in names
+                if (not tld or self.images[name]['tld'] == tld)
+                and (not group or self.images[name]['group'] == group)
+                and (not q or q in self.images[name]['domain'])]
+
+    def query(self, offset=0, limit=100, q='', tld='', sort='domain', group=''):
+        """(cursor, total matches, one page of matches) for a search.
+
+        q matches anywhere in the domain, tld and group filter exactly, and
+        sort is a field from SORT_FIELDS, prefixed with '-' for descending order.
+        """
+        field = sort.lstrip('-')
+        if field not in SORT_FIELDS:
+            raise ValueError(f"Cannot sort by {sort}")
+        with self.condition:
+            names = self._order(field)
+            if sort.startswith('-'):
+                names = reversed(names)
+            matches = self._matches(names, q, tld, group)
+            page = [self.images[name] for name in matches[offset:offset + limit]]
+            return self.cursor, len(matches), page
+
+    def groups(self, offset=0, limit=100, q='', tld=''):
+        """(cursor, total groups, one page of groups) among the images matching a search.
+
+        Each group is {'id', 'count', 'cover'}, the cover being its first
+        member by domain. Largest groups come first.
+        """
+        with self.condition:
+            if not (q or tld) and self.group_list is not None and self.derived_at == self.cursor:
+                listing = self.group_list
+            else:
+                members = {}
+                for name in self._matches(self._order('domain'), q, tld):
+                    members.setdefault(self.images[name]['group'], []).append(name)
+                listing = sorted(members.items(), key=lambda item: (-len(item[1]), item[1][0]))
+                if not (q or tld):
+                    self.group_list = listing
+            page = [{'id': group, 'count': len(names), 'cover': self.images[names[0]]}
+                    for group, names in listing[offset:offset + limit]]
+            return self.cursor, len(listing), page
+
+    def wait_for_change(self, cursor, timeout):
+        """Block until the index moves past cursor or timeout passes; returns the current cursor"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.cursor != cursor, timeout)
+            return self.cursor
@@ -0,0 +1,361 @@
+import hashlib
+import io
+import os
+import secrets
+import shutil
+import tempfile
+import time
+from urllib.parse import unquote
+from PIL import Image, ImageChops
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+SCREENSHOT_WIDTH = int(os.getenv('SCREENSHOT_WIDTH', 1920))
+SCREENSHOT_HEIGHT = int(os.getenv('SCREENSHOT_HEIGHT', 1080))
+SCREENSHOT_RESIZE_WIDTH = int(os.getenv('SCREENSHOT_RESIZE_WIDTH', 500))
+BROWSER_SCALING = os.getenv('BROWSER_SCALING', 'true').lower() == 'true'
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'webp').lower()
+OUTPUT_QUALITY = int(os.getenv('OUTPUT_QUALITY', 80))
+OUTPUT_VARIANTS = os.getenv('OUTPUT_VARIANTS', f'thumb:250,preview:{SCREENSHOT_RESIZE_WIDTH}')
+# Store each distinct capture once under objects/ and hard-link it from every domain that has it
+CONTENT_STORE = os.getenv('CONTENT_STORE', 'true').lower() == 'true'
+# Side of the perceptual hash grid; the hash has PHASH_SIZE² bits
+PHASH_SIZE = int(os.getenv('PHASH_SIZE', 16))
+
+# Directory inside the image directory holding content-addressed captures
+OBJECT_DIR = 'objects'
+
+# Characters kept as they are in screenshot names; every other byte is written as _xx
+NAME_CHARACTERS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789.-')
+
+# Pillow format name and file extension for each output format
+FORMATS = {
+    'png': ('PNG', '.png'),
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+    'avif': ('AVIF', '.avif'),
+}
+
+
+def parse_variants(spec):
+    """Parse 'name:width,...' into (name, width) pairs, smallest first; width 0 keeps full size"""
+    variants = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, width = item.strip().partition(':')
+        variants.append((name.strip(), int(width or 0)))
+    if not variants:
+        raise ValueError("OUTPUT_VARIANTS must name at least one variant")
+    return sorted(variants, key=lambda variant: variant[1] or float('inf'))
+
+
+if OUTPUT_FORMAT not in FORMATS:
+    raise ValueError(f"Unknown OUTPUT_FORMAT: {OUTPUT_FORMAT}")
+VARIANTS = parse_variants(OUTPUT_VARIANTS)
+EXTENSION = FORMATS[OUTPUT_FORMAT][1]
+
+
+def capture_width():
+    """Width the browser has to render at to satisfy the largest variant"""
+    largest = VARIANTS[-1][1]
+    return min(largest, SCREENSHOT_WIDTH) if largest else SCREENSHOT_WIDTH
+
+
+def capture_params():
+    """Parameters for CDP Page.captureScreenshot.
+
+    With BROWSER_SCALING the clip asks Chrome to render the viewport straight
+    at the largest variant's width, so the biggest output needs no resizing.
+    """
+    params = {'format': 'png'}
+    if BROWSER_SCALING and capture_width() < SCREENSHOT_WIDTH:
+        params['clip'] = {
+            'x': 0,
+            'y': 0,
+            'width': SCREENSHOT_WIDTH,
+            'height': SCREENSHOT_HEIGHT,
+            'scale': capture_width() / SCREENSHOT_WIDTH,
+        }
+    return params
+
+
+def screenshot_name(domain):
+    """Reversible file name of the stored screenshots for a domain.
+
+    Lowercase letters, digits, dots and hyphens are kept; any other byte,
+    '_' included, becomes _xx in hex, so no two targets share a name. https
+    is the default scheme and is left out; an explicit http:// target keeps
+    its scheme, escaped, so it never overwrites the https capture.
+    """
+    host = domain[len('https://'):] if domain.startswith('https://') else domain
+    return ''.join(c if c in NAME_CHARACTERS and not (i == 0 and c == '.')
+                   else ''.join(f'_{byte:02x}' for byte in c.encode())
+                   for i, c in enumerate(host))
+
+
+def domain_from_name(name):
+    """Target a screenshot name was made from"""
+    # '%' itself is always escaped in names, so every '%' here starts an escape
+    return unquote(name.replace('_', '%'), errors='strict')
+
+
+def screenshot_path(domain):
+    """Location of a domain's screenshots inside each variant directory, without extension.
+
+    Names are spread over 256 subdirectories by a hash prefix, so no
+    directory grows past a few thousand entries in a large collection.
+    """
+    name = screenshot_name(domain)
+    return f"{hashlib.sha256(name.encode()).hexdigest()[:2]}/{name}"
+
+
+def is_variant_file(relative_path):
+    """Whether a path inside the image directory is a screenshot variant laid out by variant_path.
+
+    Everything else there, such as the content store and temporaries, is
+    not meant to be served.
+    """
+    parts = relative_path.split(os.sep)
+    if len(parts) != 3:
+        return False
+    variant, shard, filename = parts
+    name = filename[:-len(EXTENSION)]
+    return (variant in dict(VARIANTS) and filename.endswith(EXTENSION) and bool(name) and not name.startswith('.')
+            and shard == hashlib.sha256(name.encode()).hexdigest()[:2])
+
+
+def variant_path(image_dir, variant, stem):
+    return os.path.join(image_dir, variant, f"{stem}{EXTENSION}")
+
+
+def stat_variants(image_dir, stem):
+    """{variant: [bytes, mtime_ns]} of the files stored for a screenshot, leaving out missing ones"""
+    files = {}
+    for name, _ in VARIANTS:
+        try:
+            stat = os.stat(variant_path(image_dir, name, stem))
+        except OSError:
+            continue
+        files[name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def encoding_tag(width, output_format=OUTPUT_FORMAT, quality=OUTPUT_QUALITY):
+    """Short digest of the settings a variant is encoded with"""
+    return hashlib.sha256(f"{output_format}:{quality}:{width}".encode()).hexdigest()[:8]
+
+
+def object_path(image_dir, variant, object_id, width=None):
+    """Content-addressed location of one variant of a stored capture.
+
+    The key is the capture's hash plus the variant's encoding settings, so
+    changing OUTPUT_FORMAT, OUTPUT_QUALITY or a variant's width never reuses
+    an object encoded the old way. width defaults to the configured one.
+    """
+    if width is None:
+        width = dict(VARIANTS).get(variant, 0)
+    return os.path.join(image_dir, OBJECT_DIR, variant, object_id[:2],
+                        f"{object_id}-{encoding_tag(width)}{EXTENSION}")
+
+
+def pixel_difference(path_a, path_b, threshold=16):
+    """Share of pixels where two images differ by more than threshold in any channel.
+
+    Images of different sizes count as entirely different.
+    """
+    with Image.open(path_a) as a, Image.open(path_b) as b:
+        if a.size != b.size:
+            return 1.0
+        bands = ImageChops.difference(a.convert('RGB'), b.convert('RGB')).split()
+    peak = ImageChops.lighter(ImageChops.lighter(bands[0], bands[1]), bands[2])
+    changed = sum(peak.histogram()[threshold + 1:])
+    return changed / (peak.width * peak.height)
+
+
+def link_file(source, path):
+    """Make path another name for source, replacing whatever path was.
+
+    Falls back to a copy on filesystems without hard links.
+    """
+    temp_path = os.path.join(os.path.dirname(path) or '.', f".{secrets.token_hex(8)}.tmp")
+    try:
+        os.link(source, temp_path)
+    except OSError as e:
+        if isinstance(e, FileNotFoundError):
+            raise
+        shutil.copyfile(source, temp_path)
+    try:
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def prune_objects(image_dir, referenced):
+    """Delete stored captures no domain links to any more; returns how many files went.
+
+    referenced holds the hashes the manifest still records. Their objects
+    are always kept: where link_file had to fall back to copies, every
+    object has a single link whether it is used or not.
+    """
+    removed = 0
+    for root, _, files in os.walk(os.path.join(image_dir, OBJECT_DIR)):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.split('-', 1)[0] in referenced:
+                continue
+            try:
+                # One link left means only the object itself
+                if os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                continue
+    return removed
+
+
+def perceptual_hash(img, size=PHASH_SIZE):
+    """Difference hash as hex: one bit per horizontally adjacent pixel pair of a small grayscale copy.
+
+    Re-renders of the same page, or pages differing only in small text such
+    as a parked domain's name, land within a few bits of each other.
+    """
+    small = img.convert('L').resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            bits = bits << 1 | (pixels[offset + col] > pixels[offset + col + 1])
+    return format(bits, f"0{-(-size * size // 4)}x")
+
+
+def scale_to_width(img, width):
+    """Resize keeping the aspect ratio; images already at or below width are returned as is"""
+    if not width or img.size[0] <= width:
+        return img
+    width_percent = (width / float(img.size[0]))
+    new_height = int((float(img.size[1]) * float(width_percent)))
+    return img.resize((width, new_height), Image.Resampling.LANCZOS)
+
+
+def encode(img, output_format=OUTPUT_FORMAT, quality=OUTPUT_QUALITY):
+    """Encode an image in the configured output format"""
+    if output_format == 'avif':
+        try:
+            # Registers the AVIF codec with Pillow
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            raise RuntimeError("AVIF output needs the pillow-avif-plugin package")
+
+    pil_format = FORMATS[output_format][0]
+    if pil_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    output = io.BytesIO()
+    if pil_format == 'PNG':
+        img.save(output, format=pil_format, optimize=True)
+    else:
+        img.save(output, format=pil_format, quality=quality)
+    return output.getvalue()
+
+
+def atomic_write(path, data):
+    """Write data next to path and rename it into place so readers never see partial files"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _decode(png):
+    img = Image.open(io.BytesIO(png))
+    img.load()
+    return img
+
+
+class _Steps:
+    """Durations of the post-processing steps of one capture, for its metrics and trace"""
+
+    def __init__(self):
+        self.steps = []
+
+    def __call__(self, step, function, *args):
+        started, clock = time.time(), time.perf_counter()
+        result = function(*args)
+        self.steps.append((step, started, time.perf_counter() - clock))
+        return result
+
+    def report(self):
+        return {'pid': os.getpid(), 'steps': self.steps}
+
+
+def write_variants(image_dir, stem, png, variants=VARIANTS, content_store=CONTENT_STORE):
+    """Decode a screenshot once, store every size variant and return its hash and perceptual hash.
+
+    With content_store each variant is written once under objects/, named by
+    the capture's hash, and the domain's files are hard links to it, so
+    identical captures take the space of one. Module-level so the
+    post-processing process pool can run it. The result also carries the
+    time each step took, for the capture's metrics and trace.
+    """
+    timed = _Steps()
+    content_hash = hashlib.sha256(png).hexdigest()
+    with timed('decode', _decode, png) as img:
+        for name, width in variants:
+            path = variant_path(image_dir, name, stem)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not content_store:
+                data = timed('encode', encode, timed('resize', scale_to_width, img, width))
+                timed('write', atomic_write, path, data)
+                continue
+            source = object_path(image_dir, name, content_hash, width)
+            if not os.path.exists(source):
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                data = timed('encode', encode, timed('resize', scale_to_width, img, width))
+                timed('write', atomic_write, source, data)
+            timed('write', link_file, source, path)
+        phash = timed('phash', perceptual_hash, img)
+        return {'hash': content_hash, 'phash': phash, 'timings': timed.report()}
+
+
+def encode_variants(png, variants=VARIANTS, output_format=OUTPUT_FORMAT, quality=OUTPUT_QUALITY):
+    """Decode a screenshot once and encode every size variant in memory.
+
+    Returns what write_variants does plus the encoded bytes by variant name
+    under 'files', for a distributed worker to upload to the coordinator.
+    """
+    timed = _Steps()
+    with timed('decode', _decode, png) as img:
+        files = {name: timed('encode', encode, timed('resize', scale_to_width, img, width), output_format, quality)
+                 for name, width in variants}
+        phash = timed('phash', perceptual_hash, img)
+    return {'hash': hashlib.sha256(png).hexdigest(), 'phash': phash, 'files': files,
+            'timings': timed.report()}
+
+
+def store_variants(image_dir, stem, content_hash, files, content_store=CONTENT_STORE):
+    """Put variants encoded elsewhere in place, laid out as write_variants would have"""
+    for name, data in files.items():
+        path = variant_path(image_dir, name, stem)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not content_store:
+            atomic_write(path, data)
+            continue
+        source = object_path(image_dir, name, content_hash)
+        if not os.path.exists(source):
+            os.makedirs(os.path.dirname(source), exist_ok=True)
+            atomic_write(source, data)
+        link_file(source, path)
@@ -0,0 +1,116 @@
+import ipaddress
+import logging
+import os
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+TARGET_FILE = os.getenv('TARGET_FILE', 'target.txt')
+
+
+def normalize_domain(line):
+    """Canonical form of a target line, or None when it names no usable host.
+
+    Lowercases the host, drops https:// (the default), userinfo, fragments
+    and a bare trailing '/', strips trailing dots and converts
+    internationalized names to their IDNA form. Paths and queries are kept
+    as written, so URL targets capture the page they name. An explicit
+    http:// is kept because it asks for a different URL. IPv6 hosts stay in
+    brackets.
+    """
+    text = line.strip()
+    if not text or text.startswith('#') or any(c.isspace() for c in text):
+        return None
+
+    scheme = 'https'
+    if '://' in text:
+        scheme, _, text = text.partition('://')
+        scheme = scheme.lower()
+        if scheme not in ('http', 'https'):
+            return None
+
+    text = text.split('#', 1)[0]
+    cut = min((index for index in (text.find('/'), text.find('?')) if index >= 0), default=len(text))
+    address, path = text[:cut].rpartition('@')[2], text[cut:]
+    if path == '/':
+        path = ''
+    elif path.startswith('?'):
+        path = '/' + path
+
+    if address.startswith('['):
+        host, bracket, port = address[1:].partition(']')
+        if not bracket or (port and not port.startswith(':')):
+            return None
+        port = port[1:]
+        try:
+            host = f"[{ipaddress.IPv6Address(host).compressed}]"
+        except ValueError:
+            return None
+    else:
+        host, _, port = address.partition(':')
+        host = host.rstrip('.').lower()
+        if not host:
+            return None
+        try:
+            host = host.encode('idna').decode('ascii')
+        except UnicodeError:
+            # Empty or over-long labels
+            return None
+    if port and not port.isdigit():
+        return None
+
+    target = (f"{host}:{port}" if port else host) + path
+    return f"http://{target}" if scheme == 'http' else target
+
+
+def split_target(domain):
+    """(scheme, host, port, path) of a normalized target; IPv6 hosts come without brackets"""
+    scheme = 'http' if domain.startswith('http://') else 'https'
+    address = domain.split('://', 1)[-1]
+    cut = min((index for index in (address.find('/'), address.find('?')) if index >= 0), default=len(address))
+    address, path = address[:cut], address[cut:]
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        port = port[1:]
+    else:
+        host, _, port = address.partition(':')
+    return scheme, host, port, path
+
+
+class IngestStats:
+    """Counts from one pass over the target list"""
+
+    def __init__(self):
+        self.lines = 0
+        self.invalid = 0
+        self.accepted = 0
+        # Skipped by incremental mode because their screenshot is still fresh
+        self.fresh = 0
+
+    def log_summary(self, stored):
+        """Log the counts; stored is how many distinct domains made it into the run"""
+        logging.info(f"Read {self.lines} target lines: {self.invalid} blank or invalid, "
+                     f"{self.fresh} fresh, {self.accepted - self.fresh - stored} duplicates, "
+                     f"{stored} domains queued")
+
+
+def read_targets(path=TARGET_FILE, stats=None):
+    """Lazily yield normalized domains from a target file, one line at a time.
+
+    Duplicates are left in; the job store drops them when the run is created,
+    so de-duplication costs no memory here however long the list is.
+    """
+    stats = stats if stats is not None else IngestStats()
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for number, line in enumerate(f, 1):
+            stats.lines += 1
+            domain = normalize_domain(line)
+            if domain is None:
+                stats.invalid += 1
+                if line.strip() and not line.lstrip().startswith('#'):
+                    logging.warning(f"Skipping line {number} of {path}, not a usable target: {line.strip()[:200]}")
+                continue
+            stats.accepted += 1
+            yield domain
@@ -0,0 +1,115 @@
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+JOB_HISTORY = int(os.getenv('JOB_HISTORY', 50))
+
+
+class BackgroundJob:
+    """State of one background job; waiters are woken on every update"""
+
+    def __init__(self, job_id, kind):
+        self.id = job_id
+        self.kind = kind
+        self.state = 'queued'
+        self.progress = {}
+        self.message = ''
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+        self.condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+    def update(self, **fields):
+        with self.condition:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.condition.notify_all()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'progress': self.progress,
+            'message': self.message,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def wait_for_change(self, seen_version, timeout):
+        """Block until the job moves past seen_version; returns (snapshot or None on timeout, version)"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != seen_version, timeout)
+            if self.version == seen_version:
+                return None, seen_version
+            return self.to_dict(), self.version
+
+
+class JobManager:
+    """Runs long operations off the request threads.
+
+    Jobs of the same kind run one after another on their own worker thread,
+    so two screenshot batches never overlap while a domain regeneration can
+    still run next to a batch.
+    """
+
+    def __init__(self, history=JOB_HISTORY):
+        self.history = history
+        self.jobs = OrderedDict()
+        self.executors = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start(self, kind, function, *args, **kwargs):
+        """Queue function(job, *args, **kwargs) and return the job immediately"""
+        with self.lock:
+            job = BackgroundJob(next(self.ids), kind)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest.finished:
+                    break
+                self.jobs.popitem(last=False)
+            if kind not in self.executors:
+                self.executors[kind] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'job-{kind}')
+            executor = self.executors[kind]
+
+        def run():
+            job.update(state='running', started_at=time.time())
+            try:
+                function(job, *args, **kwargs)
+            except Exception as e:
+                logging.error(f"Background job {job.id} ({kind}) failed: {str(e)}")
+                job.update(state='failed', error=str(e), finished_at=time.time())
+            else:
+                job.update(state='done', finished_at=time.time())
+
+        executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in reversed(self.jobs.values())]
@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+JOB_DB = os.getenv('JOB_DB', 'jobs.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    total INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    domain TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL,
+    duration REAL,
+    error TEXT,
+    not_before REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, domain)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (run_id, state);
+"""
+
+
+class JobStore:
+    """SQLite-backed record of screenshot runs with one row per domain per run.
+
+    Jobs move pending -> running -> success/error, or straight from pending to
+    dead when the precheck finds the domain unresolvable or unreachable. A
+    retry puts a running job back to pending with a not_before time, and it
+    cannot be claimed again until then.
+    The politeness scheduler picks among due_after() and claims with
+    claim_domain(), a write transaction that only succeeds on a pending
+    job, so a job is never handed out twice, and jobs left running by
+    a crashed process go back to pending when the run is resumed.
+    """
+
+    def __init__(self, path=JOB_DB):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets the server read status while a batch is writing
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA busy_timeout=5000')
+        self.connection.executescript(SCHEMA)
+        columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(jobs)')}
+        if 'not_before' not in columns:
+            # Stores created before deferred retries
+            self.connection.execute('ALTER TABLE jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0')
+
+    def _transaction(self, work):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(self.connection)
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return result
+
+    def create_run(self, domains):
+        """Start a new run, abandoning any unfinished earlier one"""
+        def work(db):
+            now = time.time()
+            db.execute('UPDATE runs SET finished_at = ? WHERE finished_at IS NULL', (now,))
+            run_id = db.execute('INSERT INTO runs (started_at) VALUES (?)', (now,)).lastrowid
+            db.executemany('INSERT OR IGNORE INTO jobs (run_id, domain) VALUES (?, ?)',
+                           ((run_id, domain) for domain in domains))
+            total = db.execute('SELECT COUNT(*) FROM jobs WHERE run_id = ?', (run_id,)).fetchone()[0]
+            db.execute('UPDATE runs SET total = ? WHERE id = ?', (total, run_id))
+            return run_id
+        return self._transaction(work)
+
+    def run_total(self, run_id):
+        """Number of distinct domains a run was created with"""
+        with self.lock:
+            row = self.connection.execute('SELECT total FROM runs WHERE id = ?', (run_id,)).fetchone()
+        return row['total'] if row else 0
+
+    def unfinished_run(self):
+        """Id of the latest run that never finished, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT id FROM runs WHERE finished_at IS NULL ORDER BY id DESC LIMIT 1').fetchone()
+        return row['id'] if row else None
+
+    def resume_run(self, run_id):
+        """Put jobs interrupted mid-capture back in the queue"""
+        def work(db):
+            return db.execute("UPDATE jobs SET state = 'pending' WHERE run_id = ? AND state = 'running'",
+                              (run_id,)).rowcount
+        return self._transaction(work)
+
+    def due_after(self, run_id, after='', limit=100):
+        """Pending domains that may be claimed now, in key order, starting after the given domain"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain FROM jobs WHERE run_id = ? AND state = 'pending' AND domain > ? "
+                "AND not_before <= ? ORDER BY domain LIMIT ?", (run_id, after, time.time(), limit)).fetchall()
+        return [row['domain'] for row in rows]
+
+    def claim_domain(self, run_id, domain):
+        """Move one pending job to running; False if it was claimed or finished in the meantime"""
+        def work(db):
+            return db.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, started_at = ?, "
+                "finished_at = NULL, duration = NULL, error = NULL "
+                "WHERE run_id = ? AND domain = ? AND state = 'pending'",
+                (time.time(), run_id, domain)).rowcount == 1
+        return self._transaction(work)
+
+    def pending_after(self, run_id, after='', limit=1000):
+        """Pending domains of a run in key order, starting after the given domain"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain FROM jobs WHERE run_id = ? AND state = 'pending' AND domain > ? "
+                "ORDER BY domain LIMIT ?", (run_id, after, limit)).fetchall()
+        return [row['domain'] for row in rows]
+
+    def mark_dead(self, run_id, dead):
+        """Finish pending jobs whose domain failed the precheck; dead is (domain, reason) pairs"""
+        def work(db):
+            db.executemany("UPDATE jobs SET state = 'dead', finished_at = ?, error = ? "
+                           "WHERE run_id = ? AND domain = ? AND state = 'pending'",
+                           ((time.time(), reason, run_id, domain) for domain, reason in dead))
+        if dead:
+            self._transaction(work)
+
+    def defer(self, run_id, domain, delay, error=None):
+        """Put a running job back in the queue, claimable again after delay seconds"""
+        def work(db):
+            db.execute("UPDATE jobs SET state = 'pending', not_before = ?, error = ? "
+                       "WHERE run_id = ? AND domain = ?", (time.time() + delay, error, run_id, domain))
+        self._transaction(work)
+
+    def attempts(self, run_id, domain):
+        with self.lock:
+            row = self.connection.execute('SELECT attempts FROM jobs WHERE run_id = ? AND domain = ?',
+                                          (run_id, domain)).fetchone()
+        return row['attempts'] if row else 0
+
+    def next_due(self, run_id):
+        """Earliest time a pending job of the run may be claimed, or None when none are pending"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT MIN(not_before) AS due FROM jobs WHERE run_id = ? AND state = 'pending'",
+                (run_id,)).fetchone()
+        return row['due']
+
+    def finish(self, run_id, domain, state, error=None):
+        def work(db):
+            now = time.time()
+            db.execute("UPDATE jobs SET state = ?, finished_at = ?, duration = ? - started_at, error = ? "
+                       "WHERE run_id = ? AND domain = ?", (state, now, now, error, run_id, domain))
+        self._transaction(work)
+
+    def finish_run(self, run_id):
+        def work(db):
+            db.execute('UPDATE runs SET finished_at = ? WHERE id = ?', (time.time(), run_id))
+        self._transaction(work)
+
+    def counts(self, run_id):
+        """Number of jobs in each state for a run"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT state, COUNT(*) AS n FROM jobs WHERE run_id = ? GROUP BY state', (run_id,)).fetchall()
+        return {row['state']: row['n'] for row in rows}
+
+    def latest_run(self):
+        """Summary of the most recent run, or None if nothing has run yet"""
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            return None
+        summary = dict(row)
+        summary['states'] = self.counts(row['id'])
+        return summary
+
+    def errors(self, run_id, limit=100, state='error'):
+        """Failed jobs of a run with their last error; state='dead' lists precheck casualties and the reason"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain, attempts, error FROM jobs WHERE run_id = ? AND state = ? LIMIT ?",
+                (run_id, state, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import imaging
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+IMAGE_DIR = os.getenv('IMAGE_DIR', 'img')
+# Perceptual hash bits two captures may differ by and still be stored once, if their pixels agree too;
+# -1 keeps every capture that is not byte-identical to another
+DEDUP_DISTANCE = int(os.getenv('DEDUP_DISTANCE', 4))
+# Share of pixels near-identical captures may differ in before they are stored separately after all
+DEDUP_PIXEL_SHARE = float(os.getenv('DEDUP_PIXEL_SHARE', 0.001))
+# Bits two screenshots may differ by and still be grouped as look-alikes in the viewer
+LOOKALIKE_DISTANCE = int(os.getenv('LOOKALIKE_DISTANCE', 32))
+
+
+def distance(a, b):
+    """Hamming distance between two hashes given as integers"""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Perceptual hashes indexed for near-neighbour lookups by Hamming distance.
+
+    Each node keeps its children by their distance to it, so a search within
+    a radius only descends into children whose distance could be in range.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        """Insert a hash, or replace the value stored for an identical one"""
+        if self.root is None:
+            self.root = [key, value, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            d = distance(node[0], key)
+            if d == 0:
+                node[1] = value
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def nearest(self, key, radius):
+        """(distance, key, value) of the closest hash within radius, or None"""
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = distance(node[0], key)
+            if d <= radius and (best is None or d < best[0]):
+                best = (d, node[0], node[1])
+                if d == 0:
+                    break
+            limit = best[0] if best is not None else radius
+            stack.extend(child for gap, child in node[2].items() if d - limit <= gap <= d + limit)
+        return best
+
+
+class ContentStore:
+    """Folds near-identical captures onto one stored copy.
+
+    write_variants already shares files between byte-identical captures.
+    settle() goes further: a new capture whose perceptual hash is within
+    DEDUP_DISTANCE bits of an earlier one, and whose pixels match it to
+    within DEDUP_PIXEL_SHARE, has its files relinked to the earlier copy. The hash alone is not enough: blank and single-colour
+    pages all hash alike. Copies nothing links to any more are deleted by
+    imaging.prune_objects() once the run is over.
+    """
+
+    def __init__(self, manifest, image_dir=IMAGE_DIR, radius=DEDUP_DISTANCE, pixel_share=DEDUP_PIXEL_SHARE):
+        self.image_dir = image_dir
+        self.radius = radius
+        self.pixel_share = pixel_share
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+        self.linked = 0
+        self.stored = 0
+        for entry in manifest.entries.values():
+            if entry.get('hash') and entry.get('phash'):
+                self.tree.add(int(entry['phash'], 16), entry['hash'])
+
+    def _available(self, object_id):
+        return all(os.path.exists(imaging.object_path(self.image_dir, name, object_id))
+                   for name, _ in imaging.VARIANTS)
+
+    def _looks_same(self, object_id, other_id):
+        """Whether two stored captures match pixel for pixel in their largest variant, within pixel_share"""
+        name = max(imaging.VARIANTS, key=lambda variant: variant[1])[0]
+        try:
+            share = imaging.pixel_difference(imaging.object_path(self.image_dir, name, object_id),
+                                             imaging.object_path(self.image_dir, name, other_id))
+        except OSError:
+            return False
+        return share <= self.pixel_share
+
+    def settle(self, stem, stored):
+        """Hash of the copy a new capture ends up sharing; stored is what write_variants returned"""
+        if not imaging.CONTENT_STORE or self.radius < 0:
+            return stored['hash']
+        key = int(stored['phash'], 16)
+        with self.lock:
+            match = self.tree.nearest(key, self.radius)
+            if match is not None and match[2] == stored['hash']:
+                # Byte-identical to the representative; write_variants already linked it
+                self.linked += 1
+                return stored['hash']
+            if match is not None and self._available(match[2]) and self._looks_same(stored['hash'], match[2]):
+                for name, _ in imaging.VARIANTS:
+                    imaging.link_file(imaging.object_path(self.image_dir, name, match[2]),
+                                      imaging.variant_path(self.image_dir, name, stem))
+                self.linked += 1
+                return match[2]
+            if match is not None and self._available(match[2]):
+                # Hashes alike but the pixels are not: keep it, and leave the representative as it was
+                self.stored += 1
+                return stored['hash']
+            # First of its look, or the earlier copy has been pruned: this one represents it from now on
+            self.tree.add(match[1] if match is not None else key, stored['hash'])
+            self.stored += 1
+            return stored['hash']
+
+    def log_summary(self):
+        if self.linked or self.stored:
+            logging.info(f"Content store: {self.stored} captures stored, "
+                         f"{self.linked} linked to a near-identical copy")
@@ -0,0 +1,136 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from imaging import atomic_write
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+IMAGE_DIR = os.getenv('IMAGE_DIR', 'img')
+# Kept outside IMAGE_DIR so deleting the screenshots never takes the capture history with them
+MANIFEST_FILE = os.getenv('MANIFEST_FILE', 'manifest.jsonl')
+CAPTURE_TTL = int(os.getenv('CAPTURE_TTL', 7 * 24 * 3600))
+
+
+class Manifest:
+    """Per-domain record of the last capture: time, status, content hash, perceptual hash and stored files.
+
+    Updates are appended to a JSON Lines file as they happen, so a crashed run
+    loses nothing; the latest line for a domain wins when the file is loaded.
+    compact() rewrites it with one line per domain. Appends and rewrites
+    hold an exclusive lock on a .lock file next to it, so a rewrite never
+    drops lines another run or process appends meanwhile. It doubles as the index
+    of the image directory: each entry names the screenshot's path and the
+    size and modification time of every variant, so the catalog never has
+    to list the directory.
+    """
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Inode and read offset, so refresh() can pick up lines appended by another process
+        self.position = (None, 0)
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        self.position = (None, 0)
+        self.refresh()
+
+    def refresh(self):
+        """Apply lines appended since the last read; re-read everything if the file was replaced.
+
+        Returns the set of domains whose entry changed, including those that
+        are gone because the file was replaced or deleted.
+        """
+        changed = set()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # Deleted along with the screenshots
+            changed.update(self.entries)
+            self.entries = {}
+            self.position = (None, 0)
+            return changed
+        inode, offset = self.position
+        if stat.st_ino != inode or stat.st_size < offset:
+            # Compacted or recreated
+            changed.update(self.entries)
+            self.entries = {}
+            offset = 0
+        if stat.st_size == offset:
+            self.position = (stat.st_ino, offset)
+            return changed
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written; read it again next time
+                    break
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['domain']] = entry
+                    changed.add(entry['domain'])
+                except (ValueError, KeyError):
+                    # A torn line from an interrupted run
+                    continue
+        self.position = (stat.st_ino, offset)
+        return changed
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the manifest against other threads and, through its lock file, other processes"""
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(f'{self.path}.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def record(self, domain, status, content_hash=None, phash=None, path=None, files=None, captured_at=None):
+        """Append a domain's latest capture; path and files are what imaging.stat_variants found stored"""
+        entry = {'domain': domain, 'status': status,
+                 'captured_at': captured_at if captured_at is not None else time.time(),
+                 'hash': content_hash, 'phash': phash, 'path': path, 'files': files}
+        if status != 'success' and domain in self.entries:
+            # Keep pointing at the last good capture when a re-capture fails
+            for key in ('hash', 'phash', 'path', 'files'):
+                if entry[key] is None:
+                    entry[key] = self.entries[domain].get(key)
+        with self._locked():
+            self.entries[domain] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def needs_capture(self, domain, ttl=CAPTURE_TTL, now=None):
+        """True when a domain is missing, failed last time, or older than ttl"""
+        entry = self.entries.get(domain)
+        if entry is None or entry['status'] != 'success':
+            return True
+        now = now if now is not None else time.time()
+        return bool(ttl) and now - entry['captured_at'] > ttl
+
+    def clear(self):
+        """Forget every domain, once the screenshots themselves have been deleted"""
+        with self._locked():
+            self.entries = {}
+            atomic_write(self.path, b'')
+
+    def compact(self):
+        with self._locked():
+            # Take in whatever other processes appended before the rewrite
+            self.refresh()
+            data = ''.join(json.dumps(entry) + '\n' for entry in self.entries.values())
+            try:
+                atomic_write(self.path, data.encode())
+            except OSError as e:
+                logging.warning(f"Could not compact manifest {self.path}: {str(e)}")
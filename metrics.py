@@ -0,0 +1,286 @@
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+# Per-run trace in Chrome trace event format; {run} is replaced by the run id, empty disables it
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+
+# Upper bounds in seconds of the stage histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    """Base for labelled metrics rendered in the Prometheus text format"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self._header()
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from a function at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        function = self.function
+        if function is not None:
+            try:
+                self.set(function())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = self._header()
+        names = self.label_names + ('le',)
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, observed in zip(self.buckets, counts):
+                    cumulative += observed
+                    lines.append(f"{self.name}_bucket{_labels(names, key + (f'{bound:g}',))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {total:g}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+
+# Every metric, in the order they are exported
+REGISTRY = []
+
+STAGE_SECONDS = Histogram('screenshot_stage_seconds', 'Seconds spent per capture in each stage', ['stage'])
+CAPTURES = Counter('screenshot_captures_total', 'Finished captures by final status', ['status'])
+ERRORS = Counter('screenshot_errors_total', 'Failed capture attempts by error class', ['error_class'])
+RETRIES = Counter('screenshot_retries_total', 'Capture attempts deferred for a retry, by error class',
+                  ['error_class'])
+IN_FLIGHT = Gauge('screenshot_in_flight', 'Captures claimed from the job store and not yet finished')
+BROWSER_RSS = Gauge('screenshot_browser_rss_bytes', 'Resident memory of the running browsers and their children')
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class TraceWriter:
+    """Streams events to a file in Chrome's trace event format (JSON array).
+
+    The file opens with '[' and gets its closing ']' on close(); trace
+    viewers accept the unterminated array too, so a run can be inspected
+    while it is still going.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.first = True
+        self.pid = os.getpid()
+
+    def write(self, events):
+        with self.lock:
+            for event in events:
+                self.file.write(('' if self.first else ',\n') + json.dumps(event))
+                self.first = False
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.write('\n]\n')
+            self.file.close()
+
+
+class CaptureTrace:
+    """Stage timings of one capture attempt"""
+
+    def __init__(self, domain, lane):
+        self.domain = domain
+        self.lane = lane
+        self.started = time.time()
+        # (stage, wall clock start, seconds, process id)
+        self.stages = []
+
+
+# Attempts in progress by domain, and the trace lanes they occupy
+_active = {}
+_lanes = set()
+_lock = threading.Lock()
+_writer = None
+
+
+def start_trace(run_id, path=TRACE_FILE):
+    """Begin writing the per-run trace when TRACE_FILE is set; returns its path or None"""
+    global _writer
+    if not path:
+        return None
+    with _lock:
+        _writer = TraceWriter(path.replace('{run}', str(run_id)))
+        return _writer.path
+
+
+def stop_trace():
+    global _writer
+    with _lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def begin(domain):
+    """Start timing a capture attempt"""
+    with _lock:
+        # The lowest free lane, so overlapping attempts get their own row in a trace viewer
+        lane = next(index for index in range(len(_lanes) + 1) if index not in _lanes)
+        _lanes.add(lane)
+        _active[domain] = CaptureTrace(domain, lane)
+
+
+def record(domain, stage, seconds, started=None, pid=None):
+    """Account seconds to a stage of a domain's attempt; started defaults to seconds ago"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _active.get(domain)
+    if trace is not None:
+        trace.stages.append((stage, started if started is not None else time.time() - seconds, seconds, pid))
+
+
+class stage:
+    """Context manager timing a block as one stage of a domain's attempt"""
+
+    def __init__(self, domain, name):
+        self.domain = domain
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.domain, self.name, time.perf_counter() - self.clock, self.started)
+        return False
+
+
+def finish(domain, status, error_class=None, timings=None):
+    """Close a domain's attempt: count its outcome and write it to the trace.
+
+    status is 'success', 'error' or 'retry'. timings are the post-processing
+    steps as (stage, wall clock start, seconds) reported by the worker
+    process, with its pid, and are added per stage to the histograms.
+    """
+    if status == 'retry':
+        RETRIES.inc(error_class=error_class)
+    else:
+        CAPTURES.inc(status=status)
+    if error_class:
+        ERRORS.inc(error_class=error_class)
+
+    with _lock:
+        trace = _active.pop(domain, None)
+        if trace is not None:
+            _lanes.discard(trace.lane)
+        writer = _writer
+    if trace is None:
+        return
+
+    if timings:
+        totals = {}
+        for name, started, seconds in timings['steps']:
+            totals[name] = totals.get(name, 0.0) + seconds
+            trace.stages.append((name, started, seconds, timings['pid']))
+        for name, seconds in totals.items():
+            STAGE_SECONDS.observe(seconds, stage=name)
+
+    if writer is None:
+        return
+    ended = time.time()
+    args = {'domain': domain, 'status': status}
+    if error_class:
+        args['error_class'] = error_class
+    events = [{'name': domain, 'cat': 'capture', 'ph': 'X', 'pid': writer.pid, 'tid': trace.lane,
+               'ts': trace.started * 1e6, 'dur': (ended - trace.started) * 1e6, 'args': args}]
+    for name, started, seconds, pid in trace.stages:
+        events.append({'name': name, 'cat': 'stage', 'ph': 'X',
+                       'pid': pid or writer.pid, 'tid': pid or trace.lane,
+                       'ts': started * 1e6, 'dur': seconds * 1e6, 'args': {'domain': domain}})
+    writer.write(events)
@@ -0,0 +1,166 @@
+import argparse
+import logging
+import os
+import imaging
+from manifest import Manifest, MANIFEST_FILE
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+IMAGE_DIR = os.getenv('IMAGE_DIR', 'img')
+
+
+def legacy_name(domain):
+    """Screenshot name used before names were reversible and sharded.
+
+    It dropped the scheme, so http:// targets and their https:// twins
+    shared one file; Migration gives such a file to the latest capture.
+    """
+    return domain.split('://', 1)[-1].replace('.', '_').replace(':', '_')
+
+
+def _flat_files(directory, extension):
+    """Screenshots stored directly in a directory rather than in its shard subdirectories"""
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.endswith(extension) and not entry.name.startswith('.') and entry.is_file():
+                yield entry
+
+
+def needs_migration(image_dir=IMAGE_DIR):
+    """True when the image directory still has screenshots in the flat layout.
+
+    Stops at the first one, so it is cheap on both layouts: a migrated
+    variant directory holds nothing but its 256 shard directories.
+    """
+    directories = [(os.path.join(image_dir, name), imaging.EXTENSION) for name, _ in imaging.VARIANTS]
+    # Screenshots stored before size variants existed
+    directories.append((image_dir, '.png'))
+    return any(next(_flat_files(directory, extension), None) is not None
+               for directory, extension in directories)
+
+
+class Migration:
+    """Moves flat screenshots into the sharded layout and indexes them in the manifest"""
+
+    def __init__(self, image_dir=IMAGE_DIR, manifest_path=MANIFEST_FILE, dry_run=False):
+        self.image_dir = image_dir
+        self.dry_run = dry_run
+        self.manifest = Manifest(manifest_path)
+        # Legacy names are lossy: where several domains share one, the file is the latest capture's
+        self.owners = {}
+        self.ambiguous = set()
+        for domain, entry in sorted(self.manifest.entries.items(), key=lambda item: item[1].get('captured_at') or 0):
+            name = legacy_name(domain)
+            if name in self.owners:
+                self.ambiguous.add(name)
+            self.owners[name] = domain
+        self.moved = 0
+        self.converted = 0
+        self.guessed = 0
+        self.shared = 0
+        self.skipped = 0
+
+    def domain_for(self, name):
+        domain = self.owners.get(name)
+        if domain is None:
+            # Not in the manifest: the best guess is the one the gallery always showed
+            self.guessed += 1
+            return name.replace('_', '.')
+        if name in self.ambiguous:
+            self.shared += 1
+            logging.warning(f"{name} could be the screenshot of several domains, keeping it for {domain}; "
+                            f"the others are captured again by the next incremental run")
+        return domain
+
+    def index(self, domain, stem, mtime=None, stored=None):
+        """Record where a domain's screenshot now lives, keeping what the manifest knew about it"""
+        entry = self.manifest.entries.get(domain, {})
+        if stored is not None:
+            content_hash, phash = stored['hash'], stored['phash']
+        else:
+            content_hash, phash = entry.get('hash'), entry.get('phash')
+        self.manifest.record(domain, entry.get('status', 'success'), content_hash, phash, stem,
+                             imaging.stat_variants(self.image_dir, stem),
+                             captured_at=entry.get('captured_at', mtime))
+
+    def move_variants(self):
+        """Move every variant of each flat screenshot to its sharded path"""
+        found = {}
+        for variant, _ in imaging.VARIANTS:
+            for entry in _flat_files(os.path.join(self.image_dir, variant), imaging.EXTENSION):
+                found.setdefault(entry.name[:-len(imaging.EXTENSION)], []).append((variant, entry.path))
+
+        for name in sorted(found):
+            domain = self.domain_for(name)
+            stem = imaging.screenshot_path(domain)
+            mtime = max(os.stat(path).st_mtime for _, path in found[name])
+            if self.dry_run:
+                self.moved += 1
+                continue
+            for variant, path in found[name]:
+                target = imaging.variant_path(self.image_dir, variant, stem)
+                if os.path.exists(target):
+                    # Captured again since the upgrade, so the sharded copy is newer
+                    os.unlink(path)
+                    self.skipped += 1
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # A rename keeps the hard link to the content store
+                os.replace(path, target)
+            self.index(domain, stem, mtime)
+            self.moved += 1
+
+    def convert_pngs(self):
+        """Re-encode screenshots stored before size variants existed into every variant"""
+        for entry in sorted(_flat_files(self.image_dir, '.png'), key=lambda entry: entry.name):
+            domain = self.domain_for(entry.name[:-len('.png')])
+            stem = imaging.screenshot_path(domain)
+            if self.dry_run:
+                self.converted += 1
+                continue
+            if not all(os.path.exists(imaging.variant_path(self.image_dir, variant, stem))
+                       for variant, _ in imaging.VARIANTS):
+                with open(entry.path, 'rb') as f:
+                    stored = imaging.write_variants(self.image_dir, stem, f.read())
+                self.index(domain, stem, entry.stat().st_mtime, stored)
+            os.unlink(entry.path)
+            self.converted += 1
+
+    def index_rest(self):
+        """Give entries recorded before the manifest tracked files their file list, so nothing is looked up later"""
+        for domain, entry in list(self.manifest.entries.items()):
+            if 'files' not in entry and not self.dry_run:
+                self.index(domain, imaging.screenshot_path(domain))
+
+    def run(self):
+        self.move_variants()
+        self.convert_pngs()
+        self.index_rest()
+        if not self.dry_run:
+            self.manifest.compact()
+        verb = 'Would migrate' if self.dry_run else 'Migrated'
+        logging.info(f"{verb} {self.moved} screenshots and {self.converted} pre-variant PNGs "
+                     f"({self.guessed} not in the manifest, named from their file name; "
+                     f"{self.shared} shared by several domains; {self.skipped} files already re-captured)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move screenshots from the flat layout into shard directories '
+                                                 'and index them in the manifest')
+    parser.add_argument('--image-dir', default=IMAGE_DIR)
+    parser.add_argument('--manifest', default=MANIFEST_FILE)
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be moved')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    Migration(args.image_dir, args.manifest, args.dry_run).run()
+
+
+if __name__ == "__main__":
+    main()
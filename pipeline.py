@@ -0,0 +1,164 @@
+import concurrent.futures
+import logging
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', 0)) or os.cpu_count() or 1
+POSTPROCESS_QUEUE_SIZE = int(os.getenv('POSTPROCESS_QUEUE_SIZE', 0)) or POSTPROCESS_WORKERS * 2
+# Durations kept per stage for percentiles
+STAGE_SAMPLES = int(os.getenv('STAGE_SAMPLES', 10000))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of already sorted values, 0.0 when there are none"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+class StageMetrics:
+    """Thread-safe throughput counters for one pipeline stage.
+
+    Durations are kept as a uniform random sample of at most STAGE_SAMPLES,
+    so latency percentiles stay cheap on runs of any length.
+    """
+
+    def __init__(self, name, samples=STAGE_SAMPLES):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.stalled_seconds = 0.0
+        self.started = None
+        self.samples = []
+        self.sample_size = samples
+
+    def start(self):
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+
+    def record(self, seconds, ok=True):
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic() - seconds
+            self.count += 1
+            self.busy_seconds += seconds
+            if not ok:
+                self.errors += 1
+            # Reservoir sampling
+            if len(self.samples) < self.sample_size:
+                self.samples.append(seconds)
+            else:
+                slot = random.randrange(self.count)
+                if slot < self.sample_size:
+                    self.samples[slot] = seconds
+
+    def stalled(self, seconds):
+        with self.lock:
+            self.stalled_seconds += seconds
+
+    def summary(self):
+        with self.lock:
+            wall = time.monotonic() - self.started if self.started else 0.0
+            samples = sorted(self.samples)
+            return {
+                'stage': self.name,
+                'count': self.count,
+                'errors': self.errors,
+                'per_second': self.count / wall if wall else 0.0,
+                'avg_ms': self.busy_seconds / self.count * 1000 if self.count else 0.0,
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p95_ms': percentile(samples, 0.95) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'stalled_seconds': self.stalled_seconds,
+            }
+
+    def log_summary(self):
+        s = self.summary()
+        logging.info(f"Stage {s['stage']}: {s['count']} done, {s['errors']} errors, "
+                     f"{s['per_second']:.2f}/s, avg {s['avg_ms']:.0f} ms, p95 {s['p95_ms']:.0f} ms, "
+                     f"stalled {s['stalled_seconds']:.1f}s")
+
+
+def _timed_call(function, args):
+    """Run in the worker process and report how long the call took there"""
+    started = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - started
+
+
+class PostProcessStage:
+    """CPU-bound image work on a process pool behind a bounded queue.
+
+    submit() blocks once queue_size jobs are waiting or running, which pushes
+    back on the capture workers instead of letting raw screenshots pile up
+    in memory. Functions and arguments must be picklable.
+    """
+
+    def __init__(self, workers=POSTPROCESS_WORKERS, queue_size=POSTPROCESS_QUEUE_SIZE):
+        # Spawn rather than fork: the parent is full of browser and I/O threads
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.metrics = StageMetrics('postprocess')
+
+    def submit(self, function, *args):
+        wait_started = time.monotonic()
+        self.slots.acquire()
+        self.metrics.stalled(time.monotonic() - wait_started)
+        self.metrics.start()
+
+        try:
+            inner = self.executor.submit(_timed_call, function, args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future = concurrent.futures.Future()
+
+        def finish(done):
+            self.slots.release()
+            try:
+                result, seconds = done.result()
+            except Exception as e:
+                self.metrics.record(0.0, ok=False)
+                future.set_exception(e)
+            else:
+                self.metrics.record(seconds)
+                future.set_result(result)
+
+        inner.add_done_callback(finish)
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def flatten(future):
+    """Resolve to the final result when a future's result may itself be a future"""
+    outer = concurrent.futures.Future()
+
+    def copy(done):
+        try:
+            result = done.result()
+        except Exception as e:
+            outer.set_exception(e)
+            return
+        if isinstance(result, concurrent.futures.Future):
+            result.add_done_callback(copy)
+        else:
+            outer.set_result(result)
+
+    future.add_done_callback(copy)
+    return outer
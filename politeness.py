@@ -0,0 +1,180 @@
+import ipaddress
+import logging
+import os
+import threading
+import time
+from collections import Counter
+import precheck
+from ingest import split_target
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+# Concurrent captures per registrable domain and per resolved address; 0 disables the limit
+POLITENESS_PER_SITE = int(os.getenv('POLITENESS_PER_SITE', 2))
+POLITENESS_PER_IP = int(os.getenv('POLITENESS_PER_IP', 4))
+# Minimum seconds between two capture starts on the same site or address
+POLITENESS_SITE_INTERVAL = float(os.getenv('POLITENESS_SITE_INTERVAL', 1))
+POLITENESS_IP_INTERVAL = float(os.getenv('POLITENESS_IP_INTERVAL', 0))
+# Pending jobs looked at per claim before giving up until a slot frees
+POLITENESS_SCAN = int(os.getenv('POLITENESS_SCAN', 1000))
+
+# Second-level labels under which country TLDs register names (example.co.uk, example.com.au)
+SECOND_LEVEL_LABELS = {'ac', 'co', 'com', 'edu', 'gov', 'go', 'ltd', 'ne', 'net', 'or', 'org', 'plc'}
+
+PAGE_SIZE = 100
+
+
+def host_of(domain):
+    """Bare host name of a normalized target domain"""
+    return split_target(domain)[1]
+
+
+def site_of(domain):
+    """Registrable domain a target belongs to, so www and bare names share one limit.
+
+    Approximates the public suffix list: a country TLD preceded by one of
+    SECOND_LEVEL_LABELS counts as a two-label suffix.
+    """
+    host = host_of(domain)
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    labels = host.split('.')
+    keep = 3 if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS else 2
+    return '.'.join(labels[-keep:])
+
+
+class PolitenessScheduler:
+    """Hands out pending jobs so that no site or server gets more than its share of the workers.
+
+    Each claim walks the run's due jobs from where the previous claim left
+    off and takes the first one whose registrable domain and resolved address
+    are below their concurrency limits and outside their minimum interval.
+    Blocked jobs are skipped rather than waited for, so other hosts keep every
+    worker busy. Addresses come from the precheck cache; domains without a
+    cached address are limited by site only.
+    """
+
+    def __init__(self, job_store, run_id, per_site=POLITENESS_PER_SITE, per_ip=POLITENESS_PER_IP,
+                 site_interval=POLITENESS_SITE_INTERVAL, ip_interval=POLITENESS_IP_INTERVAL,
+                 scan=POLITENESS_SCAN, cache=None):
+        self.job_store = job_store
+        self.run_id = run_id
+        self.limits = {'site': (per_site, site_interval), 'ip': (per_ip, ip_interval)}
+        self.scan = max(1, scan)
+        self.lock = threading.Lock()
+        self.active = Counter()
+        self.last_start = {}
+        # Keys held by each claimed domain until it is released
+        self.held = {}
+        self.addresses = {}
+        self.cursor = ''
+        self.wake_at = None
+        self.skipped = 0
+        self.own_cache = cache is None and per_ip > 0 and precheck.PRECHECK
+        self.cache = precheck.PrecheckCache() if self.own_cache else cache
+
+    def _lookup(self, domains):
+        # Called with the lock held; bounded so a long run does not keep every address
+        if self.cache is None:
+            return
+        missing = [domain for domain in domains if domain not in self.addresses]
+        if not missing:
+            return
+        if len(self.addresses) > self.scan * 4:
+            self.addresses = {}
+        found = self.cache.addresses(missing)
+        for domain in missing:
+            self.addresses[domain] = found.get(domain)
+
+    def keys(self, domain):
+        """(kind, key) pairs a domain's capture counts against"""
+        keys = [('site', site_of(domain))]
+        address = self.addresses.get(domain)
+        if address:
+            keys.append(('ip', address))
+        return keys
+
+    def _blocked_until(self, keys, now):
+        """0 when a capture may start now, the monotonic time it may start, or None if it must wait for a release"""
+        ready = 0
+        for kind, key in keys:
+            limit, interval = self.limits[kind]
+            if limit and self.active[(kind, key)] >= limit:
+                return None
+            if interval and (kind, key) in self.last_start:
+                ready = max(ready, self.last_start[(kind, key)] + interval)
+        return ready if ready > now else 0
+
+    def _pages(self):
+        # Due jobs after the cursor, then wrapping round to the ones before it
+        remaining = self.scan
+        for start, stop in ((self.cursor, None), ('', self.cursor)):
+            after = start
+            while remaining > 0:
+                page = self.job_store.due_after(self.run_id, after, min(PAGE_SIZE, remaining))
+                if stop is not None:
+                    page = [domain for domain in page if domain <= stop]
+                if not page:
+                    break
+                remaining -= len(page)
+                yield page
+                after = page[-1]
+                if stop is not None and after >= stop:
+                    break
+
+    def claim(self):
+        """Claim the next job that may start now and return its domain, or None"""
+        with self.lock:
+            now = time.monotonic()
+            self.wake_at = None
+            for page in self._pages():
+                self._lookup(page)
+                for domain in page:
+                    keys = self.keys(domain)
+                    ready = self._blocked_until(keys, now)
+                    if ready is None or ready:
+                        self.skipped += 1
+                        if ready:
+                            self.wake_at = min(self.wake_at or ready, ready)
+                        continue
+                    if not self.job_store.claim_domain(self.run_id, domain):
+                        continue
+                    for key in keys:
+                        self.active[key] += 1
+                        self.last_start[key] = now
+                    self.held[domain] = keys
+                    self.cursor = domain
+                    self._prune(now)
+                    return domain
+            return None
+
+    def _prune(self, now):
+        # Start times older than the longest interval no longer block anything
+        if len(self.last_start) > self.scan * 4:
+            horizon = now - max(interval for _, interval in self.limits.values())
+            self.last_start = {key: started for key, started in self.last_start.items() if started > horizon}
+
+    def release(self, domain):
+        """Give back the limits held by a finished (or deferred) capture"""
+        with self.lock:
+            for key in self.held.pop(domain, ()):
+                self.active[key] -= 1
+                if not self.active[key]:
+                    del self.active[key]
+
+    def ready_in(self):
+        """Seconds until a job skipped by the last claim for its interval may start, or None"""
+        with self.lock:
+            return max(0.0, self.wake_at - time.monotonic()) if self.wake_at else None
+
+    def close(self):
+        if self.skipped:
+            logging.info(f"Politeness: jobs were passed over {self.skipped} times for a busy site or address")
+        if self.own_cache:
+            self.cache.close()
@@ -0,0 +1,330 @@
+import asyncio
+import ipaddress
+import logging
+import os
+import random
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from ingest import split_target
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+PRECHECK = os.getenv('PRECHECK', 'true').lower() == 'true'
+# host:port of the DNS server to ask; empty uses the first nameserver in /etc/resolv.conf
+PRECHECK_RESOLVER = os.getenv('PRECHECK_RESOLVER', '')
+PRECHECK_CONCURRENCY = int(os.getenv('PRECHECK_CONCURRENCY', 200))
+PRECHECK_TIMEOUT = float(os.getenv('PRECHECK_TIMEOUT', 3))
+PRECHECK_PORTS = [int(port) for port in os.getenv('PRECHECK_PORTS', '443,80').split(',') if port.strip()]
+PRECHECK_CACHE = os.getenv('PRECHECK_CACHE', 'precheck.db')
+PRECHECK_TTL = int(os.getenv('PRECHECK_TTL', 24 * 3600))
+# Refused connections can be a server restarting, so they are trusted for much less long
+PRECHECK_UNREACHABLE_TTL = int(os.getenv('PRECHECK_UNREACHABLE_TTL', 900))
+PRECHECK_BATCH = int(os.getenv('PRECHECK_BATCH', 1000))
+
+# Check outcomes; only the dead ones keep a domain away from the browser
+ALIVE = 'alive'
+NXDOMAIN = 'nxdomain'
+NO_ADDRESS = 'no_address'
+UNREACHABLE = 'unreachable'
+UNKNOWN = 'unknown'
+DEAD = (NXDOMAIN, NO_ADDRESS, UNREACHABLE)
+
+TYPE_A = 1
+TYPE_AAAA = 28
+RCODE_NXDOMAIN = 3
+
+
+class DNSError(Exception):
+    pass
+
+
+def system_resolver():
+    """First nameserver from /etc/resolv.conf, or None"""
+    try:
+        with open('/etc/resolv.conf', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    return parts[1], 53
+    except OSError:
+        pass
+    return None
+
+
+def parse_address(spec):
+    host, _, port = spec.rpartition(':') if spec.count(':') == 1 else (spec, '', '')
+    return host, int(port or 53)
+
+
+def build_query(query_id, name, record_type):
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    question = b''.join(bytes([len(label)]) + label for label in
+                        (part.encode('ascii') for part in name.rstrip('.').split('.'))) + b'\0'
+    return header + question + struct.pack('!HH', record_type, 1)
+
+
+def skip_name(packet, offset):
+    while True:
+        length = packet[offset]
+        if length & 0xC0 == 0xC0:
+            # Compression pointer ends the name
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_response(packet, query_id):
+    """(rcode, truncated, addresses) from a DNS response"""
+    response_id, flags, questions, answers = struct.unpack('!HHHH', packet[:8])
+    if response_id != query_id or not flags & 0x8000:
+        raise DNSError("Mismatched response")
+    offset = 12
+    for _ in range(questions):
+        offset = skip_name(packet, offset) + 4
+    addresses = []
+    for _ in range(answers):
+        offset = skip_name(packet, offset)
+        record_type, _, _, length = struct.unpack('!HHIH', packet[offset:offset + 10])
+        offset += 10
+        data = packet[offset:offset + length]
+        offset += length
+        # CNAME chains come first; every address record in the answer belongs to the name asked for
+        if record_type == TYPE_A and length == 4:
+            addresses.append(str(ipaddress.IPv4Address(data)))
+        elif record_type == TYPE_AAAA and length == 16:
+            addresses.append(str(ipaddress.IPv6Address(data)))
+    return flags & 0x000F, bool(flags & 0x0200), addresses
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, address):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class HostChecker:
+    """Asynchronous DNS lookup plus TCP connect, telling dead domains from live ones.
+
+    Lookups go straight to a DNS server over UDP, so thousands can be in
+    flight without a thread each and tests can point it at a stub resolver.
+    Anything inconclusive (timeouts, SERVFAIL, truncated answers, addresses
+    this host cannot route to) is reported as UNKNOWN and left for the
+    browser to try. Only a host refusing every connection is UNREACHABLE.
+    """
+
+    def __init__(self, resolver=PRECHECK_RESOLVER, timeout=PRECHECK_TIMEOUT, ports=PRECHECK_PORTS):
+        self.resolver = parse_address(resolver) if resolver else system_resolver()
+        self.timeout = timeout
+        self.ports = ports
+
+    async def query(self, name, record_type):
+        loop = asyncio.get_running_loop()
+        query_id = random.randrange(1 << 16)
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _QueryProtocol(future), remote_addr=self.resolver)
+        try:
+            transport.sendto(build_query(query_id, name, record_type))
+            packet = await asyncio.wait_for(future, self.timeout)
+        finally:
+            transport.close()
+        return parse_response(packet, query_id)
+
+    async def resolve(self, host):
+        """(status, addresses) for a host name"""
+        try:
+            ipaddress.ip_address(host)
+            return ALIVE, [host]
+        except ValueError:
+            pass
+
+        if self.resolver is None:
+            return await self.resolve_with_system(host)
+
+        addresses = []
+        for record_type in (TYPE_A, TYPE_AAAA):
+            try:
+                rcode, truncated, found = await self.query(host, record_type)
+            except (asyncio.TimeoutError, OSError, DNSError, struct.error, IndexError):
+                return UNKNOWN, []
+            if rcode == RCODE_NXDOMAIN:
+                return NXDOMAIN, []
+            if rcode != 0 or truncated:
+                return UNKNOWN, []
+            addresses.extend(found)
+            if addresses:
+                break
+        return (ALIVE, addresses) if addresses else (NO_ADDRESS, [])
+
+    async def resolve_with_system(self, host):
+        # No nameserver known: fall back to the (thread backed) system resolver
+        try:
+            infos = await asyncio.wait_for(
+                asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM), self.timeout)
+        except socket.gaierror as e:
+            return (NXDOMAIN, []) if e.errno == socket.EAI_NONAME else (UNKNOWN, [])
+        except asyncio.TimeoutError:
+            return UNKNOWN, []
+        return ALIVE, list(dict.fromkeys(info[4][0] for info in infos))
+
+    async def connect(self, addresses, ports):
+        """True as soon as any address accepts a connection on any port, False if every one refused.
+
+        None when an attempt timed out or could not be made at all, such as
+        an IPv6 address from a host without IPv6: that says nothing about
+        the site.
+        """
+        refused = True
+        for port in ports:
+            for address in addresses[:2]:
+                try:
+                    _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), self.timeout)
+                except ConnectionRefusedError:
+                    continue
+                except (asyncio.TimeoutError, OSError):
+                    refused = False
+                    continue
+                writer.close()
+                return True
+        return False if refused else None
+
+    async def check(self, domain):
+        """(status, detail) for a normalized target domain"""
+        scheme, host, port, _ = split_target(domain)
+        status, addresses = await self.resolve(host)
+        if status != ALIVE:
+            return status, ''
+        if port:
+            ports = [int(port)]
+        else:
+            ports = [80, 443] if scheme == 'http' else self.ports
+        reached = await self.connect(addresses, ports)
+        if reached is None:
+            return UNKNOWN, ''
+        if not reached:
+            return UNREACHABLE, f"connection refused on port {'/'.join(map(str, ports))} of {addresses[0]}"
+        return ALIVE, addresses[0]
+
+
+class PrecheckCache:
+    """Check results by domain, kept for PRECHECK_TTL seconds across runs, or PRECHECK_UNREACHABLE_TTL if refused"""
+
+    def __init__(self, path=PRECHECK_CACHE, ttl=PRECHECK_TTL, unreachable_ttl=PRECHECK_UNREACHABLE_TTL):
+        self.ttl = ttl
+        self.unreachable_ttl = unreachable_ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checks ('
+                                'domain TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                                'detail TEXT, checked_at REAL NOT NULL)')
+
+    def get_many(self, domains):
+        """Fresh cached results for the domains that have one"""
+        now = time.time()
+        cutoffs = [now - self.ttl, UNREACHABLE, now - min(self.ttl, self.unreachable_ttl)]
+        found = {}
+        with self.lock:
+            for start in range(0, len(domains), 500):
+                chunk = domains[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT domain, status, detail FROM checks WHERE checked_at > ? "
+                    f"AND (status != ? OR checked_at > ?) "
+                    f"AND domain IN ({','.join('?' * len(chunk))})", [*cutoffs, *chunk]).fetchall()
+                found.update((domain, (status, detail)) for domain, status, detail in rows)
+        return found
+
+    def addresses(self, domains):
+        """Address each live domain was reached at, for the domains with a fresh result"""
+        return {domain: detail for domain, (status, detail) in self.get_many(domains).items()
+                if status == ALIVE and detail}
+
+    def put_many(self, results):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO checks (domain, status, detail, checked_at) VALUES (?, ?, ?, ?)',
+                ((domain, status, detail, now) for domain, (status, detail) in results.items()
+                 # Inconclusive results are worth asking again next time
+                 if status != UNKNOWN))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+async def _check_all(checker, domains, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def check(domain):
+        async with slots:
+            try:
+                return domain, await checker.check(domain)
+            except Exception as e:
+                logging.warning(f"Precheck of {domain} failed: {str(e)}")
+                return domain, (UNKNOWN, '')
+
+    return dict(await asyncio.gather(*(check(domain) for domain in domains)))
+
+
+def check_domains(domains, checker=None, cache=None, concurrency=PRECHECK_CONCURRENCY):
+    """Check a batch of domains, answering from the cache where possible; returns {domain: (status, detail)}"""
+    checker = checker or HostChecker()
+    results = cache.get_many(domains) if cache else {}
+    missing = [domain for domain in domains if domain not in results]
+    if missing:
+        checked = asyncio.run(_check_all(checker, missing, concurrency))
+        if cache:
+            cache.put_many(checked)
+        results.update(checked)
+    return results
+
+
+def precheck_run(job_store, run_id, checker=None, cache=None, batch=PRECHECK_BATCH):
+    """Check every pending job of a run and finish dead domains without a browser.
+
+    Dead jobs end in the 'dead' state with the reason as their error, so
+    they show up in the job status. Returns the number of outcomes by status.
+    """
+    checker = checker or HostChecker()
+    own_cache = cache is None
+    cache = cache or PrecheckCache()
+    counts = {}
+    started = time.monotonic()
+    try:
+        after = ''
+        while True:
+            domains = job_store.pending_after(run_id, after, batch)
+            if not domains:
+                break
+            after = domains[-1]
+            results = check_domains(domains, checker, cache)
+            dead = []
+            for domain, (status, detail) in results.items():
+                counts[status] = counts.get(status, 0) + 1
+                if status in DEAD:
+                    dead.append((domain, f"{status}: {detail}" if detail else status))
+            job_store.mark_dead(run_id, dead)
+    finally:
+        if own_cache:
+            cache.close()
+
+    removed = sum(counts.get(status, 0) for status in DEAD)
+    logging.info(f"Precheck: {sum(counts.values())} domains in {time.monotonic() - started:.1f}s, "
+                 f"{removed} dead ({', '.join(f'{k}: {v}' for k, v in sorted(counts.items()))})")
+    return counts
@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+READY_STRATEGIES = os.getenv('READY_STRATEGIES', 'network_idle')
+READY_TIMEOUT = float(os.getenv('READY_TIMEOUT', 15))
+READY_POLL_INTERVAL = float(os.getenv('READY_POLL_INTERVAL', 0.1))
+NETWORK_IDLE_WINDOW = float(os.getenv('NETWORK_IDLE_WINDOW', 0.5))
+PAGE_LOAD_STRATEGY = os.getenv('PAGE_LOAD_STRATEGY', 'eager')
+PAGE_LOAD_WAIT = float(os.getenv('PAGE_LOAD_WAIT', 3))
+
+# Outcome of a readiness wait: which strategy fired, seconds since navigation start
+# and how many of them the navigation request itself took
+ReadinessResult = namedtuple('ReadinessResult', ['strategy', 'elapsed', 'navigated'], defaults=[0.0])
+
+
+class ReadyStateStrategy:
+    """Fires once document.readyState reports 'complete'"""
+    name = 'readystate'
+
+    def reset(self, driver):
+        pass
+
+    def check(self, driver, elapsed):
+        return driver.execute_script('return document.readyState') == 'complete'
+
+
+class NetworkIdleStrategy:
+    """Fires once no request has been in flight for NETWORK_IDLE_WINDOW seconds.
+
+    In-flight requests are tracked from the CDP Network events that Chrome
+    writes to the performance log. If that log is unavailable the strategy
+    falls back to watching the resource timing buffer for new entries.
+    """
+    name = 'network_idle'
+
+    def __init__(self):
+        self.in_flight = set()
+        self.idle_since = None
+        self.use_log = True
+        self.resource_count = -1
+
+    def reset(self, driver):
+        # Drain events left over from the previous page
+        try:
+            driver.get_log('performance')
+        except WebDriverException:
+            self.use_log = False
+
+    def _update_from_log(self, driver):
+        for entry in driver.get_log('performance'):
+            message = json.loads(entry['message'])['message']
+            method = message.get('method', '')
+            request_id = message.get('params', {}).get('requestId')
+            if method == 'Network.requestWillBeSent':
+                self.in_flight.add(request_id)
+                self.idle_since = None
+            elif method in ('Network.loadingFinished', 'Network.loadingFailed'):
+                self.in_flight.discard(request_id)
+        return not self.in_flight
+
+    def _update_from_resources(self, driver):
+        count = driver.execute_script(
+            "return performance.getEntriesByType('resource').length")
+        if count != self.resource_count:
+            self.resource_count = count
+            self.idle_since = None
+        return True
+
+    def check(self, driver, elapsed):
+        if self.use_log:
+            try:
+                quiet = self._update_from_log(driver)
+            except WebDriverException:
+                self.use_log = False
+                quiet = self._update_from_resources(driver)
+        else:
+            quiet = self._update_from_resources(driver)
+
+        if not quiet or driver.execute_script('return document.readyState') == 'loading':
+            self.idle_since = None
+            return False
+        if self.idle_since is None:
+            self.idle_since = elapsed
+        return elapsed - self.idle_since >= NETWORK_IDLE_WINDOW
+
+
+class FirstPaintStrategy:
+    """Fires once the page has reported its first contentful paint"""
+    name = 'first_paint'
+
+    def reset(self, driver):
+        pass
+
+    def check(self, driver, elapsed):
+        return bool(driver.execute_script(
+            "return performance.getEntriesByName('first-contentful-paint').length"))
+
+
+class FixedDelayStrategy:
+    """Fires after PAGE_LOAD_WAIT seconds, matching the old fixed sleep"""
+    name = 'fixed'
+
+    def reset(self, driver):
+        pass
+
+    def check(self, driver, elapsed):
+        return elapsed >= PAGE_LOAD_WAIT
+
+
+class HardCapStrategy:
+    """Fires after READY_TIMEOUT seconds no matter what the page is doing"""
+    name = 'timeout'
+
+    def reset(self, driver):
+        pass
+
+    def check(self, driver, elapsed):
+        return elapsed >= READY_TIMEOUT
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (ReadyStateStrategy, NetworkIdleStrategy, FirstPaintStrategy,
+                     FixedDelayStrategy, HardCapStrategy)
+}
+
+
+def build_strategies(names=READY_STRATEGIES):
+    """Instantiate the configured strategies, always ending with the hard cap"""
+    strategies = []
+    for name in (n.strip() for n in names.split(',')):
+        if not name or name == HardCapStrategy.name:
+            continue
+        if name not in STRATEGIES:
+            raise ValueError(f"Unknown readiness strategy: {name}")
+        strategies.append(STRATEGIES[name]())
+    strategies.append(HardCapStrategy())
+    return strategies
+
+
+def configure_options(chrome_options):
+    """Apply the browser options the readiness strategies rely on"""
+    # Let driver.get return early so the strategies decide when the page is ready
+    chrome_options.page_load_strategy = PAGE_LOAD_STRATEGY
+    if NetworkIdleStrategy.name in READY_STRATEGIES:
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+
+
+def wait_until_ready(driver, strategies, started, navigated=0.0):
+    """Poll the strategies until one fires and report which one it was"""
+    while True:
+        elapsed = time.monotonic() - started
+        for strategy in strategies:
+            try:
+                fired = strategy.check(driver, elapsed)
+            except WebDriverException as e:
+                # A page mid-navigation can reject scripts; try again next poll
+                logging.debug(f"Readiness check {strategy.name} failed: {str(e)}")
+                fired = False
+            if fired:
+                return ReadinessResult(strategy.name, elapsed, navigated)
+        time.sleep(READY_POLL_INTERVAL)
+
+
+def navigate(driver, url, names=READY_STRATEGIES):
+    """Load url and block until the page is ready for a screenshot"""
+    strategies = build_strategies(names)
+    for strategy in strategies:
+        strategy.reset(driver)
+
+    driver.set_page_load_timeout(READY_TIMEOUT)
+    started = time.monotonic()
+    try:
+        driver.get(url)
+    except TimeoutException:
+        # The hard cap has already passed; capture whatever has rendered
+        logging.warning(f"Page load timed out after {READY_TIMEOUT}s: {url}")
+    return wait_until_ready(driver, strategies, started, time.monotonic() - started)
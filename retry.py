@@ -0,0 +1,75 @@
+import os
+import random
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+RETRY_DELAY = float(os.getenv('RETRY_DELAY', 2))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+
+# Error classes
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+BROWSER = 'browser'
+
+# Chrome network errors that will fail the same way on every attempt
+PERMANENT_MARKERS = (
+    'ERR_NAME_NOT_RESOLVED',
+    'ERR_NAME_RESOLUTION_FAILED',
+    'ERR_ADDRESS_UNREACHABLE',
+    'ERR_ADDRESS_INVALID',
+    'ERR_CONNECTION_REFUSED',
+    'ERR_CERT_',
+    'ERR_SSL_',
+    'ERR_BAD_SSL_CLIENT_AUTH_CERT',
+    'ERR_TOO_MANY_REDIRECTS',
+    'ERR_INVALID_URL',
+    'ERR_UNSAFE_PORT',
+    'ERR_BLOCKED_BY_',
+    'ERR_INVALID_RESPONSE',
+    'ERR_EMPTY_RESPONSE',
+)
+
+# Faults of the browser or its session rather than of the page
+BROWSER_MARKERS = (
+    'invalid session id',
+    'session deleted',
+    'chrome not reachable',
+    'disconnected: ',
+    'tab crashed',
+    'target crashed',
+    'target closed',
+    'no such window',
+    'devtools connection closed',
+    'unable to receive message from renderer',
+    'failed to start a thread',
+    'cannot connect to chrome',
+)
+
+
+def classify(error):
+    """PERMANENT, TRANSIENT or BROWSER for an exception raised by a capture"""
+    message = str(error)
+    lowered = message.lower()
+    if any(marker in lowered for marker in BROWSER_MARKERS):
+        return BROWSER
+    if any(marker in message for marker in PERMANENT_MARKERS):
+        return PERMANENT
+    # Timeouts, resets and anything unrecognised get another chance
+    return TRANSIENT
+
+
+def is_browser_fault(error):
+    return classify(error) == BROWSER
+
+
+def backoff(attempt, base=RETRY_DELAY, cap=RETRY_MAX_DELAY):
+    """Seconds to wait before retry number attempt: exponential, capped, with jitter.
+
+    Half of the delay is fixed and half random, so retries of domains that
+    failed together spread out instead of all coming back at once.
+    """
+    delay = min(cap, base * 2 ** max(0, attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
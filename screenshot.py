@@ -1,9 +1,20 @@
-from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.common.exceptions import WebDriverException
-from webdriver_manager.chrome import ChromeDriverManager
-from PIL import Image
+from browser_pool import BrowserPool, BROWSER_POOL_SIZE, TABS_PER_BROWSER
+from manifest import Manifest
+from jobstore import JobStore
+from ingest import IngestStats, read_targets
+from imaging import screenshot_path
+import adaptive
+import imaging
+import lookalike
+import metrics
+import migrate_images
+import pipeline
+import politeness
+import precheck
+import retry
+import readiness
+import base64
 import os
 import time
 import concurrent.futures
@@ -20,12 +31,14 @@ IMAGE_DIR = os.getenv('IMAGE_DIR', 'img')
 TARGET_FILE = os.getenv('TARGET_FILE', 'target.txt')
 SCREENSHOT_WIDTH = int(os.getenv('SCREENSHOT_WIDTH', 1920))
 SCREENSHOT_HEIGHT = int(os.getenv('SCREENSHOT_HEIGHT', 1080))
-SCREENSHOT_RESIZE_WIDTH = int(os.getenv('SCREENSHOT_RESIZE_WIDTH', 500))
-PAGE_LOAD_WAIT = int(os.getenv('PAGE_LOAD_WAIT', 3))
 MAX_WORKERS = int(os.getenv('MAX_WORKERS', 4))
 MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
-RETRY_DELAY = int(os.getenv('RETRY_DELAY', 2))
 HEADLESS = os.getenv('HEADLESS', 'true').lower() == 'true'
+CAPTURE_ENGINE = os.getenv('CAPTURE_ENGINE', 'selenium')
+INCREMENTAL = os.getenv('INCREMENTAL', 'false').lower() == 'true'
+RESUME = os.getenv('RESUME', 'true').lower() == 'true'
+# Captures claimed from the job store but not yet finished; 0 means twice the engine's concurrency
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', 0))
 
 # Configure logging
 logging.basicConfig(
@@ -33,146 +46,462 @@ logging.basicConfig(
     format='%(asctime)s - [Thread-%(thread)d] - %(levelname)s - %(message)s'
 )
 
-# Thread-local storage for WebDriver instances
-thread_local = threading.local()
-
-# Shared queue for progress tracking
+# Shared queue for progress tracking, replaced for every batch
 progress_queue = Queue()
 
-def get_thread_driver():
-    """Get or create thread-local WebDriver instance"""
-    if not hasattr(thread_local, "driver"):
-        chrome_options = Options()
-        if HEADLESS:
-            chrome_options.add_argument('--headless=new')
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument(f'--window-size={SCREENSHOT_WIDTH},{SCREENSHOT_HEIGHT}')
-        chrome_options.add_argument('--disable-gpu')
-        
-        try:
-            # Use webdriver-manager to get the correct chromedriver version
-            service = Service(ChromeDriverManager().install())
-            thread_local.driver = webdriver.Chrome(service=service, options=chrome_options)
-        except Exception as e:
-            logging.error(f"Error setting up Chrome WebDriver: {str(e)}")
-            raise
-    return thread_local.driver
+class BatchProgress:
+    """Counts for the running batch, readable by whoever started it"""
 
-def cleanup_thread_driver():
-    """Cleanup thread-local WebDriver instance"""
-    if hasattr(thread_local, "driver"):
-        try:
-            thread_local.driver.quit()
-        except Exception:
-            pass
-        delattr(thread_local, "driver")
+    def __init__(self, on_change=None, on_stored=None):
+        self.total = 0
+        self.success = 0
+        self.error = 0
+        # Dropped by the precheck before reaching a browser
+        self.dead = 0
+        # Per-stage metrics summaries, once the run is over
+        self.stages = None
+        self.on_change = on_change
+        self.on_stored = on_stored
+
+    def snapshot(self):
+        counts = {'total': self.total, 'success': self.success, 'error': self.error,
+                  'processed': self.success + self.error, 'dead': self.dead}
+        if self.stages is not None:
+            counts['stages'] = self.stages
+        return counts
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self.snapshot())
+
+    def stored(self, domain):
+        if self.on_stored:
+            self.on_stored(domain)
+
+# Pool of browser tabs shared by the worker threads
+browser_pool = None
+
+# Process pool stage that decodes, resizes and writes captured screenshots
+postprocess_stage = None
 
-def process_single_domain(domain):
-    """Process a single domain with retries"""
-    retry_count = 0
+# Last capture time, status and content hash of every domain
+manifest = None
+
+# Links near-identical captures to one stored copy
+content_store = None
+
+# Persistent per-run job state and the run being processed
+job_store = None
+run_id = None
+
+def create_chrome_options(debugger_address=None):
+    """Build Chrome options for launching a browser or attaching a tab to one"""
+    chrome_options = Options()
+    readiness.configure_options(chrome_options)
+    if debugger_address:
+        chrome_options.debugger_address = debugger_address
+        return chrome_options
     
-    while retry_count < MAX_RETRIES:
-        try:
-            driver = get_thread_driver()
-            output_path = os.path.join(IMAGE_DIR, f"{domain.replace('.', '_')}.png")
-            
-            url = f"https://{domain}" if not domain.startswith(('http://', 'https://')) else domain
-            logging.info(f"Processing: {url}")
-            
-            driver.get(url)
-            time.sleep(PAGE_LOAD_WAIT)
+    if HEADLESS:
+        chrome_options.add_argument('--headless=new')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument(f'--window-size={SCREENSHOT_WIDTH},{SCREENSHOT_HEIGHT}')
+    chrome_options.add_argument('--disable-gpu')
+    return chrome_options
+
+def browser_pool_size(workers):
+    """Enough browsers for every worker to lease a tab"""
+    return BROWSER_POOL_SIZE or -(-workers // TABS_PER_BROWSER)
+
+def create_browser_pool(workers=MAX_WORKERS):
+    size = browser_pool_size(workers)
+    return BrowserPool(create_chrome_options, size, tabs=TABS_PER_BROWSER)
+
+def close_browser_pool():
+    """Shut down every browser in the pool"""
+    global browser_pool
+    if browser_pool is not None:
+        browser_pool.close()
+        browser_pool = None
+
+def domain_url(domain):
+    """Turn a target line into the URL to capture"""
+    return f"https://{domain}" if not domain.startswith(('http://', 'https://')) else domain
+
+def capture_png(driver):
+    """Take the screenshot as PNG bytes through CDP, scaled by Chrome when enabled"""
+    result = driver.execute('executeCdpCommand', {
+        'cmd': 'Page.captureScreenshot',
+        'params': imaging.capture_params(),
+    })['value']
+    return base64.b64decode(result['data'])
+
+def store_screenshot(domain, png):
+    """Queue captured PNG bytes on the post-processing stage and return its future"""
+    stem = screenshot_path(domain)
+    # Time spent waiting for room on a busy post-processing stage
+    with metrics.stage(domain, 'handoff'):
+        future = postprocess_stage.submit(imaging.write_variants, IMAGE_DIR, stem, png)
+    
+    def log_saved(done):
+        if done.exception() is None:
+            logging.info(f"Screenshot saved: {stem}{imaging.EXTENSION} "
+                         f"({', '.join(name for name, _ in imaging.VARIANTS)})")
+    
+    future.add_done_callback(log_saved)
+    return future
+
+def process_single_domain(domain, on_capture, stage_metrics):
+    """Capture a single domain once and hand the bytes to post-processing through on_capture.
+
+    Failures propagate; report_progress decides whether the job is retried.
+    """
+    started = time.monotonic()
+    try:
+        url = domain_url(domain)
+        logging.info(f"Processing: {url}")
+        
+        with browser_pool.lease() as driver:
+            metrics.record(domain, 'acquire', time.monotonic() - started)
+            ready = readiness.navigate(driver, url)
+            logging.info(f"Ready: {url} via {ready.strategy} after {ready.elapsed:.2f}s")
+            loaded = time.time() - ready.elapsed
+            metrics.record(domain, 'navigate', ready.navigated, loaded)
+            metrics.record(domain, 'ready', ready.elapsed - ready.navigated, loaded + ready.navigated)
             
             driver.set_window_size(SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT)
-            driver.save_screenshot(output_path)
-            
-            with Image.open(output_path) as img:
-                width_percent = (SCREENSHOT_RESIZE_WIDTH / float(img.size[0]))
-                new_height = int((float(img.size[1]) * float(width_percent)))
-                resized_img = img.resize((SCREENSHOT_RESIZE_WIDTH, new_height), Image.Resampling.LANCZOS)
-                resized_img.save(output_path)
-            
-            logging.info(f"Screenshot saved: {output_path}")
-            progress_queue.put(('success', domain))
-            return True
-            
-        except Exception as e:
-            retry_count += 1
-            logging.error(f"Error processing {domain} (attempt {retry_count}/{MAX_RETRIES}): {str(e)}")
-            
-            cleanup_thread_driver()
-            
-            if retry_count < MAX_RETRIES:
-                time.sleep(RETRY_DELAY)
-            else:
-                progress_queue.put(('error', domain))
-                return False
+            with metrics.stage(domain, 'capture'):
+                png = capture_png(driver)
+    
+    except Exception:
+        stage_metrics.record(time.monotonic() - started, ok=False)
+        raise
+    
+    stage_metrics.record(time.monotonic() - started)
+    return on_capture(domain, png)
+
+class SeleniumEngine:
+    """Captures on worker threads, each leasing a tab from the browser pool"""
+
+    def __init__(self, on_capture, workers=MAX_WORKERS):
+        global browser_pool
+        self.on_capture = on_capture
+        browser_pool = create_browser_pool(workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.concurrency = workers
+        self.metrics = pipeline.StageMetrics('capture')
 
-def progress_monitor():
+    def submit(self, domain):
+        # The worker returns the post-processing future once the capture is done
+        return pipeline.flatten(self.executor.submit(process_single_domain, domain, self.on_capture,
+                                                     self.metrics))
+
+    def rss_mb(self):
+        return browser_pool.rss_mb() if browser_pool is not None else 0
+
+    def resize(self, workers):
+        """Follow the adaptive concurrency limit, closing browsers it no longer needs"""
+        browser_pool.resize(browser_pool_size(workers))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        close_browser_pool()
+
+def create_engine(on_capture=store_screenshot, name=CAPTURE_ENGINE):
+    """Create the capture engine selected by CAPTURE_ENGINE.
+
+    on_capture(domain, png_bytes) queues a screenshot for post-processing
+    and returns its future. The remote engine captures nothing itself: it
+    hands jobs to distributed workers (worker.py) and stores their uploads.
+    """
+    if name == 'selenium':
+        # Threads up to the adaptive maximum; the capture slots decide how many are busy
+        workers = adaptive.ADAPTIVE_MAX_WORKERS if adaptive.ADAPTIVE_CONCURRENCY else MAX_WORKERS
+        return SeleniumEngine(on_capture, workers)
+    if name == 'cdp':
+        # Imported lazily so the Selenium engine does not need websockets
+        from cdp_engine import CDPCaptureEngine
+        return CDPCaptureEngine(on_capture, domain_url)
+    if name == 'remote':
+        from coordinator import RemoteEngine
+        return RemoteEngine(IMAGE_DIR)
+    raise ValueError(f"Unknown capture engine: {name}")
+
+def report_progress(domain, future):
+    """Record a finished capture and forward it to the progress monitor.
+
+    Transient and browser failures go back to the job store with a backoff
+    delay instead of occupying a worker; permanent ones fail straight away.
+    """
+    error = None
+    phash = None
+    try:
+        stored = future.result()
+        content_hash = content_store.settle(screenshot_path(domain), stored)
+        phash = stored['phash']
+    except Exception as e:
+        kind = retry.classify(e)
+        attempts = job_store.attempts(run_id, domain)
+        if kind != retry.PERMANENT and attempts < MAX_RETRIES:
+            delay = retry.backoff(attempts)
+            logging.warning(f"Error processing {domain} ({kind}, attempt {attempts}/{MAX_RETRIES}), "
+                            f"retrying in {delay:.1f}s: {str(e)}")
+            job_store.defer(run_id, domain, delay, f"{kind}: {str(e)}")
+            metrics.finish(domain, 'retry', kind)
+            return
+        logging.error(f"Error processing {domain} ({kind}, attempt {attempts}/{MAX_RETRIES}): {str(e)}")
+        content_hash = None
+        error = f"{kind}: {str(e)}"
+    status = 'success' if content_hash else 'error'
+    metrics.finish(domain, status, kind if error else None, stored.get('timings') if content_hash else None)
+    job_store.finish(run_id, domain, status, error)
+    if manifest is not None:
+        if content_hash:
+            stem = screenshot_path(domain)
+            manifest.record(domain, status, content_hash, phash, stem, imaging.stat_variants(IMAGE_DIR, stem))
+        else:
+            manifest.record(domain, status)
+    progress_queue.put((status, domain))
+
+def progress_monitor(queue, progress):
     """Monitor and display progress information"""
-    success_count = 0
-    error_count = 0
-    total_count = 0
-    
     while True:
         try:
-            status, domain = progress_queue.get()
+            status, domain = queue.get()
             if status == 'success':
-                success_count += 1
+                progress.success += 1
+                progress.stored(domain)
             elif status == 'error':
-                error_count += 1
+                progress.error += 1
             elif status == 'total':
-                total_count = domain
-                logging.info(f"Starting processing of {total_count} domains")
+                progress.total = domain
+                logging.info(f"Starting processing of {progress.total} domains")
+                progress.changed()
                 continue
             
-            processed = success_count + error_count
-            if total_count > 0:
-                percentage = (processed / total_count) * 100
-                logging.info(f"Progress: {processed}/{total_count} ({percentage:.1f}%) - "
-                           f"Success: {success_count}, Errors: {error_count}")
+            processed = progress.success + progress.error
+            if progress.total > 0:
+                percentage = (processed / progress.total) * 100
+                logging.info(f"Progress: {processed}/{progress.total} ({percentage:.1f}%) - "
+                           f"Success: {progress.success}, Errors: {progress.error}")
+            progress.changed()
             
-            if processed == total_count:
+            if processed == progress.total:
                 break
             
         except Exception as e:
             logging.error(f"Error in progress monitor: {str(e)}")
             break
 
-def process_domains_parallel(domains):
-    """Process domains in parallel using ThreadPoolExecutor"""
-    monitor_thread = threading.Thread(target=progress_monitor)
+def process_run(progress):
+    """Claim pending jobs of the current run and process them until none are left"""
+    global postprocess_stage, progress_queue
+    if precheck.PRECHECK and job_store.counts(run_id).get('pending', 0):
+        # Unregistered and unreachable domains never reach a browser
+        precheck.precheck_run(job_store, run_id)
+    counts = job_store.counts(run_id)
+    progress.dead = counts.get('dead', 0)
+    remaining = counts.get('pending', 0)
+    if not remaining:
+        logging.info("No domains to process")
+        job_store.finish_run(run_id)
+        return
+    
+    # Picks jobs so that no single site or address takes up the workers
+    scheduler = politeness.PolitenessScheduler(job_store, run_id)
+    postprocess_stage = pipeline.PostProcessStage()
+    try:
+        engine = create_engine()
+    except Exception:
+        postprocess_stage.close()
+        scheduler.close()
+        raise
+    
+    # Daemon so an aborted run cannot leave the process waiting on the monitor
+    progress_queue = Queue()
+    monitor_thread = threading.Thread(target=progress_monitor, args=(progress_queue, progress), daemon=True)
     monitor_thread.start()
     
-    progress_queue.put(('total', len(domains)))
+    progress_queue.put(('total', remaining))
+    
+    trace_path = metrics.start_trace(run_id)
+    if trace_path:
+        logging.info(f"Writing capture trace to {trace_path}")
+    metrics.BROWSER_RSS.set_function(lambda: engine.rss_mb() * 1024 * 1024)
+    
+    # Claim a job only when the engine has room for it, so the store stays the source of truth
+    window = MAX_IN_FLIGHT or engine.concurrency * 2
+    if CAPTURE_ENGINE == 'remote':
+        # Workers tune their own concurrency
+        slots, controller = threading.Semaphore(window), None
+    else:
+        # With ADAPTIVE_CONCURRENCY the slots start at MAX_WORKERS and follow what the host can take
+        slots, controller = adaptive.create_slots(engine, window, MAX_WORKERS)
+    activity = threading.Condition()
+    in_flight = 0
+    completed = 0
+    # Futures complete on the process pool's result thread or the CDP event loop; the job store,
+    # manifest and content store are updated on this thread instead, so neither is held up
+    completions = Queue()
+    
+    def bookkeeping():
+        while True:
+            item = completions.get()
+            if item is None:
+                break
+            try:
+                finished(*item)
+            except Exception as e:
+                logging.error(f"Error recording {item[0]}: {str(e)}")
+    
+    bookkeeper = threading.Thread(target=bookkeeping, daemon=True)
+    bookkeeper.start()
+    
+    def finished(domain, future, submitted):
+        nonlocal in_flight, completed
+        if controller is not None:
+            controller.observe(time.monotonic() - submitted, None if future.cancelled() else future.exception())
+        try:
+            report_progress(domain, future)
+        finally:
+            scheduler.release(domain)
+            slots.release()
+            with activity:
+                in_flight -= 1
+                metrics.IN_FLIGHT.set(in_flight)
+                completed += 1
+                activity.notify_all()
     
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(process_single_domain, domain) for domain in domains]
-            concurrent.futures.wait(futures)
+        while True:
+            slots.acquire()
+            with activity:
+                seen = completed
+            domain = scheduler.claim()
+            if domain is not None:
+                with activity:
+                    in_flight += 1
+                    metrics.IN_FLIGHT.set(in_flight)
+                metrics.begin(domain)
+                submitted = time.monotonic()
+                future = engine.submit(domain)
+                future.add_done_callback(lambda f, domain=domain, submitted=submitted:
+                                         completions.put((domain, f, submitted)))
+                continue
+            
+            slots.release()
+            with activity:
+                if completed != seen:
+                    # A capture finished while claiming and may have freed its site
+                    continue
+                # Retries are deferred before in_flight drops, so this sees every outstanding job
+                due = job_store.next_due(run_id)
+                if due is None and in_flight == 0:
+                    break
+                # Sleep until a retry comes due, a site's interval passes or a capture finishes
+                waits = [wait for wait in (due - time.time() if due is not None else None, scheduler.ready_in())
+                         if wait is not None and wait > 0]
+                if waits:
+                    activity.wait(max(0.05, min(waits)))
+                else:
+                    activity.wait(None if in_flight else 0.05)
+        
+        job_store.finish_run(run_id)
     
     finally:
-        cleanup_thread_driver()
+        if controller is not None:
+            controller.stop()
+        engine.close()
+        postprocess_stage.close()
+        # Record whatever finished or was cancelled while shutting down
+        completions.put(None)
+        bookkeeper.join()
+        scheduler.close()
+        metrics.stop_trace()
+        metrics.BROWSER_RSS.set_function(None)
+        metrics.BROWSER_RSS.set(0)
+        metrics.IN_FLIGHT.set(0)
+        engine.metrics.log_summary()
+        postprocess_stage.metrics.log_summary()
+        progress.stages = {stage_metrics.name: stage_metrics.summary()
+                           for stage_metrics in (engine.metrics, postprocess_stage.metrics)}
     
     monitor_thread.join()
 
-def main():
+def screenshot_exists(domain):
+    """True when every size variant of a domain's screenshot is on disk"""
+    stem = screenshot_path(domain)
+    return all(os.path.exists(imaging.variant_path(IMAGE_DIR, name, stem)) for name, _ in imaging.VARIANTS)
+
+def select_incremental(domains, stats):
+    """Keep only domains that are missing, stale past CAPTURE_TTL, or failed last time"""
+    for domain in domains:
+        if manifest.needs_capture(domain) or not screenshot_exists(domain):
+            yield domain
+        else:
+            stats.fresh += 1
+
+def start_run(incremental, resume):
+    """Resume the last interrupted run, or create a new one from TARGET_FILE"""
+    unfinished = job_store.unfinished_run() if resume else None
+    if unfinished is not None:
+        requeued = job_store.resume_run(unfinished)
+        logging.info(f"Resuming run {unfinished} ({requeued} interrupted jobs requeued)")
+        return unfinished
+    
+    # Streamed straight into the job store, which also drops duplicates
+    stats = IngestStats()
+    domains = read_targets(TARGET_FILE, stats)
+    if incremental:
+        domains = select_incremental(domains, stats)
+    
+    new_run = job_store.create_run(domains)
+    stats.log_summary(job_store.run_total(new_run))
+    return new_run
+
+def run_batch(incremental=INCREMENTAL, resume=RESUME, on_progress=None, on_stored=None):
+    """Run one screenshot batch in this process and return its final counts.
+
+    on_progress(counts) is called from the monitor thread whenever a domain
+    finishes, and on_stored(domain) once its images are on disk. Only one
+    batch may run per process at a time.
+    """
+    global manifest, content_store, job_store, run_id
+    progress = BatchProgress(on_progress, on_stored)
     try:
         if not os.path.exists(IMAGE_DIR):
             os.makedirs(IMAGE_DIR)
-            
-        with open(TARGET_FILE, 'r') as file:
-            domains = [line.strip() for line in file]
+        if migrate_images.needs_migration(IMAGE_DIR):
+            logging.warning(f"{IMAGE_DIR} still has screenshots in the flat layout; "
+                            f"run migrate_images.py so incremental runs do not capture them again")
         
-        logging.info(f"Starting screenshot generation with {len(domains)} domains")
-        process_domains_parallel(domains)
+        manifest = Manifest()
+        content_store = lookalike.ContentStore(manifest, IMAGE_DIR)
+        job_store = JobStore()
+        run_id = start_run(incremental, resume)
+        process_run(progress)
+        manifest.compact()
+        content_store.log_summary()
+        if imaging.CONTENT_STORE:
+            # Copies replaced by re-captures or folded into a look-alike
+            removed = imaging.prune_objects(IMAGE_DIR, {entry['hash'] for entry in manifest.entries.values()})
+            if removed:
+                logging.info(f"Removed {removed} unreferenced stored images")
         logging.info("Processing completed!")
+        return progress.snapshot()
     
+    finally:
+        close_browser_pool()
+        if job_store is not None:
+            job_store.close()
+            job_store = None
+
+def main():
+    try:
+        run_batch()
     except Exception as e:
         logging.error(f"Error in main process: {str(e)}")
-    
-    finally:
-        cleanup_thread_driver()
 
 if __name__ == "__main__":
     main()
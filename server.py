@@ -1,10 +1,21 @@
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import threading
 from dotenv import load_dotenv
-from urllib.parse import parse_qs
-import subprocess
+from urllib.parse import parse_qs, unquote, urlsplit
+import hashlib
 import shutil
+import time
+import coordinator
+import domaingen
+import imaging
+import metrics
+from image_index import ImageIndex, version_tag
+from migrate_images import needs_migration
+from jobstore import JobStore
+from job_manager import JobManager
 
 # Load environment variables
 load_dotenv()
@@ -12,10 +23,21 @@ load_dotenv()
 # Get configuration from environment
 SERVER_HOST = os.getenv('SERVER_HOST', 'localhost')
 SERVER_PORT = int(os.getenv('SERVER_PORT', 8000))
+# CAPTURE_ENGINE=remote makes this server the coordinator of distributed workers
+CAPTURE_ENGINE = os.getenv('CAPTURE_ENGINE', 'selenium')
 IMAGE_DIR = os.getenv('IMAGE_DIR', 'img')
 SOURCE_FILE = os.getenv('SOURCE_FILE', 'source.txt')
 TARGET_FILE = os.getenv('TARGET_FILE', 'target.txt')
 EXTENSIONS_FILE = os.getenv('EXTENSIONS_FILE', 'extensions.txt')
+JOB_EVENT_HEARTBEAT = int(os.getenv('JOB_EVENT_HEARTBEAT', 15))
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 32))
+SERVER_QUEUE_SIZE = int(os.getenv('SERVER_QUEUE_SIZE', 64))
+SERVER_MAX_STREAMS = int(os.getenv('SERVER_MAX_STREAMS', 0)) or max(1, SERVER_WORKERS // 2)
+SERVER_KEEPALIVE_TIMEOUT = float(os.getenv('SERVER_KEEPALIVE_TIMEOUT', 5))
+IMAGE_INDEX_RESCAN = int(os.getenv('IMAGE_INDEX_RESCAN', 30))
+IMAGE_PAGE_SIZE = int(os.getenv('IMAGE_PAGE_SIZE', 100))
+IMAGE_PAGE_MAX = int(os.getenv('IMAGE_PAGE_MAX', 1000))
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', 365 * 24 * 3600))
 
 # Add file editor section to the HTML template
 FILE_EDITOR = """
@@ -50,6 +72,7 @@ MANAGEMENT_BUTTONS = """
         </div>
         <div class="button-group" style="margin-top: 10px;">
             <button class="action-button" onclick="regenerateScreenshots()">Regenerate All Screenshots</button>
+            <button class="action-button" onclick="updateScreenshots()">Capture New &amp; Stale Screenshots</button>
         </div>
         <div id="managementMessage" class="message"></div>
     </div>
@@ -63,17 +86,50 @@ REGENERATE_SCRIPT = """
         }
         
         try {
-            showMessage('managementMessage', 'Starting screenshot regeneration...', true);
             const response = await fetch('/regenerate-screenshots', { method: 'POST' });
             const result = await response.json();
             showMessage('managementMessage', result.message, result.success);
             if (result.success) {
-                updateGallery();
+                watchJob(result.job_id);
             }
         } catch (error) {
             showMessage('managementMessage', 'Error regenerating screenshots', false);
         }
     }
+    
+    async function updateScreenshots() {
+        try {
+            const response = await fetch('/update-screenshots', { method: 'POST' });
+            const result = await response.json();
+            showMessage('managementMessage', result.message, result.success);
+            if (result.success) {
+                watchJob(result.job_id);
+            }
+        } catch (error) {
+            showMessage('managementMessage', 'Error updating screenshots', false);
+        }
+    }
+    
+    function watchJob(jobId) {
+        const status = document.getElementById('jobStatus');
+        const source = new EventSource(`/jobs/${jobId}/events`);
+        source.onmessage = event => {
+            const job = JSON.parse(event.data);
+            const progress = job.progress || {};
+            if (job.state === 'running' && progress.total) {
+                status.textContent = `${progress.processed}/${progress.total} ` +
+                    `(${progress.success} ok, ${progress.error} errors, ${progress.dead || 0} dead)`;
+            } else {
+                status.textContent = job.state;
+            }
+            if (job.state === 'done' || job.state === 'failed') {
+                source.close();
+                showMessage('managementMessage',
+                            job.state === 'done' ? job.message : `Job failed: ${job.error}`,
+                            job.state === 'done');
+            }
+        };
+    }
 """
 
 # Add editor scripts
@@ -272,28 +328,64 @@ VIEWER_HTML = """<!DOCTYPE html>
             background: #f8d7da;
             color: #721c24;
         }
+        .filters {
+            display: flex;
+            gap: 10px;
+            margin-bottom: 20px;
+        }
+        .filters select {
+            padding: 8px;
+            border: 1px solid #ddd;
+            border-radius: 4px;
+        }
+        /* Only the visible cards exist; they are positioned inside a gallery as tall as all rows */
         .gallery {
-            display: grid;
-            grid-template-columns: repeat(auto-fill, minmax(250px, 1fr));
-            gap: 20px;
+            position: relative;
         }
         .image-card {
+            position: absolute;
+            box-sizing: border-box;
+            height: 230px;
             background: #fff;
             padding: 10px;
             border-radius: 5px;
             box-shadow: 0 2px 5px rgba(0,0,0,0.1);
+            overflow: hidden;
         }
         .image-card img {
             width: 100%;
-            height: auto;
+            height: 150px;
+            object-fit: cover;
+            object-position: top;
             border-radius: 3px;
+            background: #eee;
         }
         .image-card .title {
             margin-top: 10px;
             font-size: 14px;
             color: #666;
             text-align: center;
-            word-break: break-all;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
+        }
+        .image-card .meta {
+            margin-top: 4px;
+            font-size: 12px;
+            color: #999;
+            text-align: center;
+        }
+        .image-card.failed .meta {
+            color: #721c24;
+        }
+        .image-card.group .meta {
+            color: #007bff;
+            cursor: pointer;
+        }
+        .filters .toggle {
+            display: flex;
+            align-items: center;
+            gap: 5px;
         }
         """ + ACTION_BUTTON_STYLE + """
     </style>
@@ -302,7 +394,7 @@ VIEWER_HTML = """<!DOCTYPE html>
     <div class="container">
         <div class="header">
             <h1>Screenshot Viewer</h1>
-            <p>Auto-refreshing every second</p>
+            <p>Updates live as screenshots are captured</p>
         </div>
         
         """ + FILE_EDITOR + """
@@ -338,14 +430,33 @@ VIEWER_HTML = """<!DOCTYPE html>
                 <h3>Last Update</h3>
                 <div id="lastUpdate">-</div>
             </div>
+            <div class="stat-box">
+                <h3>Batch Progress</h3>
+                <div id="jobStatus">-</div>
+            </div>
+        </div>
+        
+        <div class="filters">
+            <input type="text" id="searchInput" placeholder="Search domains" oninput="filtersChanged()">
+            <select id="tldFilter" onchange="filtersChanged()">
+                <option value="">All TLDs</option>
+            </select>
+            <select id="sortOrder" onchange="filtersChanged()">
+                <option value="domain">Domain A-Z</option>
+                <option value="-domain">Domain Z-A</option>
+                <option value="-captured_at">Newest first</option>
+                <option value="captured_at">Oldest first</option>
+                <option value="-size">Largest first</option>
+                <option value="status">Failed first</option>
+            </select>
+            <label class="toggle"><input type="checkbox" id="groupToggle" onchange="openGroup('', this.checked)"> Group look-alikes</label>
+            <button id="groupClear" style="display: none" onclick="openGroup('')">Show all</button>
         </div>
         
         <div class="gallery" id="imageGallery"></div>
     </div>
 
     <script>
-        const IMAGE_DIR = '""" + IMAGE_DIR + """';
-        
         function showMessage(elementId, message, isSuccess) {
             const element = document.getElementById(elementId);
             element.textContent = message;
@@ -356,68 +467,431 @@ VIEWER_HTML = """<!DOCTYPE html>
             }, 3000);
         }
         
-        function updateGallery() {
-            fetch('/images')
-                .then(response => response.json())
-                .then(images => {
-                    const gallery = document.getElementById('imageGallery');
-                    const totalCount = document.getElementById('totalCount');
-                    const lastUpdate = document.getElementById('lastUpdate');
-                    
-                    totalCount.textContent = images.length;
-                    lastUpdate.textContent = new Date().toLocaleTimeString();
-                    
-                    gallery.innerHTML = '';
-                    
-                    images.forEach(image => {
-                        const card = document.createElement('div');
-                        card.className = 'image-card';
-                        
-                        const img = document.createElement('img');
-                        img.src = `${IMAGE_DIR}/${image}`;
-                        img.alt = image;
-                        
-                        const title = document.createElement('div');
-                        title.className = 'title';
-                        title.textContent = image.replace(/_/g, '.').replace('.png', '');
-                        
-                        card.appendChild(img);
-                        card.appendChild(title);
-                        gallery.appendChild(card);
-                    });
-                })
-                .catch(error => console.error('Error:', error));
+        // The gallery is virtualized: pages of PAGE_SIZE images are fetched as they
+        // scroll into view and only cards near the viewport are kept in the DOM
+        const PAGE_SIZE = 100;
+        const CARD_MIN_WIDTH = 250;
+        const CARD_HEIGHT = 230;
+        const GAP = 20;
+        const OVERSCAN_ROWS = 2;
+        
+        const pages = new Map();
+        const pending = new Set();
+        const cards = new Map();
+        let total = 0;
+        let imageCursor = null;
+        let generation = 0;
+        // Look-alike group being browsed, from a group card
+        let groupFilter = '';
+        
+        function grouping() {
+            return document.getElementById('groupToggle').checked;
+        }
+        
+        function galleryQuery() {
+            const params = new URLSearchParams({
+                q: document.getElementById('searchInput').value.trim(),
+                tld: document.getElementById('tldFilter').value,
+                sort: document.getElementById('sortOrder').value
+            });
+            if (groupFilter) params.set('group', groupFilter);
+            return params.toString();
+        }
+        
+        function openGroup(group, grouped = false) {
+            groupFilter = group;
+            document.getElementById('groupToggle').checked = grouped;
+            document.getElementById('groupClear').style.display = group ? '' : 'none';
+            filtersChanged();
+        }
+        
+        function layout() {
+            const gallery = document.getElementById('imageGallery');
+            const width = gallery.clientWidth;
+            const columns = Math.max(1, Math.floor((width + GAP) / (CARD_MIN_WIDTH + GAP)));
+            const cardWidth = (width - GAP * (columns - 1)) / columns;
+            return { gallery, columns, cardWidth, rowHeight: CARD_HEIGHT + GAP };
+        }
+        
+        function createCard(image) {
+            const card = document.createElement('div');
+            card.className = image.status === 'success' ? 'image-card' : 'image-card failed';
+            
+            // Variants are ordered smallest first; let the browser pick via srcset
+            const variants = image.variants;
+            const link = document.createElement('a');
+            link.href = variants[variants.length - 1].url;
+            link.target = '_blank';
+            
+            const img = document.createElement('img');
+            img.src = variants[0].url;
+            img.srcset = variants.map(v => `${v.url} ${v.width}w`).join(', ');
+            img.sizes = '280px';
+            img.loading = 'lazy';
+            img.alt = image.domain;
+            
+            const title = document.createElement('div');
+            title.className = 'title';
+            title.textContent = image.domain;
+            title.title = image.domain;
+            
+            const meta = document.createElement('div');
+            meta.className = 'meta';
+            if (image.count > 1) {
+                // Cover of a look-alike group: open the group instead
+                card.classList.add('group');
+                meta.textContent = `${image.count} look-alikes`;
+                meta.onclick = () => openGroup(image.group);
+            } else {
+                meta.textContent = `${new Date(image.captured_at * 1000).toLocaleString()} · ` +
+                    (image.status === 'success' ? `${Math.round(image.size / 1024)} KB` : 'last capture failed');
+            }
+            
+            link.appendChild(img);
+            card.appendChild(link);
+            card.appendChild(title);
+            card.appendChild(meta);
+            return card;
+        }
+        
+        async function loadPage(page) {
+            if (pages.has(page) || pending.has(page)) return;
+            pending.add(page);
+            const requested = generation;
+            try {
+                const endpoint = grouping() ? '/images/groups' : '/images';
+                const response = await fetch(`${endpoint}?offset=${page * PAGE_SIZE}&limit=${PAGE_SIZE}&${galleryQuery()}`);
+                const result = await response.json();
+                if (requested !== generation) return;
+                // A group is shown as its cover image carrying the member count
+                pages.set(page, result.images ||
+                          result.groups.map(group => Object.assign({}, group.cover, { count: group.count })));
+                imageCursor = result.cursor;
+                if (result.total !== total) {
+                    total = result.total;
+                    document.getElementById('totalCount').textContent = total;
+                }
+                updateTlds(result.tlds);
+                document.getElementById('lastUpdate').textContent = new Date().toLocaleTimeString();
+                render();
+            } catch (error) {
+                console.error('Error:', error);
+            } finally {
+                pending.delete(page);
+            }
+        }
+        
+        function render() {
+            const { gallery, columns, cardWidth, rowHeight } = layout();
+            gallery.style.height = `${Math.ceil(total / columns) * rowHeight}px`;
+            
+            const top = window.scrollY - (gallery.getBoundingClientRect().top + window.scrollY);
+            const firstRow = Math.max(0, Math.floor(top / rowHeight) - OVERSCAN_ROWS);
+            const lastRow = Math.floor((top + window.innerHeight) / rowHeight) + OVERSCAN_ROWS;
+            const first = firstRow * columns;
+            const last = Math.min(total, (lastRow + 1) * columns);
+            
+            const visible = new Set();
+            let complete = true;
+            for (let index = first; index < last; index++) {
+                const page = Math.floor(index / PAGE_SIZE);
+                const images = pages.get(page);
+                if (!images) {
+                    loadPage(page);
+                    complete = false;
+                    continue;
+                }
+                const image = images[index % PAGE_SIZE];
+                if (!image) continue;
+                const key = `${index}:${image.name}:${image.updated}:${image.status}:${image.count || 0}`;
+                visible.add(key);
+                let card = cards.get(key);
+                if (!card) {
+                    card = createCard(image);
+                    cards.set(key, card);
+                    gallery.appendChild(card);
+                }
+                card.style.width = `${cardWidth}px`;
+                card.style.left = `${(index % columns) * (cardWidth + GAP)}px`;
+                card.style.top = `${Math.floor(index / columns) * rowHeight}px`;
+            }
+            if (!complete) return;
+            for (const [key, card] of cards) {
+                if (!visible.has(key)) {
+                    card.remove();
+                    cards.delete(key);
+                }
+            }
+        }
+        
+        function updateTlds(tlds) {
+            const select = document.getElementById('tldFilter');
+            const selected = select.value;
+            const options = Object.keys(tlds).sort().map(tld => `${tld}:${tlds[tld]}`).join(',');
+            if (select.dataset.options === options) return;
+            select.dataset.options = options;
+            select.innerHTML = '<option value="">All TLDs</option>';
+            Object.keys(tlds).sort().forEach(tld => {
+                const option = document.createElement('option');
+                option.value = tld;
+                option.textContent = `.${tld} (${tlds[tld]})`;
+                select.appendChild(option);
+            });
+            select.value = selected;
+        }
+        
+        function reloadGallery() {
+            // Drop cached pages but keep cards on screen until their replacements arrive
+            generation++;
+            pages.clear();
+            pending.clear();
+            render();
+        }
+        
+        let filterTimer = null;
+        function filtersChanged() {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(() => {
+                window.scrollTo(0, window.scrollY + document.getElementById('imageGallery').getBoundingClientRect().top - 20);
+                reloadGallery();
+            }, 250);
         }
         
+        function applyUpdate(update) {
+            imageCursor = update.cursor;
+            if (update.reset) {
+                // The server could not replay what was missed
+                reloadGallery();
+                return;
+            }
+            // Re-captures of images already loaded are swapped in place
+            const changed = new Map(update.changed.map(image => [image.name, image]));
+            const removed = new Set(update.removed);
+            let found = 0;
+            for (const images of pages.values()) {
+                images.forEach((image, i) => {
+                    const fresh = changed.get(image.name);
+                    if (fresh) {
+                        images[i] = Object.assign({}, fresh, { count: image.count });
+                        found++;
+                    } else if (removed.has(image.name)) {
+                        images[i] = null;
+                    }
+                });
+            }
+            if (found === changed.size && !removed.size) {
+                scheduleRender();
+                return;
+            }
+            // New or removed images move others between pages: re-query the pages in view, at most once a second
+            if (reloadTimer) return;
+            reloadTimer = setTimeout(() => { reloadTimer = null; reloadGallery(); }, 1000);
+        }
+        
+        let reloadTimer = null;
+        let pollTimer = null;
+        function watchImages() {
+            // Deltas since the cursor of the pages already loaded; a dropped stream resumes from the last event
+            const source = new EventSource(`/images/events?summary=1&since=${imageCursor || ''}`);
+            source.onmessage = event => applyUpdate(JSON.parse(event.data));
+            source.onerror = () => {
+                if (source.readyState === EventSource.CLOSED && !pollTimer) {
+                    // Refused, e.g. too many open streams: catch up by polling, then try the stream again
+                    pollTimer = setInterval(pollImages, 5000);
+                    setTimeout(() => { clearInterval(pollTimer); pollTimer = null; watchImages(); }, 60000);
+                }
+            };
+        }
+        
+        async function pollImages() {
+            if (!imageCursor) {
+                reloadGallery();
+                return;
+            }
+            try {
+                const response = await fetch(`/images?summary=1&since=${imageCursor}`);
+                applyUpdate(await response.json());
+            } catch (error) {
+                console.error('Error:', error);
+            }
+        }
+        
+        let scheduled = false;
+        function scheduleRender() {
+            if (scheduled) return;
+            scheduled = true;
+            requestAnimationFrame(() => { scheduled = false; render(); });
+        }
+        window.addEventListener('scroll', scheduleRender);
+        window.addEventListener('resize', scheduleRender);
+        
         """ + EDITOR_SCRIPTS + """
         """ + REGENERATE_SCRIPT + """
 
-        updateGallery();
-        setInterval(updateGallery, 1000);
+        loadPage(0).then(watchImages);
     </script>
 </body>
 </html>
 """
 
+VIEWER_ETAG = f'"{hashlib.sha256(VIEWER_HTML.encode()).hexdigest()[:16]}"'
+
+# Opened on first use so the server starts even before any batch has run
+job_store = None
+
+# Screenshot batches and domain generation run here instead of on request threads
+jobs = JobManager()
+
+# Stored screenshots, updated by batches in this process and by periodic rescans
+images = ImageIndex()
+
+def run_screenshot_batch(job, incremental):
+    """Background job: capture screenshots in this process and publish progress"""
+    # Imported on first use so the viewer starts without loading the browser stack
+    import screenshot
+    
+    if not incremental and os.path.exists(IMAGE_DIR):
+        # Clear existing screenshots
+        shutil.rmtree(IMAGE_DIR)
+        os.makedirs(IMAGE_DIR)
+        images.clear()
+    
+    counts = screenshot.run_batch(incremental=incremental, resume=False,
+                                  on_progress=lambda progress: job.update(progress=progress),
+                                  on_stored=lambda domain: images.scan())
+    job.update(progress=counts,
+               message=f"Captured {counts['success']} screenshots ({counts['error']} errors, "
+                       f"{counts['dead']} dead domains skipped)")
+
+def run_domain_generation(job, incremental=False):
+    """Background job: regenerate the target list, or append only what new names add"""
+    count = domaingen.generate_domains(incremental=incremental)
+    if count is None:
+        raise RuntimeError('Domain generation failed, see the server log')
+    if incremental:
+        job.update(message=f'Added {count} new domains')
+    else:
+        job.update(message=f'Generated {count} domains')
+
+def remove_images(job):
+    """Background job: delete every stored screenshot"""
+    if os.path.exists(IMAGE_DIR):
+        shutil.rmtree(IMAGE_DIR)
+        os.makedirs(IMAGE_DIR)
+    images.clear()
+    job.update(message='All images removed successfully')
+
+def job_status():
+    """Summary of the latest screenshot run from the job store"""
+    global job_store
+    if job_store is None:
+        job_store = JobStore()
+    run = job_store.latest_run()
+    if run is not None:
+        run['errors'] = job_store.errors(run['id'])
+        run['dead'] = job_store.errors(run['id'], state='dead')
+    return {'run': run}
+
+def parse_range(header, size):
+    """(start, end) of a single 'bytes=' range, None to send the whole file.
+
+    Raises ValueError when the range lies outside the file.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        # Multiple ranges are rare for images; answering with the whole file is allowed
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    if not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        # Malformed ranges are ignored
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        raise ValueError("Range starts past the end of the file")
+    return (start, end) if end >= start else None
+
+def page_bounds(params):
+    """(offset, limit) of a paged catalog request, the limit capped at IMAGE_PAGE_MAX"""
+    offset = max(0, int(params.get('offset', ['0'])[0]))
+    limit = min(IMAGE_PAGE_MAX, max(0, int(params.get('limit', [IMAGE_PAGE_SIZE])[0])))
+    return offset, limit
+
+def rescan_images():
+    """Pick up screenshots recorded in the manifest by screenshot.py running outside the server"""
+    while True:
+        time.sleep(IMAGE_INDEX_RESCAN)
+        images.scan()
+
+def image_update(cursor, listing=True):
+    """Images changed since a client's cursor, or everything when it cannot catch up.
+
+    Without listing a reset carries only the new cursor, for clients that
+    re-query the pages they show.
+    """
+    changes = images.changes_since(images.parse_token(cursor)) if cursor else None
+    if changes is None:
+        if not listing:
+            return {'cursor': images.token(images.cursor), 'reset': True}
+        current, listing = images.snapshot()
+        return {'cursor': images.token(current), 'reset': True, 'images': listing}
+    current, changed, removed = changes
+    return {'cursor': images.token(current), 'changed': changed, 'removed': removed}
+
+# Progress streams hold their worker thread for the whole batch, so they get a
+# share of the pool rather than all of it
+event_streams = threading.BoundedSemaphore(SERVER_MAX_STREAMS)
+
 class ImageListHandler(SimpleHTTPRequestHandler):
+    # Keep-alive: the gallery polls every second over the same connection
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections give their worker back after this many seconds
+    timeout = SERVER_KEEPALIVE_TIMEOUT
+    
+    extensions_map = dict(SimpleHTTPRequestHandler.extensions_map, **{
+        '.webp': 'image/webp',
+        '.avif': 'image/avif',
+    })
+    
     def do_GET(self):
         if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(VIEWER_HTML.encode())
+            self.send_viewer()
             
-        elif self.path == '/images':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
+        elif self.path.startswith(f'/{IMAGE_DIR}/'):
+            self.send_image()
+            
+        elif self.path == '/images' or self.path.startswith('/images?'):
+            self.send_images()
+            
+        elif self.path == '/images/events' or self.path.startswith('/images/events?'):
+            self.stream_images()
+            
+        elif self.path == '/images/groups' or self.path.startswith('/images/groups?'):
+            self.send_image_groups()
+            
+        elif self.path == '/jobs':
+            self.send_json(jobs.list())
+            
+        elif self.path.startswith('/jobs/'):
+            parts = self.path.split('/')
+            job = jobs.get(int(parts[2])) if parts[2].isdigit() else None
+            if job is None:
+                self.send_error(404)
+            elif len(parts) > 3 and parts[3] == 'events':
+                self.stream_job(job)
+            else:
+                self.send_json(job.to_dict())
             
-            image_list = []
-            if os.path.exists(IMAGE_DIR):
-                image_list = [f for f in os.listdir(IMAGE_DIR) if f.endswith('.png')]
-                image_list.sort()
+        elif self.path == '/job-status':
+            self.send_json(job_status())
             
-            self.wfile.write(json.dumps(image_list).encode())
+        elif self.path == '/metrics':
+            # Prometheus text exposition format, covering batches run by this server
+            self.send_body(metrics.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
             
         elif self.path.startswith('/file-content'):
             params = parse_qs(self.path.split('?')[1])
@@ -433,17 +907,288 @@ class ImageListHandler(SimpleHTTPRequestHandler):
                 with open(file_path, 'r') as f:
                     content = f.read()
                 
-                self.send_response(200)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(content.encode())
+                self.send_body(content.encode(), 'text/plain')
             else:
-                self.send_response(404)
-                self.end_headers()
+                self.send_error(404)
+        else:
+            # No catch-all file serving: the working directory holds .env and the job databases
+            self.send_error(404)
+
+    def do_HEAD(self):
+        if self.path == '/':
+            self.send_viewer(head=True)
+        elif self.path.startswith(f'/{IMAGE_DIR}/'):
+            self.send_image(head=True)
         else:
-            return SimpleHTTPRequestHandler.do_GET(self)
+            self.send_error(404)
 
+    def send_viewer(self, head=False):
+        if self.headers.get('If-None-Match') == VIEWER_ETAG:
+            self.send_response(304)
+            self.send_header('ETag', VIEWER_ETAG)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(VIEWER_HTML.encode())))
+        self.send_header('ETag', VIEWER_ETAG)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if not head:
+            self.wfile.write(VIEWER_HTML.encode())
+    
+    def send_image(self, head=False):
+        """Serve a screenshot with validators, Range support and a zero-copy body.
+
+        URLs carrying the file's current ?v= version never change content, so
+        they are cacheable for good; anything else must be revalidated.
+        """
+        url = urlsplit(self.path)
+        root = os.path.realpath(IMAGE_DIR)
+        path = os.path.realpath(unquote(url.path).lstrip('/'))
+        # Only the variant files the catalog links to, not the content store or anything else kept there
+        if not path.startswith(root + os.sep) or not imaging.is_variant_file(os.path.relpath(path, root)):
+            self.send_error(404)
+            return
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        
+        with f:
+            stat = os.fstat(f.fileno())
+            version = version_tag(stat)
+            etag = f'"{version}-{stat.st_size:x}"'
+            if parse_qs(url.query).get('v', [''])[0] == version:
+                cache_control = f'public, max-age={IMAGE_CACHE_MAX_AGE}, immutable'
+            else:
+                cache_control = 'no-cache'
+            
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                return
+            
+            start, end = 0, stat.st_size - 1
+            status = 200
+            # A Range for an outdated copy (If-Range mismatch) gets the whole new file
+            if self.headers.get('If-Range', etag) == etag:
+                try:
+                    requested = parse_range(self.headers.get('Range'), stat.st_size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{stat.st_size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if requested:
+                    start, end = requested
+                    status = 206
+            
+            length = max(0, end - start + 1)
+            self.send_response(status)
+            self.send_header('Content-type', self.guess_type(path))
+            self.send_header('Content-Length', str(length))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{stat.st_size}')
+            self.end_headers()
+            
+            if not head and length:
+                try:
+                    # socket.sendfile uses os.sendfile, copying straight from the page cache
+                    self.connection.sendfile(f, start, length)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+    
+    def send_body(self, body, content_type, status=200):
+        # Every response carries its length so the connection can be reused
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode(), 'application/json', status)
+    
+    def handle_work(self):
+        """Coordinator side of distributed capture: leases, heartbeats and uploads from worker.py"""
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not coordinator.authorized(self.headers.get('Authorization')):
+            # The body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            self.send_json({'error': 'unauthorized'}, 401)
+            return
+        if not 0 <= length <= coordinator.MAX_UPLOAD_BYTES:
+            self.close_connection = True
+            self.send_json({'error': f'request body must be at most {coordinator.MAX_UPLOAD_BYTES} bytes'}, 413)
+            return
+        body = self.rfile.read(length)
+        try:
+            status, response = coordinator.handle(self.path, json.loads(body or b'{}'))
+        except (ValueError, TypeError, AttributeError) as e:
+            status, response = 400, {'error': str(e)}
+        self.send_json(response, status)
+    
+    def send_images(self):
+        """Full image list with an ETag, only the changes after ?since=<cursor>, or one page of a search"""
+        params = parse_qs(urlsplit(self.path).query)
+        since = params.get('since', [''])[0]
+        if since:
+            self.send_json(image_update(since, params.get('summary', [''])[0] != '1'))
+            return
+        if any(name in params for name in ('offset', 'limit', 'q', 'tld', 'sort', 'group')):
+            self.send_image_page(params)
+            return
+        
+        cursor, listing = images.snapshot()
+        etag = f'"{images.token(cursor)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        body = json.dumps({'cursor': images.token(cursor), 'reset': True, 'images': listing}).encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_image_page(self, params):
+        """/images?offset=&limit=&q=&tld=&sort=&group= against the catalog, with the total match count"""
+        try:
+            offset, limit = page_bounds(params)
+            cursor, total, page = images.query(offset, limit,
+                                               q=params.get('q', [''])[0].strip(),
+                                               tld=params.get('tld', [''])[0].strip().lstrip('.').lower(),
+                                               sort=params.get('sort', ['domain'])[0],
+                                               group=params.get('group', [''])[0])
+        except ValueError as e:
+            self.send_json({'success': False, 'message': str(e)}, status=400)
+            return
+        self.send_json({
+            'cursor': images.token(cursor),
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'images': page,
+            'tlds': images.tlds()
+        })
+    
+    def send_image_groups(self):
+        """/images/groups?offset=&limit=&q=&tld=: look-alike groups, largest first, one cover image each"""
+        params = parse_qs(urlsplit(self.path).query)
+        try:
+            offset, limit = page_bounds(params)
+        except ValueError as e:
+            self.send_json({'success': False, 'message': str(e)}, status=400)
+            return
+        cursor, total, page = images.groups(offset, limit,
+                                            q=params.get('q', [''])[0].strip(),
+                                            tld=params.get('tld', [''])[0].strip().lstrip('.').lower())
+        self.send_json({
+            'cursor': images.token(cursor),
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'groups': page,
+            'tlds': images.tlds()
+        })
+    
+    def start_event_stream(self):
+        """Send event stream headers; False (after a 503) when every stream slot is taken"""
+        if not event_streams.acquire(blocking=False):
+            self.send_response(503)
+            self.send_header('Retry-After', '5')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+        
+        # The stream has no length, so it ends the connection when done
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # Heartbeats are written more often than the idle timeout
+        self.connection.settimeout(None)
+        return True
+    
+    def stream_images(self):
+        """Push image additions and removals as Server-Sent Events"""
+        if not self.start_event_stream():
+            return
+        
+        # ?summary=1 leaves the full listing out of resets, for clients that re-query pages themselves
+        params = parse_qs(urlsplit(self.path).query)
+        listing = params.get('summary', [''])[0] != '1'
+        # EventSource sends the id of the last event it saw when it reconnects
+        since = self.headers.get('Last-Event-ID') or params.get('since', [''])[0]
+        cursor = since
+        update = image_update(since, listing)
+        if not update.get('reset') and not update['changed'] and not update['removed']:
+            # The client is up to date
+            update = None
+        try:
+            while True:
+                if update is None:
+                    self.wfile.write(b': keep-alive\n\n')
+                else:
+                    self.wfile.write(f"id: {update['cursor']}\ndata: {json.dumps(update)}\n\n".encode())
+                    cursor = update['cursor']
+                self.wfile.flush()
+                
+                seen = images.parse_token(cursor)
+                current = images.wait_for_change(seen, JOB_EVENT_HEARTBEAT)
+                update = None if current == seen else image_update(cursor, listing)
+        except (BrokenPipeError, ConnectionResetError):
+            # The viewer closed the page
+            pass
+        finally:
+            event_streams.release()
+    
+    def stream_job(self, job):
+        """Push job updates as Server-Sent Events until the job finishes"""
+        if not self.start_event_stream():
+            return
+        
+        version = -1
+        try:
+            while True:
+                snapshot, version = job.wait_for_change(version, JOB_EVENT_HEARTBEAT)
+                if snapshot is None:
+                    self.wfile.write(b': keep-alive\n\n')
+                else:
+                    self.wfile.write(f"data: {json.dumps(snapshot)}\n\n".encode())
+                self.wfile.flush()
+                if snapshot is not None and snapshot['state'] in ('done', 'failed'):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            # The viewer closed the page
+            pass
+        finally:
+            event_streams.release()
+    
     def do_POST(self):
+        if self.path.startswith('/work/'):
+            self.handle_work()
+            return
+        
         content_length = int(self.headers.get('Content-Length', 0))
         post_data = self.rfile.read(content_length).decode('utf-8') if content_length > 0 else ''
         params = parse_qs(post_data)
@@ -451,32 +1196,21 @@ class ImageListHandler(SimpleHTTPRequestHandler):
         response = {'success': False, 'message': 'Invalid request'}
         
         if self.path == '/regenerate-screenshots':
-            try:
-                # Clear existing screenshots
-                if os.path.exists(IMAGE_DIR):
-                    shutil.rmtree(IMAGE_DIR)
-                    os.makedirs(IMAGE_DIR)
-                
-                # Run screenshot script
-                result = subprocess.run(['python3', 'screenshot.py'], 
-                                     capture_output=True, 
-                                     text=True)
+            job = jobs.start('screenshots', run_screenshot_batch, incremental=False)
+            response = {
+                'success': True,
+                'message': 'Screenshot regeneration started',
+                'job_id': job.id
+            }
                 
-                if result.returncode == 0:
-                    response = {
-                        'success': True,
-                        'message': 'Screenshots regenerated successfully'
-                    }
-                else:
-                    response = {
-                        'success': False,
-                        'message': f'Error regenerating screenshots: {result.stderr}'
-                    }
-            except Exception as e:
-                response = {
-                    'success': False,
-                    'message': f'Error regenerating screenshots: {str(e)}'
-                }
+        elif self.path == '/update-screenshots':
+            # Keep existing screenshots and only capture missing, stale or failed domains
+            job = jobs.start('screenshots', run_screenshot_batch, incremental=True)
+            response = {
+                'success': True,
+                'message': 'Capturing new and stale screenshots',
+                'job_id': job.id
+            }
                 
         elif self.path == '/save-file':
             file_type = params.get('file', [''])[0]
@@ -497,25 +1231,19 @@ class ImageListHandler(SimpleHTTPRequestHandler):
                     response = {'success': False, 'message': f'Error saving file: {str(e)}'}
                     
         elif self.path == '/regenerate-domains':
-            try:
-                subprocess.run(['python3', 'domaingen.py'])
-                response = {'success': True, 'message': 'Domains regenerated successfully'}
-            except Exception as e:
-                response = {'success': False, 'message': f'Error regenerating domains: {str(e)}'}
+            job = jobs.start('domains', run_domain_generation)
+            response = {'success': True, 'message': 'Domain regeneration started', 'job_id': job.id}
                 
         elif self.path == '/remove-images':
-            try:
-                if os.path.exists(IMAGE_DIR):
-                    shutil.rmtree(IMAGE_DIR)
-                    os.makedirs(IMAGE_DIR)
-                response = {'success': True, 'message': 'All images removed successfully'}
-            except Exception as e:
-                response = {'success': False, 'message': f'Error removing images: {str(e)}'}
+            # Queued behind any running batch so it never deletes files mid-capture
+            job = jobs.start('screenshots', remove_images)
+            response = {'success': True, 'message': 'Removing all images', 'job_id': job.id}
                 
         elif self.path == '/remove-domains':
             try:
                 with open(TARGET_FILE, 'w') as f:
                     f.write('')
+                domaingen.reset_state()
                 response = {'success': True, 'message': 'All domains removed successfully'}
             except Exception as e:
                 response = {'success': False, 'message': f'Error removing domains: {str(e)}'}
@@ -526,6 +1254,7 @@ class ImageListHandler(SimpleHTTPRequestHandler):
                     f.write('')
                 with open(TARGET_FILE, 'w') as f:
                     f.write('')
+                domaingen.reset_state()
                 response = {'success': True, 'message': 'All names and generated domains removed successfully'}
             except Exception as e:
                 response = {'success': False, 'message': f'Error removing names: {str(e)}'}
@@ -548,23 +1277,86 @@ class ImageListHandler(SimpleHTTPRequestHandler):
                 try:
                     with open(SOURCE_FILE, 'a') as f:
                         f.write(f"{name}\n")
-                    subprocess.run(['python3', 'domaingen.py'])
-                    response = {'success': True, 'message': f'Name {name} added and domains generated'}
+                    # Only the new name's combinations are appended
+                    job = jobs.start('domains', run_domain_generation, incremental=True)
+                    response = {
+                        'success': True,
+                        'message': f'Name {name} added, generating domains',
+                        'job_id': job.id
+                    }
                 except Exception as e:
                     response = {'success': False, 'message': f'Error adding name: {str(e)}'}
             else:
                 response = {'success': False, 'message': 'Name cannot be empty'}
         
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(response).encode())
+        self.send_json(response)
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server handling connections on a fixed pool of worker threads.
+
+    At most workers connections are served at once and queue_size more wait
+    for a thread; anything beyond that is answered 503 straight away instead
+    of piling up. Long operations never run on these threads, they are handed
+    to the JobManager.
+    """
+    
+    request_queue_size = 128
+    
+    def __init__(self, address, handler, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+    
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.reject(request)
+            return
+        try:
+            self.executor.submit(self.process_request_thread, request, client_address)
+        except RuntimeError:
+            # Shutting down
+            self.slots.release()
+            self.shutdown_request(request)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+    
+    def reject(self, request):
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                            b'Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 def run_server():
+    if CAPTURE_ENGINE == 'remote':
+        try:
+            coordinator.check_exposure(SERVER_HOST)
+        except ValueError as e:
+            raise SystemExit(str(e))
     if not os.path.exists(IMAGE_DIR):
         os.makedirs(IMAGE_DIR)
+    
+    if needs_migration(IMAGE_DIR):
+        print(f"{IMAGE_DIR} still has screenshots in the flat layout, which the gallery does not show; "
+              f"run python migrate_images.py to move them")
+    images.scan()
+    if IMAGE_INDEX_RESCAN > 0:
+        threading.Thread(target=rescan_images, daemon=True).start()
         
-    server = HTTPServer((SERVER_HOST, SERVER_PORT), ImageListHandler)
+    # Pooled so progress streams and slow clients do not block the gallery
+    server = PooledHTTPServer((SERVER_HOST, SERVER_PORT), ImageListHandler)
     print(f"Server started at http://{SERVER_HOST}:{SERVER_PORT}")
     print(f"View the gallery at http://{SERVER_HOST}:{SERVER_PORT}/")
     server.serve_forever()
@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+# Modules read their configuration when imported, so point every file they use at a scratch directory first
+WORKDIR = tempfile.mkdtemp(prefix='screenshot-tests-')
+os.environ.update({
+    'IMAGE_DIR': os.path.join(WORKDIR, 'img'),
+    'MANIFEST_FILE': os.path.join(WORKDIR, 'manifest.jsonl'),
+    'JOB_DB': os.path.join(WORKDIR, 'jobs.db'),
+    'PRECHECK_CACHE': os.path.join(WORKDIR, 'precheck.db'),
+    'COORDINATOR_TOKEN': '',
+    'POSTPROCESS_WORKERS': '1',
+    'WORKER_POLL_INTERVAL': '0.1',
+})
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
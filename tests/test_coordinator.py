@@ -0,0 +1,185 @@
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import pytest
+from PIL import Image
+from conftest import ROOT, WORKDIR
+import coordinator
+import imaging
+import server
+
+# A worker process whose engine paints a flat image per domain instead of opening a browser
+WORKER = '''
+import concurrent.futures
+import hashlib
+import io
+import signal
+import sys
+import time
+import pipeline
+import worker
+from PIL import Image
+
+
+class FakeEngine:
+    concurrency = 2
+
+    def __init__(self, on_capture):
+        self.on_capture = on_capture
+        self.metrics = pipeline.StageMetrics('capture')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def capture(self, domain):
+        time.sleep(0.5)
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 300), tuple(hashlib.sha256(domain.encode()).digest()[:3])).save(buffer, 'PNG')
+        return self.on_capture(domain, buffer.getvalue()).result()
+
+    def submit(self, domain):
+        return self.executor.submit(self.capture, domain)
+
+    def rss_mb(self):
+        return 0
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+worker.screenshot.create_engine = lambda on_capture, name: FakeEngine(on_capture)
+capture_worker = worker.Worker(url=sys.argv[1], name=sys.argv[2])
+signal.signal(signal.SIGTERM, lambda signum, frame: capture_worker.stop())
+capture_worker.run()
+'''
+
+
+def png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (400, 300), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def upload(color='white'):
+    stored = imaging.encode_variants(png(color))
+    return {'hash': stored['hash'], 'phash': stored['phash'],
+            'files': {name: base64.b64encode(data).decode() for name, data in stored['files'].items()}}
+
+
+def post(url, path, body, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    request = urllib.request.Request(url + path, data=json.dumps(body).encode(), headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+@pytest.fixture
+def coordinator_url():
+    httpd = server.PooledHTTPServer(('127.0.0.1', 0), server.ImageListHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = coordinator.RemoteEngine(str(tmp_path / 'img'), lease_timeout=30)
+    try:
+        yield engine
+    finally:
+        engine.close()
+
+
+def test_workers_share_one_coordinator(coordinator_url, engine, tmp_path):
+    settled_by = {}
+    complete = engine.complete
+
+    def record(worker, domain, result):
+        accepted = complete(worker, domain, result)
+        if accepted:
+            settled_by[domain] = worker
+        return accepted
+
+    engine.complete = record
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    names = [f'worker-{n}' for n in range(3)]
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, coordinator_url, name], cwd=WORKDIR, env=env)
+               for name in names]
+    try:
+        # Wait until every worker polls, so none of them starts after the work is gone
+        deadline = time.monotonic() + 60
+        while set(engine.workers) != set(names):
+            assert time.monotonic() < deadline, 'workers did not start'
+            time.sleep(0.1)
+        domains = [f'site{n}.example' for n in range(12)]
+        futures = {domain: engine.submit(domain) for domain in domains}
+        for domain, future in futures.items():
+            stored = future.result(timeout=60)
+            for name, _ in imaging.VARIANTS:
+                path = imaging.variant_path(str(tmp_path / 'img'), name, imaging.screenshot_path(domain))
+                assert os.path.exists(path)
+            assert len(stored['hash']) == 64
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.wait(timeout=30)
+    assert sorted(settled_by) == sorted(domains)
+    assert len(set(settled_by.values())) > 1
+    assert not engine.leases
+
+
+def test_only_a_live_lease_settles_a_domain(engine):
+    engine.lease_timeout = 0.2
+    future = engine.submit('example.com')
+    assert engine.lease('first', 1) == ['example.com']
+
+    # Another worker's upload for a domain it does not hold
+    assert not engine.complete('second', 'example.com', upload())
+    assert not future.done()
+
+    time.sleep(0.3)
+    # The lease ran out: neither a heartbeat nor a late result brings it back
+    assert engine.heartbeat('first', ['example.com']) == 0
+    assert not engine.complete('first', 'example.com', upload('red'))
+    assert not future.done()
+
+    assert engine.lease('second', 1) == ['example.com']
+    result = upload()
+    assert engine.complete('second', 'example.com', result)
+    assert future.result(timeout=5)['hash'] == result['hash']
+
+
+def test_work_routes_check_token_and_size(coordinator_url, engine, monkeypatch):
+    monkeypatch.setattr(coordinator, 'COORDINATOR_TOKEN', 'secret')
+    assert post(coordinator_url, '/work/lease', {'worker': 'w'})[0] == 401
+    assert post(coordinator_url, '/work/lease', {'worker': 'w'}, 'wrong')[0] == 401
+    assert post(coordinator_url, '/work/lease', {'worker': 'w'}, 'secret')[0] == 200
+
+    monkeypatch.setattr(coordinator, 'MAX_UPLOAD_BYTES', 100)
+    assert post(coordinator_url, '/work/result', {'worker': 'w', 'padding': 'x' * 200}, 'secret')[0] == 413
+
+
+def test_coordinator_needs_token_off_loopback(monkeypatch):
+    coordinator.check_exposure('localhost')
+    coordinator.check_exposure('127.0.0.1')
+    with pytest.raises(ValueError):
+        coordinator.check_exposure('0.0.0.0')
+    with pytest.raises(ValueError):
+        coordinator.check_exposure('')
+    monkeypatch.setattr(coordinator, 'COORDINATOR_TOKEN', 'secret')
+    coordinator.check_exposure('0.0.0.0')
@@ -0,0 +1,27 @@
+import imaging
+import migrate_images
+
+
+def test_http_and_https_targets_get_their_own_files():
+    names = {target: imaging.screenshot_name(target)
+             for target in ('example.com', 'http://example.com', 'http://example.com:8080', 'example.com:8080')}
+    assert len(set(names.values())) == len(names)
+    assert len({imaging.screenshot_path(target) for target in names}) == len(names)
+    for target, name in names.items():
+        assert imaging.domain_from_name(name) == target
+    # https is the default scheme: writing it out changes nothing
+    assert imaging.screenshot_name('https://example.com') == names['example.com']
+
+
+def test_names_are_reversible():
+    for target in ('a_b.com', 'a-b.com', '.hidden.com', 'example.com/path?q=1', 'http://[::1]:8080', 'xn--bcher-kva.de'):
+        name = imaging.screenshot_name(target)
+        assert set(name) <= imaging.NAME_CHARACTERS | {'_'}
+        assert not name.startswith('.')
+        assert imaging.domain_from_name(name) == target
+    assert imaging.screenshot_name('a_b.com') != imaging.screenshot_name('a-b.com')
+
+
+def test_legacy_names_keep_the_old_collision():
+    # The flat layout dropped the scheme; migration has to see both targets behind the one file
+    assert migrate_images.legacy_name('http://example.com') == migrate_images.legacy_name('example.com')
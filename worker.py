@@ -0,0 +1,183 @@
+import base64
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import urllib.request
+import adaptive
+import coordinator
+import imaging
+import pipeline
+import screenshot
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Get configuration from environment
+WORKER_COORDINATOR = os.getenv('WORKER_COORDINATOR', 'http://localhost:8000').rstrip('/')
+WORKER_NAME = os.getenv('WORKER_NAME', '') or f"{socket.gethostname()}-{os.getpid()}"
+# Capture engine the worker runs: selenium or cdp
+WORKER_ENGINE = os.getenv('WORKER_ENGINE', 'selenium')
+# Domains asked for per lease request, and seconds between requests while the coordinator has none
+WORKER_BATCH = int(os.getenv('WORKER_BATCH', 8))
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', 2))
+# Concurrent result uploads, and seconds before a request to the coordinator is given up
+WORKER_UPLOADS = int(os.getenv('WORKER_UPLOADS', 4))
+WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', 30))
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', 0))
+
+
+class Worker:
+    """Stateless capture worker for a coordinator running with CAPTURE_ENGINE=remote.
+
+    Leases batches of domains, captures them with a local engine, encodes the
+    variants with the coordinator's output settings and uploads them. Nothing
+    is kept on disk, so any number of workers can run on any number of hosts.
+    Leases are renewed while captures are in flight; if a worker dies, its
+    domains are handed to another worker once their lease times out.
+    """
+
+    def __init__(self, url=WORKER_COORDINATOR, name=WORKER_NAME, engine=WORKER_ENGINE, batch=WORKER_BATCH):
+        self.url = url
+        self.name = name
+        self.engine_name = engine
+        self.batch = max(1, batch)
+        self.output = coordinator.output_settings()
+        self.lease_seconds = coordinator.LEASE_TIMEOUT
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.controller = None
+        # Leased domains not uploaded or given up on yet; only their leases are renewed
+        self.in_flight = set()
+        self.captured = 0
+        self.failed = 0
+
+    def request(self, path, body):
+        headers = {'Content-Type': 'application/json'}
+        if coordinator.COORDINATOR_TOKEN:
+            headers['Authorization'] = f'Bearer {coordinator.COORDINATOR_TOKEN}'
+        data = json.dumps(dict(body, worker=self.name)).encode()
+        request = urllib.request.Request(self.url + path, data=data, headers=headers)
+        with urllib.request.urlopen(request, timeout=WORKER_TIMEOUT) as response:
+            return json.load(response)
+
+    def on_capture(self, domain, png):
+        """Queue captured bytes for encoding; the engine calls this in place of store_screenshot"""
+        output = self.output
+        return self.stage.submit(imaging.encode_variants, png, [tuple(variant) for variant in output['variants']],
+                                 output['format'], output['quality'])
+
+    def upload(self, domain, future, submitted):
+        if self.controller is not None:
+            self.controller.observe(time.monotonic() - submitted, None if future.cancelled() else future.exception())
+        try:
+            stored = future.result()
+            result = {'hash': stored['hash'], 'phash': stored['phash'], 'timings': stored['timings'],
+                      'files': {name: base64.b64encode(data).decode() for name, data in stored['files'].items()}}
+        except Exception as e:
+            # The coordinator classifies the error and decides on a retry
+            result = {'error': str(e)}
+        try:
+            if not self.request('/work/result', dict(result, domain=domain)).get('accepted'):
+                logging.warning(f"Coordinator no longer wanted {domain}")
+        except Exception as e:
+            logging.error(f"Could not upload {domain}, its lease will run out and it is captured again: {str(e)}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(domain)
+                if 'error' in result:
+                    self.failed += 1
+                else:
+                    self.captured += 1
+            self.slots.release()
+
+    def heartbeats(self):
+        """Renew the leases of captures in flight until the worker stops"""
+        while not self.done.wait(self.lease_seconds / 3):
+            with self.lock:
+                domains = sorted(self.in_flight)
+            if not domains:
+                continue
+            try:
+                self.request('/work/heartbeat', {'domains': domains})
+            except Exception as e:
+                logging.warning(f"Heartbeat to {self.url} failed: {str(e)}")
+
+    def run(self):
+        self.stage = pipeline.PostProcessStage()
+        try:
+            engine = screenshot.create_engine(self.on_capture, self.engine_name)
+        except Exception:
+            self.stage.close()
+            raise
+        uploads = concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_UPLOADS)
+        # With ADAPTIVE_CONCURRENCY each worker host finds its own limit
+        self.slots, self.controller = adaptive.create_slots(engine, MAX_IN_FLIGHT or engine.concurrency * 2,
+                                                            screenshot.MAX_WORKERS)
+        self.done = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeats, daemon=True)
+        heartbeat.start()
+        logging.info(f"Worker {self.name} capturing for {self.url} with {self.engine_name} "
+                     f"({self.slots.limit} in flight)")
+
+        try:
+            while not self.stopping.is_set():
+                room = self.slots.wait_free(1)
+                if not room:
+                    continue
+                try:
+                    lease = self.request('/work/lease', {'size': min(room, self.batch)})
+                except Exception as e:
+                    logging.warning(f"Could not reach coordinator {self.url}: {str(e)}")
+                    self.stopping.wait(WORKER_POLL_INTERVAL)
+                    continue
+                if not lease['domains']:
+                    self.stopping.wait(WORKER_POLL_INTERVAL)
+                    continue
+                self.output = lease['output']
+                self.lease_seconds = lease['lease_seconds']
+                with self.lock:
+                    self.in_flight.update(lease['domains'])
+                for domain in lease['domains']:
+                    self.slots.acquire()
+                    submitted = time.monotonic()
+                    future = engine.submit(domain)
+                    future.add_done_callback(lambda f, domain=domain, submitted=submitted:
+                                             uploads.submit(self.upload, domain, f, submitted))
+
+        finally:
+            # Finish what was leased so it does not wait for the lease timeout
+            self.slots.wait_idle()
+            if self.controller is not None:
+                self.controller.stop()
+            engine.close()
+            self.stage.close()
+            uploads.shutdown(wait=True)
+            self.done.set()
+            engine.metrics.log_summary()
+            self.stage.metrics.log_summary()
+            logging.info(f"Worker {self.name} stopped: {self.captured} captured, {self.failed} failed")
+
+    def stop(self):
+        self.stopping.set()
+
+
+def main():
+    worker = Worker()
+
+    def stop(signum, frame):
+        logging.info("Stopping once the captures in flight are uploaded")
+        worker.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()